@@ -1,6 +1,9 @@
 import argparse
 from pathlib import Path
 
+from nixos_gen_config.devices import device_backends
+from nixos_gen_config.hardware import cpu_profiles
+
 
 def process_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -27,17 +30,164 @@ def process_args() -> argparse.Namespace:
         help="Overwrite /etc/nixos/configuration.nix if it already exists",
     )
     parser.add_argument(
-        # NOTE: remember to change default to 0
         "--debug",
         action="store_true",
-        default=1,
         help="icecream debug",
     )
+    parser.add_argument(
+        "--timings",
+        nargs="?",
+        const="text",
+        choices=["text", "json"],
+        help=(
+            "Report the wall time of every detection section, systemd-detect-virt, rendering and writing, and the "
+            "number of udev devices and mounts looked at, to stderr. --timings=json reports them as JSON"
+        ),
+    )
+    parser.add_argument(
+        "--timings-file",
+        type=Path,
+        metavar="FILE",
+        help="Write the --timings report to FILE instead of stderr",
+    )
     parser.add_argument(
         "--no-filesystems",
         action="store_true",
         help="Omit everything concerning file systems and swap devices from the hardware configuration",
     )
+    parser.add_argument(
+        "--minimal-initrd",
+        action="store_true",
+        help=(
+            "Only put the modules needed for the devices of the /, /nix, /boot and /var file systems and of the "
+            "keyboards into boot.initrd.availableKernelModules, leaving out modules the others load as dependencies. "
+            "Only for this machine, not with --from-snapshot, --batch or --remote"
+        ),
+    )
+    parser.add_argument(
+        "--cpu-profile",
+        choices=cpu_profiles,
+        default="auto",
+        help=(
+            "How to set up cpu frequency scaling. auto keeps the driver and picks a governor that scales, "
+            "throughput (servers) and power (laptops) switch amd and intel cpus that support it to the active "
+            "pstate driver and set the governor and energy performance preference for speed or battery life"
+        ),
+    )
+    parser.add_argument(
+        "--memory-tuning",
+        action="store_true",
+        help=(
+            "Also look at the numa nodes and huge page sizes: enable irqbalance and automatic numa balancing on "
+            "machines with several nodes and default to 1G huge pages on machines with 64GiB or more. "
+            "The topology the detection used is printed to stderr, with --batch and --remote after the host name. "
+            "Nothing is printed when the cached configuration is reused"
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help=(
+            "Number of detection sections to run in parallel, 1 runs them one after another. "
+            "With --batch the number of worker processes"
+        ),
+    )
+    parser.add_argument(
+        "--device-backend",
+        choices=device_backends,
+        default="auto",
+        help=(
+            "Where to read udev devices from: pyudev uses libudev, sysfs reads /sys and /run/udev/data directly and "
+            "works without libudev. auto uses pyudev when libudev can be loaded"
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=(
+            "Always run the detection. By default the configuration of the last run, cached in DIR, is reused when "
+            "the hardware fingerprint of this machine hasn't changed"
+        ),
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help=(
+            "Write nothing and exit with 1 when regenerating hardware-configuration.nix would change it, "
+            "0 when it is up to date"
+        ),
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help=(
+            "Like --check, and print the modules, attrs and fileSystems entries that would change, "
+            "one change per line"
+        ),
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "Keep running and update hardware-configuration.nix when pci, block or input devices are added or "
+            "removed. Only the detection sections reading the subsystem of an event are rerun"
+        ),
+    )
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=1.0,
+        metavar="SECONDS",
+        help="With --watch, wait until no udev event arrived for SECONDS before updating the configuration",
+    )
+    parser.add_argument(
+        "--capture",
+        type=Path,
+        metavar="SNAPSHOT",
+        help=(
+            "Record the hardware the detection reads into the archive SNAPSHOT (e.g. snapshot.tar.xz) instead of "
+            "generating a configuration"
+        ),
+    )
+    parser.add_argument(
+        "--from-snapshot",
+        type=Path,
+        metavar="SNAPSHOT",
+        help="Generate the hardware configuration from an archive written by --capture instead of this machine",
+    )
+    parser.add_argument(
+        "--batch",
+        type=Path,
+        metavar="SNAPSHOT_DIR",
+        help=(
+            "Generate a hardware configuration for every snapshot in SNAPSHOT_DIR, each written to "
+            "DIR/<snapshot name>/hardware-configuration.nix"
+        ),
+    )
+    parser.add_argument(
+        "--remote",
+        action="append",
+        metavar="HOST",
+        help=(
+            "Generate the hardware configuration of HOST over ssh into DIR/HOST/hardware-configuration.nix, may be "
+            "given several times. Only python3 is needed on HOST, a small collector reads the hardware there in one "
+            "ssh exec and the detection runs locally. --jobs hosts are collected at once"
+        ),
+    )
+    parser.add_argument(
+        "--remote-python",
+        default="python3",
+        metavar="PYTHON",
+        help="The python interpreter --remote runs the collector with on the remote hosts",
+    )
+    parser.add_argument(
+        "--remote-timeout",
+        type=float,
+        default=300.0,
+        metavar="SECONDS",
+        help="With --remote, give up on a host that hasn't sent its hardware after SECONDS and count it as failed",
+    )
     parser.add_argument(
         "--show-hardware-config",
         action="store_true",
@@ -46,4 +196,8 @@ def process_args() -> argparse.Namespace:
             "stdout only."
         ),
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.minimal_initrd and (args.from_snapshot or args.batch or args.remote):
+        # the module dependencies and the slaves of the boot devices are read from this machine
+        parser.error("--minimal-initrd can't be combined with --from-snapshot, --batch or --remote")
+    return args
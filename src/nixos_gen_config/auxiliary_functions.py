@@ -1,40 +1,25 @@
 from pathlib import Path
+from typing import Iterable
 
 
-def uniq(list1: list[str]) -> list[str]:
-    uniq_list: list[str] = []
-    for item in list1:
-        if item not in uniq_list:
-            uniq_list.append(item)
-    return uniq_list
+def uniq(list1: Iterable[str]) -> list[str]:
+    # dicts keep insertion order, so this keeps the first occurrence of every item
+    return list(dict.fromkeys(list1))
 
 
 def to_nix_string_list(*args: str) -> str:
-    res = ""
-    for item in args:
-        res += f' "{item}"'
-    return res
+    return "".join(f' "{item}"' for item in args)
 
 
 def to_nix_list(*args: str) -> str:
-    res = ""
-    for item in args:
-        res += f" {item}"
-    return res
+    return "".join(f" {item}" for item in args)
 
 
 def to_nix_multi_line_list(indent: str, *args: str) -> str:
     if not args:
         return " [ ]"
-    res = f"\n{indent}[ "
-    first = 1
-    for item in args:
-        if not first:
-            res += f"{indent}  "
-        first = 0
-        res += f"{item}\n"
-    res += f"{indent}]"
-    return res
+    items = f"\n{indent}  ".join(args)
+    return f"\n{indent}[ {items}\n{indent}]"
 
 
 def to_nix_true_attr(attr: str) -> str:
@@ -0,0 +1,74 @@
+import re
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.sections import run_sections
+from nixos_gen_config.snapshot import open_snapshot
+from nixos_gen_config.write_config import write_config_file
+
+snapshot_suffix = re.compile(r"\.tar(\.(gz|xz|bz2))?$")
+
+
+def host_name(snapshot: Path) -> str:
+    return snapshot_suffix.sub("", snapshot.name)
+
+
+def list_snapshots(snapshot_dir: Path) -> list[Path]:
+    return sorted(path for path in snapshot_dir.iterdir() if path.is_file() and snapshot_suffix.search(path.name))
+
+
+def generate_host(
+    snapshot: Path,
+    out_dir: Path,
+    root_dir: Path,
+    no_filesystems: bool,
+    cpu_profile: str = "auto",
+    memory_tuning: bool = False,
+) -> Path:
+    """render and write the hardware configuration of one snapshot, runs in a worker process.
+    the rule tables of hardware.py are module level, so a worker builds them once on import and reuses them
+    for every host it is given"""
+    with open_snapshot(snapshot) as host_snapshot:
+        host_snapshot.name = host_name(snapshot)
+        nix_hw_config = run_sections(host_snapshot.sections(root_dir, no_filesystems, cpu_profile, memory_tuning))
+
+    config_dir = out_dir.joinpath(host_name(snapshot))
+    config_dir.mkdir(parents=True, exist_ok=True)
+    config_file = config_dir.joinpath("hardware-configuration.nix")
+    write_config_file(config_file, generate_hw_config(nix_hw_config))
+    return config_file
+
+
+def run_batch(
+    snapshot_dir: Path,
+    out_dir: Path,
+    root_dir: Path,
+    no_filesystems: bool,
+    workers: int,
+    cpu_profile: str = "auto",
+    memory_tuning: bool = False,
+) -> int:
+    """generate a hardware configuration for every snapshot in snapshot_dir into out_dir/<host>/.
+    progress and errors are printed as the hosts finish, returns the number of failed hosts"""
+    snapshots = list_snapshots(snapshot_dir)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures: dict[Future[Path], Path] = {
+            executor.submit(
+                generate_host, snapshot, out_dir, root_dir, no_filesystems, cpu_profile, memory_tuning
+            ): snapshot
+            for snapshot in snapshots
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            host = host_name(futures[future])
+            try:
+                config_file = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                # one broken snapshot shouldn't stop the rest of the fleet
+                failed += 1
+                print(f"[{done}/{len(snapshots)}] {host}: failed: {error}", file=sys.stderr, flush=True)
+            else:
+                print(f"[{done}/{len(snapshots)}] {host}: wrote {config_file}", flush=True)
+    return failed
@@ -1,26 +1,101 @@
-from dataclasses import dataclass, field
+from typing import Iterable, Iterator
 
-from nixos_gen_config.auxiliary_functions import to_nix_list, to_nix_string_list, uniq
+from nixos_gen_config.auxiliary_functions import to_nix_list, to_nix_string_list
+
+
+class OrderedSet:
+    """insertion ordered set of strings with the list methods the detectors use.
+    appending a value that is already there keeps the first position"""
+
+    __slots__ = ("_items",)
+
+    def __init__(self, items: Iterable[str] = ()) -> None:
+        self._items: dict[str, None] = dict.fromkeys(items)
+
+    def append(self, item: str) -> None:
+        self._items[item] = None
+
+    def extend(self, items: Iterable[str]) -> None:
+        self._items.update(dict.fromkeys(items))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, item: object) -> bool:
+        return item in self._items
+
+    def __getitem__(self, index: int) -> str:
+        return list(self._items)[index]
+
+    def __eq__(self, other: object) -> bool:
+        # compares in order, also against plain lists
+        if isinstance(other, (OrderedSet, list, tuple)):
+            return list(self._items) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"OrderedSet({list(self._items)!r})"
 
 
-@dataclass
 class NixConfigAttrs:
-    attrs: list[str] = field(default_factory=list)
-    fsattrs: list[str] = field(default_factory=list)
-    initrd_available_kernel_modules: list[str] = field(default_factory=list)
-    initrd_kernel_modules: list[str] = field(default_factory=list)
-    kernel_modules: list[str] = field(default_factory=list)
-    module_packages: list[str] = field(default_factory=list)
-    firmware_packages: list[str] = field(default_factory=list)
-    imports: list[str] = field(default_factory=list)
+    __slots__ = (
+        "attrs",
+        "fsattrs",
+        "initrd_available_kernel_modules",
+        "initrd_kernel_modules",
+        "kernel_modules",
+        "module_packages",
+        "firmware_packages",
+        "kernel_params",
+        "imports",
+    )
+
+    def __init__(
+        self,
+        attrs: Iterable[str] = (),
+        fsattrs: Iterable[str] = (),
+        initrd_available_kernel_modules: Iterable[str] = (),
+        initrd_kernel_modules: Iterable[str] = (),
+        kernel_modules: Iterable[str] = (),
+        module_packages: Iterable[str] = (),
+        firmware_packages: Iterable[str] = (),
+        kernel_params: Iterable[str] = (),
+        imports: Iterable[str] = (),
+    ) -> None:
+        self.attrs = OrderedSet(attrs)
+        self.fsattrs = OrderedSet(fsattrs)
+        self.initrd_available_kernel_modules = OrderedSet(initrd_available_kernel_modules)
+        self.initrd_kernel_modules = OrderedSet(initrd_kernel_modules)
+        self.kernel_modules = OrderedSet(kernel_modules)
+        self.module_packages = OrderedSet(module_packages)
+        self.firmware_packages = OrderedSet(firmware_packages)
+        self.kernel_params = OrderedSet(kernel_params)
+        self.imports = OrderedSet(imports)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, NixConfigAttrs):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={list(getattr(self, name))!r}" for name in self.__slots__)
+        return f"NixConfigAttrs({values})"
 
     def get_string(self, query: str) -> str:
-        """get a deduplicated string of values in a class list.
+        """get a string of values in a class list, they are deduplicated on insert.
         if list is empty then returns a empty string"""
         val = getattr(self, query)
         return_str: str = ""
-        if query in ["initrd_available_kernel_modules", "initrd_kernel_modules", "kernel_modules"]:
-            return_str = to_nix_string_list(*(uniq(val)))
+        if query in ["initrd_available_kernel_modules", "initrd_kernel_modules", "kernel_modules", "kernel_params"]:
+            return_str = to_nix_string_list(*val)
         elif query in ["module_packages", "firmware_packages"]:
-            return_str = to_nix_list(*(uniq(val)))
+            return_str = to_nix_list(*val)
         return return_str
+
+    def merge(self, other: "NixConfigAttrs") -> None:
+        """append the values of other after our own, values we already have keep their position"""
+        for name in self.__slots__:
+            getattr(self, name).extend(getattr(other, name))
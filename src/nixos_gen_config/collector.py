@@ -0,0 +1,205 @@
+# the program --remote runs on the target host. it is sent as source to the python3 of the target, so it may only
+# use the standard library and nothing of this package, and it sticks to what python 3.6 has (typing.Dict instead
+# of dict[...], no walrus). it reads every input of the detectors in one go and writes them to stdout as one
+# gzipped json document:
+#   files    host path -> content, for the files the request names or globs and that exist
+#   exists   the requested host paths that exist, some detectors only check for them
+#   devices  subsystem -> the wanted udev properties of every device, read from /sys and /run/udev/data
+#   links    host path -> target, the symlinks of the block device tree of /sys, whose files are in files
+#   virt     the output of systemd-detect-virt, empty when it isn't installed
+# for pci devices without a driver the modules.alias lines matching their MODALIAS are added to files, only for the
+# classes the request names, the same ones the local run looks up
+import fnmatch
+import glob
+import gzip
+import json
+import os
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional, Set
+
+# the lines of the first processor block are all CpuInfo reads
+FIRST_BLOCK_FILES = ("proc/cpuinfo",)
+
+
+def read_text(path: str, first_block: bool = False) -> Optional[str]:
+    try:
+        with open(path, encoding="utf-8", errors="replace") as file:
+            if not first_block:
+                return file.read()
+            lines: List[str] = []
+            for line in file:
+                if not line.strip() and lines:
+                    break
+                lines.append(line)
+            return "".join(lines)
+    except OSError:
+        return None
+
+
+def read_properties(path: str, wanted: Set[str], properties: Dict[str, str], prefix: str = "") -> None:
+    """add the wanted KEY=VALUE lines of a uevent file, or E:KEY=VALUE lines of a udev database entry"""
+    text = read_text(path)
+    if text is None:
+        return
+    for line in text.splitlines():
+        if not line.startswith(prefix):
+            continue
+        key, sep, value = line[len(prefix) :].partition("=")
+        if sep and key in wanted and key not in properties:
+            properties[key] = value
+
+
+def device_dirs(host_root: str, subsystem: str) -> List[str]:
+    # the union of both, deduped by the device they link to
+    result: List[str] = []
+    seen: Set[str] = set()
+    for base in ("sys/bus/%s/devices" % subsystem, "sys/class/%s" % subsystem):
+        directory = os.path.join(host_root, base)
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            continue
+        for name in names:
+            device_dir = os.path.join(directory, name)
+            syspath = os.path.realpath(device_dir)
+            if syspath not in seen:
+                seen.add(syspath)
+                result.append(device_dir)
+    return result
+
+
+def collect_devices(host_root: str, wanted: Dict[str, List[str]]) -> Dict[str, List[Dict[str, str]]]:
+    # the same walk as devices.SysfsSource
+    devices: Dict[str, List[Dict[str, str]]] = {}
+    for subsystem, subsystem_wanted in wanted.items():
+        wanted_set = set(subsystem_wanted)
+        devices[subsystem] = []
+        for device_dir in device_dirs(host_root, subsystem):
+            properties: Dict[str, str] = {}
+            read_properties(os.path.join(device_dir, "uevent"), wanted_set | {"MAJOR", "MINOR"}, properties)
+            if not wanted_set <= set(properties) | {"SUBSYSTEM"}:
+                if properties.get("MAJOR") and properties.get("MINOR"):
+                    kind = "b" if subsystem == "block" else "c"
+                    name = "%s%s:%s" % (kind, properties["MAJOR"], properties["MINOR"])
+                else:
+                    name = "+%s:%s" % (subsystem, os.path.basename(device_dir))
+                read_properties(os.path.join(host_root, "run/udev/data", name), wanted_set, properties, "E:")
+            if properties.get("DEVNAME") and not properties["DEVNAME"].startswith("/"):
+                properties["DEVNAME"] = "/dev/" + properties["DEVNAME"]
+            device = {key: value for key, value in properties.items() if key in wanted_set and value}
+            if device:
+                device["SUBSYSTEM"] = subsystem
+                devices[subsystem].append(device)
+    return devices
+
+
+def collect_block_tree(host_root: str, device_files: List[str], files: Dict[str, str]) -> Dict[str, str]:
+    """partitions.block_tree: the files of every block device are added to files, the symlinks returned"""
+    links: Dict[str, str] = {}
+    root = os.path.realpath(host_root)
+    for base in ("sys/class/block", "sys/dev/block"):
+        try:
+            names = sorted(os.listdir(os.path.join(host_root, base)))
+        except OSError:
+            continue
+        for name in names:
+            entry = os.path.join(host_root, base, name)
+            if os.path.islink(entry):
+                links[base + "/" + name] = os.readlink(entry)
+            if base != "sys/class/block":
+                continue
+            device_dir = os.path.realpath(entry)
+            relative = os.path.relpath(device_dir, root)
+            if relative.startswith(".."):
+                continue
+            for device_file in device_files:
+                content = read_text(os.path.join(device_dir, device_file))
+                if content is not None:
+                    files[relative + "/" + device_file] = content
+            slaves = os.path.join(device_dir, "slaves")
+            for slave in sorted(os.listdir(slaves)) if os.path.isdir(slaves) else []:
+                links[relative + "/slaves/" + slave] = os.readlink(os.path.join(slaves, slave))
+    return links
+
+
+def collect_modules_alias(host_root: str, templates: List[str], release: str, modaliases: List[str]) -> Dict[str, str]:
+    """the lines of modules.alias that match one of modaliases, under the path they were found at"""
+    for template in templates:
+        name = template.format(release=release)
+        text = read_text(os.path.join(host_root, name))
+        if text is None:
+            continue
+        lines: List[str] = []
+        for line in text.splitlines():
+            fields = line.split()
+            if len(fields) != 3 or fields[0] != "alias":
+                continue
+            pattern = fields[1]
+            # the text before the first wildcard is cheap to check before globbing
+            prefix = pattern
+            for wildcard in "*?[":
+                prefix = prefix.split(wildcard, 1)[0]
+            if any(modalias.startswith(prefix) and fnmatch.fnmatchcase(modalias, pattern) for modalias in modaliases):
+                lines.append(line + "\n")
+        return {name: "".join(lines)}
+    return {}
+
+
+def systemd_detect_virt() -> str:
+    try:
+        result = subprocess.run(["systemd-detect-virt"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return ""
+    # exits with 1 for none
+    return result.stdout.decode("utf-8", "replace").strip()
+
+
+def is_initrd_class(pci_class: Optional[str], request: Dict[str, Any]) -> bool:
+    # pci_ids.is_initrd_class on the PCI_CLASS string
+    try:
+        value = int(pci_class or "", 16)
+    except ValueError:
+        return False
+    return value >> 16 in request.get("initrd_pci_classes", []) or value >> 8 in request.get(
+        "initrd_pci_subclasses", []
+    )
+
+
+def collect(request: Dict[str, Any], host_root: str = "/") -> Dict[str, Any]:
+    files: Dict[str, str] = {}
+    for name in request.get("files", []):
+        content = read_text(os.path.join(host_root, name), name in FIRST_BLOCK_FILES)
+        if content is not None:
+            files[name] = content
+    root_pattern = glob.escape(host_root)
+    for pattern in request.get("globs", []):
+        for path in sorted(glob.glob(os.path.join(root_pattern, pattern))):
+            name = os.path.relpath(path, host_root)
+            content = read_text(path)
+            if content is not None and name not in files:
+                files[name] = content
+    links = collect_block_tree(host_root, request.get("block_files", []), files)
+    devices = collect_devices(host_root, request.get("devices", {}))
+    unbound = [
+        device["MODALIAS"]
+        for device in devices.get("pci", [])
+        if device.get("MODALIAS") and "DRIVER" not in device and is_initrd_class(device.get("PCI_CLASS"), request)
+    ]
+    if unbound:
+        release = files.get("proc/sys/kernel/osrelease", "").strip()
+        files.update(collect_modules_alias(host_root, request.get("modules_alias", []), release, unbound))
+    return {
+        "version": request.get("version"),
+        "files": files,
+        "exists": [name for name in request.get("exists", []) if os.path.exists(os.path.join(host_root, name))],
+        "devices": devices,
+        "links": links,
+        "virt": systemd_detect_virt() if request.get("virt", True) else "",
+    }
+
+
+def main(request: Dict[str, Any]) -> None:
+    payload = json.dumps(collect(request, request.get("host_root", "/")), separators=(",", ":"))
+    sys.stdout.buffer.write(gzip.compress(payload.encode("utf-8")))
+    sys.stdout.buffer.flush()
@@ -0,0 +1,133 @@
+# where the udev devices the detectors look at come from. pyudev goes through libudev, SysfsSource reads the
+# same information straight from /sys and the udev database in /run/udev/data
+import os
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator, Mapping, Optional
+
+if TYPE_CHECKING:
+    import pyudev
+
+# subsystem -> the properties the caller reads
+WantedProperties = Mapping[str, Iterable[str]]
+
+device_backends: list[str] = ["auto", "pyudev", "sysfs"]
+
+
+class DeviceSource(ABC):
+    @abstractmethod
+    def devices(self, wanted: WantedProperties) -> Iterable["pyudev.Device"]:
+        """every device of the subsystems in wanted. a device only has to answer .get() for its SUBSYSTEM and the
+        properties wanted for that subsystem"""
+
+
+class PyudevSource(DeviceSource):
+    def __init__(self, context: Optional["pyudev.Context"] = None) -> None:
+        self.context = context
+
+    def devices(self, wanted: WantedProperties) -> "pyudev.Enumerator":
+        import pyudev
+
+        # one enumerator over every subsystem
+        enumerator: pyudev.Enumerator = (self.context or pyudev.Context()).list_devices()
+        for subsystem in wanted:
+            enumerator = enumerator.match_subsystem(subsystem)
+        return enumerator
+
+
+def read_uevent(path: Path, wanted: frozenset[str], properties: dict[str, str]) -> None:
+    """add the wanted KEY=VALUE lines of a uevent file to properties"""
+    try:
+        with open(path, encoding="utf-8", errors="replace") as uevent:
+            for line in uevent:
+                key, sep, value = line.rstrip("\n").partition("=")
+                if sep and key in wanted:
+                    properties[key] = value
+    except OSError:
+        pass
+
+
+def read_udev_data(path: Path, wanted: frozenset[str], properties: dict[str, str]) -> None:
+    """add the wanted properties of a udev database entry, stored as E:KEY=VALUE lines"""
+    try:
+        with open(path, encoding="utf-8", errors="replace") as data:
+            for line in data:
+                if not line.startswith("E:"):
+                    continue
+                key, sep, value = line[2:].rstrip("\n").partition("=")
+                if sep and key in wanted and key not in properties:
+                    properties[key] = value
+    except OSError:
+        pass
+
+
+class SysfsSource(DeviceSource):
+    """devices read from host_root/sys and the udev database without libudev.
+    only the wanted properties are parsed, the udev database is only opened when the kernel uevent
+    doesn't have all of them"""
+
+    def __init__(self, host_root: Path = Path("/")) -> None:
+        self.host_root = host_root
+
+    def device_dirs(self, subsystem: str) -> list[Path]:
+        # like libudev both, a subsystem can have devices in each, e.g. input3 is on the bus, event3 only in the class.
+        # the entries are links to sys/devices, the same device is listed once
+        device_dirs: list[Path] = []
+        seen: set[Path] = set()
+        for base in (f"sys/bus/{subsystem}/devices", f"sys/class/{subsystem}"):
+            directory = self.host_root.joinpath(base)
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            for name in names:
+                device_dir = directory.joinpath(name)
+                syspath = device_dir.resolve()
+                if syspath not in seen:
+                    seen.add(syspath)
+                    device_dirs.append(device_dir)
+        return device_dirs
+
+    def udev_data_file(self, subsystem: str, device_dir: Path, properties: dict[str, str]) -> Path:
+        # devices with a device node are b<major>:<minor> or c<major>:<minor>, the others +<subsystem>:<sysname>
+        major, minor = properties.get("MAJOR"), properties.get("MINOR")
+        if major and minor:
+            kind = "b" if subsystem == "block" else "c"
+            name = f"{kind}{major}:{minor}"
+        else:
+            name = f"+{subsystem}:{device_dir.name}"
+        return self.host_root.joinpath("run/udev/data", name)
+
+    def devices(self, wanted: WantedProperties) -> Iterator[dict[str, str]]:
+        for subsystem, subsystem_wanted in wanted.items():
+            wanted_set = frozenset(subsystem_wanted)
+            # the udev database is found through the device number
+            uevent_keys = wanted_set | {"MAJOR", "MINOR"}
+            for device_dir in self.device_dirs(subsystem):
+                properties: dict[str, str] = {}
+                read_uevent(device_dir.joinpath("uevent"), uevent_keys, properties)
+                if not wanted_set <= properties.keys() | {"SUBSYSTEM"}:
+                    read_udev_data(self.udev_data_file(subsystem, device_dir, properties), wanted_set, properties)
+                if "DEVNAME" in properties and not properties["DEVNAME"].startswith("/"):
+                    # the kernel names the node relative to /dev, udev gives the full path
+                    properties["DEVNAME"] = f"/dev/{properties['DEVNAME']}"
+                device = {key: value for key, value in properties.items() if key in wanted_set}
+                device["SUBSYSTEM"] = subsystem
+                yield device
+
+
+def have_libudev() -> bool:
+    try:
+        import pyudev
+
+        pyudev.Context()
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def device_source(backend: str = "auto", host_root: Path = Path("/")) -> DeviceSource:
+    """the device source for --device-backend, auto picks pyudev when libudev can be loaded"""
+    if backend == "sysfs" or (backend == "auto" and not have_libudev()):
+        return SysfsSource(host_root)
+    return PyudevSource()
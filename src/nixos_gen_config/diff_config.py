@@ -0,0 +1,241 @@
+# --check and --diff: compare the detected configuration with the hardware-configuration.nix on disk.
+# the file is parsed back into NixConfigAttrs and compared option by option, so the result says which modules,
+# attrs and fileSystems entries changed instead of which lines
+import re
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from nixos_gen_config.classes import NixConfigAttrs
+
+# list option -> NixConfigAttrs field, in the order generate_hw_config writes them
+list_options: dict[str, str] = {
+    "imports": "imports",
+    "boot.initrd.availableKernelModules": "initrd_available_kernel_modules",
+    "boot.initrd.kernelModules": "initrd_kernel_modules",
+    "boot.kernelModules": "kernel_modules",
+    "boot.extraModulePackages": "module_packages",
+    "hardware.firmware": "firmware_packages",
+    "boot.kernelParams": "kernel_params",
+}
+# the fields rendered as lists of strings, the others are lists of expressions
+string_list_fields: frozenset[str] = frozenset(
+    {"initrd_available_kernel_modules", "initrd_kernel_modules", "kernel_modules", "kernel_params"}
+)
+# the end of the header of the generated file, { config, lib, pkgs, modulesPath, ... }: {
+body_start = re.compile(r"\}\s*:\s*\{")
+filesystem_option = re.compile(r'fileSystems\."(?P<mountpoint>(?:[^"\\]|\\.)*)"')
+openers, closers = "([{", ")]}"
+
+
+def indented_string_end(text: str, index: int) -> int:
+    """the index after the '' closing the ''...'' string starting at index"""
+    index += 2
+    while (index := text.find("''", index)) != -1:
+        # ''', ''$ and ''\ are escapes inside it
+        if text[index + 2 : index + 3] in ("'", "$", "\\"):
+            index += 3
+            continue
+        return index + 2
+    return len(text)
+
+
+def strip_comments(text: str) -> str:
+    """text without # comments, a # inside a string is kept"""
+    out: list[str] = []
+    in_string = False
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if in_string:
+            if char == "\\":
+                out.append(text[index : index + 2])
+                index += 2
+                continue
+            in_string = char != '"'
+        elif text.startswith("''", index):
+            end = indented_string_end(text, index)
+            out.append(text[index:end])
+            index = end
+            continue
+        elif char == '"':
+            in_string = True
+        elif char == "#":
+            index = text.find("\n", index)
+            if index == -1:
+                break
+            continue
+        out.append(char)
+        index += 1
+    return "".join(out)
+
+
+def split_nix(text: str, separator: str) -> Iterator[str]:
+    """split text at separator outside of strings and brackets, whitespace counts as any amount of it.
+    stops at a closing bracket without an opening one, like the } ending the body of the file"""
+    depth = 0
+    in_string = False
+    start = 0
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if in_string:
+            if char == "\\":
+                index += 1
+            elif char == '"':
+                in_string = False
+        elif text.startswith("''", index):
+            index = indented_string_end(text, index)
+            continue
+        elif char == '"':
+            in_string = True
+        elif char in openers:
+            depth += 1
+        elif char in closers:
+            depth -= 1
+            if depth < 0:
+                break
+        elif depth == 0 and (char == separator or (separator == " " and char.isspace())):
+            if part := text[start:index].strip():
+                yield part
+            start = index + 1
+        index += 1
+    if part := text[start:index].strip():
+        yield part
+
+
+def split_binding(statement: str) -> tuple[str, str]:
+    """name = value"""
+    name, _, value = statement.partition("=")
+    return " ".join(name.split()), " ".join(value.split())
+
+
+def attr_binding(attr: str) -> tuple[str, str]:
+    """name = value; of an attr"""
+    return split_binding(attr.rstrip().rstrip(";"))
+
+
+def list_items(value: str) -> list[str]:
+    value = value.strip()
+    if not (value.startswith("[") and value.endswith("]")):
+        return [value]
+    return list(split_nix(value[1:-1], " "))
+
+
+def unquote(item: str) -> str:
+    return item[1:-1] if len(item) >= 2 and item[0] == item[-1] == '"' else item
+
+
+def parse_hw_config(text: str) -> NixConfigAttrs:
+    """the NixConfigAttrs a generated hardware-configuration.nix was rendered from.
+    fileSystems entries are kept as their text, every other option that isn't one of the lists goes to attrs"""
+    nix_hw_config = NixConfigAttrs()
+    text = strip_comments(text)
+    match = body_start.search(text)
+    if match is None:
+        return nix_hw_config
+
+    for statement in split_nix(text[match.end() :], ";"):
+        name, value = split_binding(statement)
+        if field_name := list_options.get(name):
+            items = list_items(value)
+            if field_name in string_list_fields:
+                items = [unquote(item) for item in items]
+            getattr(nix_hw_config, field_name).extend(items)
+        elif filesystem_option.match(name):
+            nix_hw_config.fsattrs.append(f"{statement};")
+        else:
+            nix_hw_config.attrs.append(f"{name} = {value};")
+    return nix_hw_config
+
+
+def parse_filesystems(fsattrs: Iterable[str]) -> dict[str, dict[str, str]]:
+    """mountpoint -> option -> value of fileSystems entries, rendered or parsed"""
+    filesystems: dict[str, dict[str, str]] = {}
+    for fsattr in fsattrs:
+        for statement in split_nix(fsattr, ";"):
+            name, value = split_binding(statement)
+            if not (match := filesystem_option.fullmatch(name)):
+                continue
+            value = value.strip()
+            body = value[1:-1] if value.startswith("{") and value.endswith("}") else ""
+            filesystems[match["mountpoint"]] = dict(split_binding(option) for option in split_nix(body, ";"))
+    return filesystems
+
+
+def diff_lists(option: str, old: list[str], new: list[str]) -> Iterator[str]:
+    old_set, new_set = set(old), set(new)
+    added = [item for item in new if item not in old_set]
+    removed = [item for item in old if item not in new_set]
+    for item in added:
+        yield f"{option}: + {item}"
+    for item in removed:
+        yield f"{option}: - {item}"
+    if not added and not removed and old != new:
+        yield f"{option}: order changed"
+
+
+def diff_mappings(prefix: str, old: dict[str, str], new: dict[str, str]) -> Iterator[str]:
+    for name, value in new.items():
+        if name not in old:
+            yield f"{prefix}{name}: + {value}"
+        elif old[name] != value:
+            yield f"{prefix}{name}: {old[name]} -> {value}"
+    for name, value in old.items():
+        if name not in new:
+            yield f"{prefix}{name}: - {value}"
+
+
+def format_filesystem(options: dict[str, str]) -> str:
+    return "{ " + " ".join(f"{name} = {value};" for name, value in options.items()) + " }"
+
+
+def diff_hw_config(old: NixConfigAttrs, new: NixConfigAttrs) -> list[str]:
+    """the changes from old to new, one per line. empty when regenerating old gives new"""
+    changes: list[str] = []
+    for option, field_name in list_options.items():
+        changes.extend(diff_lists(option, list(getattr(old, field_name)), list(getattr(new, field_name))))
+
+    old_attrs, new_attrs = list(map(attr_binding, old.attrs)), list(map(attr_binding, new.attrs))
+    attr_changes = list(diff_mappings("", dict(old_attrs), dict(new_attrs)))
+    if not attr_changes and old_attrs != new_attrs:
+        attr_changes.append("attrs: order changed")
+    changes.extend(attr_changes)
+
+    old_filesystems = parse_filesystems(old.fsattrs)
+    new_filesystems = parse_filesystems(new.fsattrs)
+    for mountpoint, options in new_filesystems.items():
+        name = f'fileSystems."{mountpoint}"'
+        if mountpoint not in old_filesystems:
+            changes.append(f"{name}: + {format_filesystem(options)}")
+        else:
+            changes.extend(diff_mappings(f"{name}.", old_filesystems[mountpoint], options))
+    for mountpoint, options in old_filesystems.items():
+        if mountpoint not in new_filesystems:
+            changes.append(f'fileSystems."{mountpoint}": - {format_filesystem(options)}')
+    return changes
+
+
+def read_hw_config(config_file: Path) -> Optional[NixConfigAttrs]:
+    try:
+        return parse_hw_config(config_file.read_text("utf-8"))
+    except FileNotFoundError:
+        return None
+
+
+def check_hw_config(nix_hw_config: NixConfigAttrs, config_dir: Path, show_diff: bool) -> int:
+    """1 when regenerating hardware-configuration.nix in config_dir would change it, printing how with show_diff.
+    nothing is written"""
+    config_file = config_dir.joinpath("hardware-configuration.nix")
+    existing = read_hw_config(config_file)
+    changes = diff_hw_config(existing or NixConfigAttrs(), nix_hw_config)
+    if existing is not None and not changes:
+        print(f"{config_file} is up to date")
+        return 0
+
+    if existing is None:
+        print(f"{config_file} doesn't exist")
+    elif not show_diff:
+        print(f"{config_file} is out of date")
+    if show_diff:
+        print("\n".join(changes))
+    return 1
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Optional
+
+from nixos_gen_config.hardware import CpuInfo, MemoryTopology, cpufreq_globs
+from nixos_gen_config.partitions import iter_mountinfo
+from nixos_gen_config.virtualisation import detect_container, dmi_files, read_host_file
+from nixos_gen_config.write_config import write_config_file
+
+CACHE_VERSION = 1
+cache_file_name = ".hardware-configuration.cache.json"
+# the device globs whose modalias sets identify the attached hardware, relative to the host root
+modalias_globs: list[str] = ["sys/bus/pci/devices/*/modalias", "sys/bus/usb/devices/*/modalias"]
+
+
+def read_modaliases(host_root: Path, pattern: str) -> list[str]:
+    modaliases: list[str] = []
+    for path in host_root.glob(pattern):
+        try:
+            modaliases.append(path.read_text("utf-8", errors="replace").strip())
+        except OSError:
+            # the device went away while we were reading
+            continue
+    return sorted(modaliases)
+
+
+def list_dir(path: Path) -> list[str]:
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def package_stamp() -> list[str]:
+    """name, size and mtime of our own modules, a changed detector must not reuse an old result"""
+    package_dir = Path(__file__).parent
+    return [
+        f"{module.name}:{module.stat().st_size}:{module.stat().st_mtime_ns}"
+        for module in sorted(package_dir.glob("*.py"))
+    ]
+
+
+def fingerprint_parts(host_root: Path, root_dir: Path, no_filesystems: bool, options: str = "") -> Iterable[str]:
+    yield f"version={CACHE_VERSION} root={root_dir} no_filesystems={no_filesystems} {options}"
+    yield from package_stamp()
+    for pattern in modalias_globs:
+        yield pattern
+        yield from read_modaliases(host_root, pattern)
+
+    cpuinfo = CpuInfo.read(host_root.joinpath("proc/cpuinfo"))
+    yield f"cpu={cpuinfo.vendor_id}:{cpuinfo.get('model name')}:{' '.join(sorted(cpuinfo.flags))}"
+    # the driver and governors of every policy, e.g. a kernel update switching to amd-pstate
+    for pattern in cpufreq_globs:
+        for path in sorted(host_root.glob(pattern)):
+            name = path.relative_to(host_root).as_posix()
+            yield f"{name}={read_host_file(host_root, f'/{name}')}"
+    # free memory changes all the time, only the layout and the size in GiB count
+    memory = MemoryTopology.read(host_root)
+    yield f"memory={memory.summary()} default={memory.default_hugepage_kb} size={memory.memory_kb >> 20}"
+    for dmi_file in dmi_files:
+        yield f"{dmi_file}={read_host_file(host_root, f'/sys/class/dmi/id/{dmi_file}')}"
+    yield f"container={detect_container(host_root)}"
+    # devices without a driver are resolved through the modules.alias of the running kernel
+    yield f"kernel={read_host_file(host_root, '/proc/sys/kernel/osrelease')}"
+
+    mountinfo = host_root.joinpath("proc/self/mountinfo")
+    if not no_filesystems and mountinfo.exists():
+        # mount ids and the device numbers of virtual filesystems change every boot, they are left out
+        for part in iter_mountinfo(root_dir, mountinfo):
+            yield f"mount={part.device}:{part.mountpoint}:{part.fstype}"
+        # a reformatted partition keeps its mount but gets a new UUID
+        yield from list_dir(host_root.joinpath("dev/disk/by-uuid"))
+
+
+def hardware_fingerprint(root_dir: Path, no_filesystems: bool, host_root: Path = Path("/"), options: str = "") -> str:
+    """a hash of everything the detectors look at, cheap enough to compute before any of them runs"""
+    digest = hashlib.sha256()
+    for part in fingerprint_parts(host_root, root_dir, no_filesystems, options):
+        digest.update(part.encode("utf-8", errors="surrogateescape"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_cached_config(cache_file: Path, fingerprint: str) -> Optional[str]:
+    """the hardware configuration cached for fingerprint, None if there is none"""
+    try:
+        with open(cache_file, encoding="utf-8") as cache:
+            cached = json.load(cache)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("fingerprint") != fingerprint:
+        return None
+    config = cached.get("config")
+    return config if isinstance(config, str) else None
+
+
+def save_cached_config(cache_file: Path, fingerprint: str, config: str) -> None:
+    try:
+        write_config_file(cache_file, json.dumps({"fingerprint": fingerprint, "config": config}))
+    except OSError:
+        # without a cache the next run just does the detection again
+        pass
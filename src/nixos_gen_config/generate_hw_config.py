@@ -1,17 +1,17 @@
+import io
 from string import Template
+from typing import Iterator, TextIO
 
 from nixos_gen_config import auxiliary_functions
 from nixos_gen_config.classes import NixConfigAttrs
 
-uniq = auxiliary_functions.uniq
 to_nix_string_list = auxiliary_functions.to_nix_string_list
 to_nix_list = auxiliary_functions.to_nix_list
 to_nix_multi_line_list = auxiliary_functions.to_nix_multi_line_list
 to_nix_true_attr = auxiliary_functions.to_nix_true_attr
 to_nix_false_attr = auxiliary_functions.to_nix_false_attr
 
-hwConfigTemplate: Template = Template(
-    """\
+hwConfigTemplate: Template = Template("""\
 # Do not modify this file!  It was generated by ‘nixos-generate-config’
 # and may be overwritten by future invocations.  Please make changes
 # to /etc/nixos/configuration.nix instead.
@@ -24,25 +24,45 @@ hwConfigTemplate: Template = Template(
   boot.kernelModules = [${k_m} ];
   boot.extraModulePackages = [${m_p} ];
   hardware.firmware = [${f_p} ];
-\
-"""
-)
+${k_p}\
+""")
 
 
-def generate_hw_config(nix_hw_config: NixConfigAttrs) -> str:
-    hw_config_replaced = hwConfigTemplate.substitute(
+def iter_hw_config(nix_hw_config: NixConfigAttrs) -> Iterator[str]:
+    """the config as chunks of text, in order"""
+    # only written when set, most machines need none
+    kernel_params = ""
+    if nix_hw_config.kernel_params:
+        kernel_params = f"  boot.kernelParams = [{nix_hw_config.get_string('kernel_params')} ];\n"
+    yield hwConfigTemplate.substitute(
         imports=to_nix_multi_line_list("    ", *nix_hw_config.imports),
         i_a_k_m=nix_hw_config.get_string("initrd_available_kernel_modules"),
         i_k_m=nix_hw_config.get_string("initrd_kernel_modules"),
         k_m=nix_hw_config.get_string("kernel_modules"),
         m_p=nix_hw_config.get_string("module_packages"),
         f_p=nix_hw_config.get_string("firmware_packages"),
+        k_p=kernel_params,
     )
-    for attr in uniq(nix_hw_config.attrs):
-        hw_config_replaced = hw_config_replaced + "  " + attr + "\n"
+    for attr in nix_hw_config.attrs:
+        yield f"  {attr}\n"
+    yield from nix_hw_config.fsattrs
+
 
-    for fsattr in uniq(nix_hw_config.fsattrs):
-        hw_config_replaced = hw_config_replaced + fsattr
-    hw_config_replaced = hw_config_replaced.rstrip()
+def render_hw_config(nix_hw_config: NixConfigAttrs, sink: TextIO) -> None:
+    """write the config to sink one chunk at a time.
+    trailing whitespace is held back until more text follows, so the output ends without it"""
+    pending: str = ""
+    for chunk in iter_hw_config(nix_hw_config):
+        stripped = chunk.rstrip()
+        if stripped:
+            sink.write(pending)
+            sink.write(stripped)
+            pending = chunk[len(stripped) :]
+        else:
+            pending += chunk
 
-    return hw_config_replaced
+
+def generate_hw_config(nix_hw_config: NixConfigAttrs) -> str:
+    buffer = io.StringIO()
+    render_hw_config(nix_hw_config, buffer)
+    return buffer.getvalue()
@@ -1,44 +1,348 @@
-import subprocess
+import sys
+from dataclasses import dataclass, field
 from pathlib import Path
-
-import pyudev
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
 
 from nixos_gen_config import auxiliary_functions as af
-from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.classes import NixConfigAttrs, OrderedSet
+from nixos_gen_config.devices import DeviceSource, device_source
+from nixos_gen_config.modalias import default_cache_dir, load_alias_index
+from nixos_gen_config.pci_ids import broadcom_sta_ids, is_initrd_class, parse_pci_class, pci_device_modules
+from nixos_gen_config.timings import timings
+from nixos_gen_config.virtualisation import detect_virt, systemd_detect_virt
+
+if TYPE_CHECKING:
+    import pyudev
+
+
+@dataclass(frozen=True)
+class CpuInfo:
+    """parsed once snapshot of /proc/cpuinfo.
+    only the first processor block is read unless per_core is set, the fields we use are the same for every core"""
+
+    fields: dict[str, str] = field(default_factory=dict)
+    flags: frozenset[str] = frozenset()
+    processors: tuple[dict[str, str], ...] = ()
+
+    @classmethod
+    def parse(cls, lines: Iterable[str], per_core: bool = False) -> "CpuInfo":
+        processors: list[dict[str, str]] = []
+        block: dict[str, str] = {}
+        for line in lines:
+            key, sep, value = line.partition(":")
+            if not sep:
+                # an empty line ends a processor block
+                if block:
+                    processors.append(block)
+                    if not per_core:
+                        break
+                    block = {}
+                continue
+            block[key.strip()] = value.strip()
+        else:
+            if block:
+                processors.append(block)
+
+        fields: dict[str, str] = processors[0] if processors else {}
+        return cls(
+            fields=fields,
+            flags=frozenset(fields.get("flags", "").split()),
+            processors=tuple(processors) if per_core else (),
+        )
+
+    @classmethod
+    def read(cls, path: Path = Path("/proc/cpuinfo"), per_core: bool = False) -> "CpuInfo":
+        with open(path, encoding="utf-8") as cpuinfo:
+            return cls.parse(cpuinfo, per_core)
+
+    def get(self, key: str) -> str:
+        return self.fields.get(key, "")
+
+    @property
+    def vendor_id(self) -> str:
+        return self.get("vendor_id")
+
+
+cpufreq_dir = "sys/devices/system/cpu/cpufreq"
+# the files CpuFreq reads, relative to the host root. cpu0/cpufreq is the layout of kernels without policy dirs
+cpufreq_globs: list[str] = [
+    f"{policy_dir}/{name}"
+    for policy_dir in (f"{cpufreq_dir}/policy*", "sys/devices/system/cpu/cpu0/cpufreq")
+    for name in ("scaling_driver", "scaling_available_governors", "energy_performance_available_preferences")
+] + ["sys/devices/system/cpu/amd_pstate/status", "sys/devices/system/cpu/intel_pstate/status"]
+cpu_profiles: list[str] = ["auto", "throughput", "power"]
+# the drivers that scale the frequency on their own and only take the energy performance preference (EPP) as a hint
+epp_drivers: frozenset[str] = frozenset({"amd-pstate-epp", "intel_pstate"})
+# profile -> governor and EPP for those drivers. powersave is the one that lets them scale, not the minimum frequency
+epp_profiles: dict[str, tuple[str, str]] = {
+    "auto": ("powersave", ""),
+    "throughput": ("performance", "performance"),
+    "power": ("powersave", "balance_power"),
+}
+
+
+def read_words(path: Path) -> tuple[str, ...]:
+    try:
+        return tuple(path.read_text("utf-8").split())
+    except OSError:
+        return ()
+
+
+@dataclass(frozen=True)
+class CpuFreqPolicy:
+    """a cpufreq policy dir, the cpus sharing one frequency"""
+
+    driver: str = ""
+    governors: tuple[str, ...] = ()
+    epp_preferences: tuple[str, ...] = ()
+
+    @classmethod
+    def read(cls, policy_dir: Path) -> "CpuFreqPolicy":
+        driver = read_words(policy_dir.joinpath("scaling_driver"))
+        return cls(
+            driver=driver[0] if driver else "",
+            governors=read_words(policy_dir.joinpath("scaling_available_governors")),
+            epp_preferences=read_words(policy_dir.joinpath("energy_performance_available_preferences")),
+        )
+
 
+def policy_dirs(host_root: Path) -> list[Path]:
+    policies = [path for path in host_root.joinpath(cpufreq_dir).glob("policy*") if path.name[6:].isdigit()]
+    if policies:
+        return sorted(policies, key=lambda path: int(path.name[6:]))
+    cpu0 = host_root.joinpath("sys/devices/system/cpu/cpu0/cpufreq")
+    return [cpu0] if cpu0.is_dir() else []
 
-def cpu_info(field: str) -> str:
-    cpudata: dict[str, str] = {}
-    # list comprehension to remove empty lines which break split
-    cpuinfo: list[str] = [s for s in (Path("/proc/cpuinfo").read_text("utf-8")).splitlines() if s]
-    for line in cpuinfo:
-        left, right = line.split(":")
-        cpudata[left.strip()] = right.strip()
-    return cpudata[field]
 
+@dataclass(frozen=True)
+class CpuFreq:
+    """the cpufreq policies of every cpu and the mode of the pstate drivers"""
 
-def cpu_section(nix_hw_config: NixConfigAttrs) -> None:
-    if cpu_info("vendor_id") == "AuthenticAMD":
+    policies: tuple[CpuFreqPolicy, ...] = ()
+    # active, passive, guided or off, empty without the driver
+    amd_pstate: str = ""
+    intel_pstate: str = ""
+
+    @classmethod
+    def read(cls, host_root: Path = Path("/")) -> "CpuFreq":
+        amd_pstate = read_words(host_root.joinpath("sys/devices/system/cpu/amd_pstate/status"))
+        intel_pstate = read_words(host_root.joinpath("sys/devices/system/cpu/intel_pstate/status"))
+        return cls(
+            policies=tuple(CpuFreqPolicy.read(policy_dir) for policy_dir in policy_dirs(host_root)),
+            amd_pstate=amd_pstate[0] if amd_pstate else "",
+            intel_pstate=intel_pstate[0] if intel_pstate else "",
+        )
+
+    @property
+    def driver(self) -> str:
+        return self.policies[0].driver if self.policies else ""
+
+    def common(self, name: str) -> tuple[str, ...]:
+        """the values of name every policy has, a governor only some cpus offer can't be set for all of them"""
+        if not self.policies:
+            return ()
+        return tuple(
+            value
+            for value in getattr(self.policies[0], name)
+            if all(value in getattr(policy, name) for policy in self.policies[1:])
+        )
+
+
+def pstate_kernel_params(cpufreq: CpuFreq, cpuinfo: CpuInfo) -> list[str]:
+    """the kernel params switching a cpu that can take EPP hints to the pstate driver in its active mode"""
+    if not cpufreq.policies:
+        # no cpufreq at all, e.g. a vm
+        return []
+    if cpuinfo.vendor_id == "AuthenticAMD" and "cppc" in cpuinfo.flags and cpufreq.amd_pstate != "active":
+        # older kernels use acpi-cpufreq or amd_pstate in passive mode by default
+        return ["amd_pstate=active"]
+    if cpuinfo.vendor_id == "GenuineIntel" and "hwp" in cpuinfo.flags and cpufreq.intel_pstate == "passive":
+        return ["intel_pstate=active"]
+    return []
+
+
+def cpufreq_settings(cpufreq: CpuFreq, cpuinfo: CpuInfo, profile: str = "auto") -> tuple[list[str], str, str]:
+    """kernel params, governor and EPP for profile, empty when there is nothing to set.
+    auto leaves the driver alone and picks a governor that scales, throughput and power also switch to the pstate
+    drivers and set their EPP"""
+    kernel_params = pstate_kernel_params(cpufreq, cpuinfo) if profile != "auto" else []
+    governors = cpufreq.common("governors")
+    if kernel_params or (cpufreq.driver in epp_drivers and cpufreq.common("epp_preferences")):
+        governor, epp = epp_profiles[profile]
+        # after the switch the preferences of the current driver don't matter
+        if not kernel_params and epp not in cpufreq.common("epp_preferences"):
+            epp = ""
+        return kernel_params, governor if kernel_params or governor in governors else "", epp
+
+    if profile == "throughput":
+        desired_governors = ["performance", "schedutil", "ondemand"]
+    elif cpufreq.driver:
+        desired_governors = ["schedutil", "ondemand", "powersave"]
+    else:
+        # without scaling_driver only the governors are known, pick like we always did
+        desired_governors = ["ondemand", "powersave"]
+    return [], next((governor for governor in desired_governors if governor in governors), ""), ""
+
+
+def cpu_section(
+    nix_hw_config: NixConfigAttrs,
+    cpuinfo: Optional[CpuInfo] = None,
+    host_root: Path = Path("/"),
+    profile: str = "auto",
+) -> None:
+    if cpuinfo is None:
+        cpuinfo = CpuInfo.read(host_root.joinpath("proc/cpuinfo"))
+
+    if cpuinfo.vendor_id == "AuthenticAMD":
         nix_hw_config.attrs.append(
             "hardware.cpu.amd.updateMicrocode = lib.mkDefault config.hardware.enableRedistributableFirmware;"
         )
-    elif cpu_info("vendor_id") == "GenuineIntel":
+    elif cpuinfo.vendor_id == "GenuineIntel":
         nix_hw_config.attrs.append(
             "hardware.cpu.intel.updateMicrocode = lib.mkDefault config.hardware.enableRedistributableFirmware;"
         )
 
-    if "svm" in cpu_info("flags"):
+    if "svm" in cpuinfo.flags:
         nix_hw_config.kernel_modules.append("kvm-amd")
-    if "vmx" in cpu_info("flags"):
+    if "vmx" in cpuinfo.flags:
         nix_hw_config.kernel_modules.append("kvm-intel")
 
-    if Path("/sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors").exists():
-        governors = Path("/sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors").read_text("utf-8")
-        desired_governors = ["ondemand", "powersave"]
-        for d_g in desired_governors:
-            if d_g in governors:
-                nix_hw_config.attrs.append(f'powerManagement.cpuFreqGovernor = lib.mkDefault "{d_g}";')
-                break
+    kernel_params, governor, epp = cpufreq_settings(CpuFreq.read(host_root), cpuinfo, profile)
+    nix_hw_config.kernel_params.extend(kernel_params)
+    if governor:
+        nix_hw_config.attrs.append(f'powerManagement.cpuFreqGovernor = lib.mkDefault "{governor}";')
+    if epp:
+        # nixos has no option for it, tmpfiles writes it to every policy at boot
+        epp_file = f"/{cpufreq_dir}/policy*/energy_performance_preference"
+        nix_hw_config.attrs.append(f'systemd.tmpfiles.rules = [ "w {epp_file} - - - - {epp}" ];')
+
+
+node_dir = "sys/devices/system/node"
+hugepages_dir = "sys/kernel/mm/hugepages"
+# the files MemoryTopology reads, relative to the host root
+memory_globs: list[str] = [
+    f"{node_dir}/node*/cpulist",
+    f"{node_dir}/node*/meminfo",
+    f"{hugepages_dir}/hugepages-*/nr_hugepages",
+    "proc/meminfo",
+]
+# machines with at least this much memory default to 1G huge pages, 2M ones cost too many tlb entries there
+large_memory_kb = 64 * 1024 * 1024
+
+
+def cpulist_count(cpulist: str) -> int:
+    """the number of cpus in a cpulist like 0-15,32-47"""
+    count = 0
+    for cpu_range in filter(None, cpulist.split(",")):
+        first, _, last = cpu_range.partition("-")
+        count += int(last or first) - int(first) + 1
+    return count
+
+
+def page_size(size_kb: int) -> str:
+    """1048576 -> 1G, the way hugepagesz= takes it"""
+    for unit, unit_kb in (("G", 1024 * 1024), ("M", 1024)):
+        if size_kb % unit_kb == 0:
+            return f"{size_kb // unit_kb}{unit}"
+    return f"{size_kb}K"
+
+
+def meminfo_values(path: Path, keys: Iterable[str]) -> dict[str, int]:
+    """the kB values of keys in a meminfo file, it is only read up to the last of them"""
+    wanted = set(keys)
+    values: dict[str, int] = {}
+    try:
+        with open(path, encoding="utf-8") as meminfo:
+            for line in meminfo:
+                # MemTotal:  65799412 kB, or Node 0 MemTotal:  32899706 kB in the files of the nodes
+                key, sep, value = line.partition(":")
+                key = key.rpartition(" ")[2]
+                if sep and key in wanted:
+                    values[key] = int(value.split()[0])
+                    if len(values) == len(wanted):
+                        break
+    except (OSError, ValueError, IndexError):
+        pass
+    return values
+
+
+@dataclass(frozen=True)
+class NumaNode:
+    node: int
+    cpulist: str
+    memory_kb: int
+
+    @property
+    def cpu_count(self) -> int:
+        return cpulist_count(self.cpulist)
+
+
+@dataclass(frozen=True)
+class MemoryTopology:
+    """the numa nodes and huge page sizes of the host"""
+
+    nodes: tuple[NumaNode, ...] = ()
+    hugepage_sizes_kb: tuple[int, ...] = ()
+    default_hugepage_kb: int = 0
+    memory_kb: int = 0
+
+    @classmethod
+    def read(cls, host_root: Path = Path("/")) -> "MemoryTopology":
+        nodes: list[NumaNode] = []
+        for path in host_root.joinpath(node_dir).glob("node*"):
+            if path.name[4:].isdigit():
+                nodes.append(
+                    NumaNode(
+                        node=int(path.name[4:]),
+                        cpulist="".join(read_words(path.joinpath("cpulist"))),
+                        memory_kb=meminfo_values(path.joinpath("meminfo"), ["MemTotal"]).get("MemTotal", 0),
+                    )
+                )
+        sizes = [
+            int(path.name[len("hugepages-") : -len("kB")])
+            for path in host_root.joinpath(hugepages_dir).glob("hugepages-*kB")
+            if path.name[len("hugepages-") : -len("kB")].isdigit()
+        ]
+        meminfo = meminfo_values(host_root.joinpath("proc/meminfo"), ["MemTotal", "Hugepagesize"])
+        return cls(
+            nodes=tuple(sorted(nodes, key=lambda node: node.node)),
+            hugepage_sizes_kb=tuple(sorted(sizes)),
+            default_hugepage_kb=meminfo.get("Hugepagesize", 0),
+            memory_kb=meminfo.get("MemTotal", 0),
+        )
+
+    def summary(self) -> str:
+        nodes = "; ".join(f"node{node.node}: cpus {node.cpulist or '-'}" for node in self.nodes)
+        sizes = " ".join(page_size(size) for size in self.hugepage_sizes_kb) or "none"
+        return f"{len(self.nodes)} numa nodes ({nodes}), huge page sizes {sizes}"
+
+
+def memory_section(
+    nix_hw_config: NixConfigAttrs,
+    host_root: Path = Path("/"),
+    topology: Optional[MemoryTopology] = None,
+    label: Optional[str] = None,
+) -> None:
+    """opt in, the settings for the memory topology: spreading interrupts and balancing memory over the numa
+    nodes, and 1G huge pages by default on large machines. with label the topology is reported on stderr,
+    after the label when it isn't empty, e.g. the host of --batch and --remote"""
+    if topology is None:
+        topology = MemoryTopology.read(host_root)
+    if label is not None:
+        prefix = f"{label}: " if label else ""
+        print(f"{prefix}Memory: {topology.summary()}", file=sys.stderr, flush=True)
+
+    if len(topology.nodes) > 1:
+        nix_hw_config.attrs.append("services.irqbalance.enable = lib.mkDefault true;")
+        nix_hw_config.attrs.append('boot.kernel.sysctl."kernel.numa_balancing" = lib.mkDefault 1;')
+
+    gigantic_kb = 1024 * 1024
+    if (
+        gigantic_kb in topology.hugepage_sizes_kb
+        and topology.default_hugepage_kb != gigantic_kb
+        and topology.memory_kb >= large_memory_kb
+    ):
+        nix_hw_config.kernel_params.append(f"default_hugepagesz={page_size(gigantic_kb)}")
 
 
 # TODO
@@ -48,110 +352,166 @@ def gpu_section(nix_hw_config: NixConfigAttrs) -> None:
         nix_hw_config.attrs.append(f'services.xserver.videoDrivers = [ "{video_driver}" ]')
 
 
-def usb_keyboard(nix_hw_config: NixConfigAttrs, device: pyudev.Device) -> None:
+UdevRuleFunc = Callable[[NixConfigAttrs, "pyudev.Device"], None]
+
+
+@dataclass(frozen=True)
+class UdevRule:
+    func: UdevRuleFunc
+    # the udev properties the rule reads, it only sees devices that have at least one of them set
+    properties: frozenset[str] = frozenset()
+
+    def matches(self, device: "pyudev.Device") -> bool:
+        return any(device.get(prop) for prop in self.properties)
+
+
+# subsystem -> rules, the subsystem order is the order in which their results end up in the config
+udev_rules: dict[str, list[UdevRule]] = {"pci": [], "block": [], "input": []}
+
+
+def udev_rule_properties(subsystem: str) -> set[str]:
+    """every udev property the rules of subsystem read"""
+    return {prop for rule in udev_rules.get(subsystem, []) for prop in rule.properties}
+
+
+def udev_rule(*subsystems: str, properties: Iterable[str] = ()) -> Callable[[UdevRuleFunc], UdevRuleFunc]:
+    """register a detector to be called for every udev device in subsystems"""
+
+    def register(func: UdevRuleFunc) -> UdevRuleFunc:
+        for subsystem in subsystems:
+            udev_rules.setdefault(subsystem, []).append(UdevRule(func, frozenset(properties)))
+        return func
+
+    return register
+
+
+@udev_rule("input", properties=["ID_INPUT_KEYBOARD", "ID_USB_DRIVER"])
+def usb_keyboard(nix_hw_config: NixConfigAttrs, device: "pyudev.Device") -> None:
     usb_driver: str
     if device.get("ID_INPUT_KEYBOARD") and (usb_driver := device.get("ID_USB_DRIVER")):
         nix_hw_config.initrd_available_kernel_modules.append(usb_driver)
 
 
-def pci(nix_hw_config: NixConfigAttrs, device: pyudev.Device) -> None:
-    pci_class: str = device.get("ID_PCI_CLASS_FROM_DATABASE")
-    pci_id: str = device.get("ID_PCI_SUBCLASS_FROM_DATABASE")
+driver_overrides: dict[str, str] = {
+    # xhci_pci has xhci_hcd in deps. xhci_pci will be needed anyways so this keeps the list shorter.
+    "xhci_hcd": "xhci_pci",
+}
+
+
+# the id tables are in pci_ids.py, every rule is a set or dict lookup on the PCI_ID and PCI_CLASS of the device
+@udev_rule("pci", properties=["PCI_CLASS", "PCI_ID", "DRIVER"])
+def pci(nix_hw_config: NixConfigAttrs, device: "pyudev.Device") -> None:
+    pci_class: Optional[int] = parse_pci_class(device.get("PCI_CLASS"))
     pci_driver: str = device.get("DRIVER")
-    # https://github.com/systemd/systemd/blob/main/hwdb.d/20-pci-classes.hwdb
-    class_filter: list[str] = [
-        "USB controller",
-        "FireWire (IEEE 1394)",
-        "Mass storage controller",
-    ]
-    model_dict: dict[str, str] = {
-        # for some of these the device loads something that has a driver different
-        # to itself
-        "Virtio SCSI": "virtio_scsi",
-    }
-    driver_overrides: dict[str, str] = {
-        # xhci_pci has xhci_hcd in deps. xhci_pci will be needed anyways so this keeps the list shorter.
-        "xhci_hcd": "xhci_pci",
-    }
-    if (pci_id or pci_class) and pci_driver:
-        if any(filter in (pci_class, pci_id) for filter in class_filter):
-            if pci_driver in list(driver_overrides):
-                pci_driver = driver_overrides[pci_driver]
-            nix_hw_config.initrd_available_kernel_modules.append(pci_driver)
-
-    model_id: str
-    if model_id := device.get("ID_MODEL_FROM_DATABASE"):
-        if any(filter in model_id for filter in model_dict):
-            nix_hw_config.initrd_available_kernel_modules.append(model_dict[model_id])
-
-
-def wifi(nix_hw_config: NixConfigAttrs, device: pyudev.Device) -> None:
-    broadcom_sta_list: list[str] = [
-        "BCM4311",  # https://linux-hardware.org/?id=pci:14e4-4311
-        "BCM4360",  # https://linux-hardware.org/?id=pci:14e4-43a0
-        "BCM4322",  # https://linux-hardware.org/?id=pci:14e4-432b
-        "BCM4313",  # https://linux-hardware.org/?id=pci:14e4-4727
-        "BCM4312",  # https://linux-hardware.org/?id=pci:14e4-4315
-        "BCM4321",  # https://linux-hardware.org/?id=pci:14e4-4328
-        "BCM43142",  # https://linux-hardware.org/?id=pci:14e4-4365
-        "BCM43224",  # https://linux-hardware.org/?id=pci:14e4-4353
-        "BCM43225",  # https://linux-hardware.org/?id=pci:14e4-4357
-        "BCM43227",  # https://linux-hardware.org/?id=pci:14e4-4358
-        "BCM43228",  # https://linux-hardware.org/?id=pci:14e4-4359
-        "BCM4331",  # https://linux-hardware.org/?id=pci:14e4-4331
-        "BCM4352",  # https://linux-hardware.org/?id=pci:14e4-43b1
-        # more devices probably belong here. however it is really tedious to go through them
-        # https://linux-hardware.org/?view=search&vendor=Broadcom&typeid=net%2Fwireless#list
-        # https://github.com/systemd/systemd/blob/main/hwdb.d/20-pci-vendor-model.hwdb
-        # https://linux-hardware.org/?view=search
-    ]
-    model_id: str
-    if model_id := device.get("ID_MODEL_FROM_DATABASE"):
-        if any(filter in model_id for filter in broadcom_sta_list):
-            nix_hw_config.module_packages.append("config.boot.kernelPackages.broadcom_sta")
-            nix_hw_config.kernel_modules.append("wl")
+    if pci_class is not None and pci_driver and is_initrd_class(pci_class):
+        nix_hw_config.initrd_available_kernel_modules.append(driver_overrides.get(pci_driver, pci_driver))
+
+    module: Optional[str]
+    if module := pci_device_modules.get(device.get("PCI_ID")):
+        nix_hw_config.initrd_available_kernel_modules.append(module)
+
+
+def unbound_modalias(device: "pyudev.Device") -> Optional[str]:
+    """the MODALIAS of a pci device the initrd would need if its driver were loaded, the pci rule only sees
+    devices that have one bound"""
+    if device.get("DRIVER"):
+        return None
+    pci_class: Optional[int] = parse_pci_class(device.get("PCI_CLASS"))
+    if pci_class is None or not is_initrd_class(pci_class):
+        return None
+    modalias: Optional[str] = device.get("MODALIAS")
+    return modalias or None
+
+
+@udev_rule("pci", properties=["PCI_ID"])
+def wifi(nix_hw_config: NixConfigAttrs, device: "pyudev.Device") -> None:
+    if device.get("PCI_ID") in broadcom_sta_ids:
+        nix_hw_config.module_packages.append("config.boot.kernelPackages.broadcom_sta")
+        nix_hw_config.kernel_modules.append("wl")
 
     # NOTE for reviewers: Intel3945ABG and Intel2200BG are included in enableRedistributableFirmware
     # devices that use brcmfmac are not needed to be specified due to the drivers being
     # included in firmwareLinuxNonfree
 
 
-def bcache(nix_hw_config: NixConfigAttrs, device: pyudev.Device) -> None:
+@udev_rule("block", properties=["ID_FS_TYPE"])
+def bcache(nix_hw_config: NixConfigAttrs, device: "pyudev.Device") -> None:
     if device.get("ID_FS_TYPE") == "bcache":
         nix_hw_config.initrd_available_kernel_modules.append("bcache")
 
 
-def udev_section(nix_hw_config: NixConfigAttrs) -> None:
-    context: pyudev.Context = pyudev.Context()
+def udev_properties(subsystem: str) -> set[str]:
+    """every udev property udev_section reads from the devices of subsystem"""
+    properties = udev_rule_properties(subsystem) | {"SUBSYSTEM"}
+    if subsystem == "pci":
+        # for devices without a driver
+        properties.update(["MODALIAS", "DRIVER", "PCI_CLASS"])
+    return properties
+
+
+def udev_section(
+    nix_hw_config: NixConfigAttrs,
+    devices: Optional[Iterable["pyudev.Device"]] = None,
+    host_root: Path = Path("/"),
+    source: Optional[DeviceSource] = None,
+    initrd_modules: bool = True,
+    subsystems: Optional[Iterable[str]] = None,
+) -> None:
+    """run the udev rules over every device. without initrd_modules the initrd modules they find are dropped,
+    initrd_section picks them instead. with subsystems only the devices of those are walked, --watch reruns
+    the rules of one subsystem at a time"""
+    wanted = None if subsystems is None else frozenset(subsystems)
+    walked = [subsystem for subsystem in udev_rules if wanted is None or subsystem in wanted]
+    if devices is None:
+        # a single walk over every subsystem that has registered rules
+        devices = (source or device_source()).devices({subsystem: udev_properties(subsystem) for subsystem in walked})
+
+    # libudev returns the subsystems interleaved, collect each into its own fragment
+    # so the output keeps the udev_rules order
+    fragments: dict[str, NixConfigAttrs] = {subsystem: NixConfigAttrs() for subsystem in walked}
+    enumerated: dict[str, int] = {}
+    unbound: list[str] = []
     device: pyudev.Device
-    for device in context.list_devices(subsystem="pci"):
-        wifi(nix_hw_config, device)
-        pci(nix_hw_config, device)
+    for device in devices:
+        subsystem: str = device.get("SUBSYSTEM")
+        if subsystem not in fragments:
+            continue
+        enumerated[subsystem] = enumerated.get(subsystem, 0) + 1
+        for rule in udev_rules.get(subsystem, []):
+            if rule.matches(device):
+                rule.func(fragments[subsystem], device)
+        if subsystem == "pci" and (modalias := unbound_modalias(device)):
+            unbound.append(modalias)
 
-    for device in context.list_devices(subsystem="block"):
-        bcache(nix_hw_config, device)
+    # modules.alias is only read when a device is missing its driver, which is rare outside of installers
+    if unbound and initrd_modules:
+        alias_index = load_alias_index(host_root, default_cache_dir() if host_root == Path("/") else None)
+        if alias_index is not None:
+            # unbound is only filled when pci is walked
+            for modalias in unbound:
+                fragments["pci"].initrd_available_kernel_modules.extend(alias_index.modules(modalias))
 
-    for device in context.list_devices(subsystem="input"):
-        usb_keyboard(nix_hw_config, device)
+    for fragment in fragments.values():
+        if not initrd_modules:
+            fragment.initrd_available_kernel_modules = OrderedSet()
+        nix_hw_config.merge(fragment)
+    for subsystem, count in enumerated.items():
+        timings.count(f"udev devices {subsystem}", count)
 
 
-def virt_section(nix_hw_config: NixConfigAttrs) -> None:
-    virtcmd = None
-    # systemd-detect-virt exits with 1 when virt = none
-    try:
-        virtcmd = subprocess.run(["systemd-detect-virt"], check=True, capture_output=True, text=True)
-    except subprocess.CalledProcessError:
+def virt_section(nix_hw_config: NixConfigAttrs, virt: Optional[str] = None, cpuinfo: Optional[CpuInfo] = None) -> None:
+    if virt is None:
+        virt = detect_virt(cpuinfo or CpuInfo.read()) or systemd_detect_virt()
+
+    if virt == "none":
         # Provide firmware for devices that are not detected by this script,
         # unless we're in a VM/container.
         nix_hw_config.imports.append('(modulesPath + "/installer/scan/not-detected.nix")')
-
-    if virtcmd:
-        virt: str = (virtcmd.stdout).strip()
-        if virt == "oracle":
-            nix_hw_config.attrs.append(af.to_nix_true_attr("virtualisation.virtualbox.guest.enable"))
-        if virt == "microsoft":
-            nix_hw_config.attrs.append(af.to_nix_true_attr("virtualisation.hypervGuest.enable"))
-        if virt == "systemd-nspawn":
-            nix_hw_config.attrs.append(af.to_nix_true_attr("boot.isContainer"))
-        if virt in ("qemu", "kvm", "bochs"):
-            nix_hw_config.imports.append('(modulesPath + "/profiles/qemu-quest.nix")')
+    if virt == "oracle":
+        nix_hw_config.attrs.append(af.to_nix_true_attr("virtualisation.virtualbox.guest.enable"))
+    if virt == "microsoft":
+        nix_hw_config.attrs.append(af.to_nix_true_attr("virtualisation.hypervGuest.enable"))
+    if virt == "systemd-nspawn":
+        nix_hw_config.attrs.append(af.to_nix_true_attr("boot.isContainer"))
+    if virt in ("qemu", "kvm", "bochs"):
+        nix_hw_config.imports.append('(modulesPath + "/profiles/qemu-quest.nix")')
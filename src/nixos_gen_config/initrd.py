@@ -0,0 +1,141 @@
+# --minimal-initrd: only the modules the initrd needs to reach the /, /nix, /boot and /var filesystems and to read
+# the console keyboard, instead of the driver of every storage and usb controller udev_section sees.
+# the devices are found by walking /sys from the block devices of those mounts and from the keyboards up to the
+# root of the device tree, every driver on the way is needed. modules.dep then drops the modules that another
+# needed module already pulls in, the initrd loads dependencies on its own
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.modalias import find_modules_file, kernel_release
+from nixos_gen_config.partitions import Partition, block_device_dir, boot_mounts, list_partitions
+
+module_suffixes: tuple[str, ...] = (".ko", ".ko.xz", ".ko.zst", ".ko.gz")
+
+
+def module_name(path: str) -> str:
+    """kernel/drivers/nvme/host/nvme-core.ko.xz -> nvme_core, the name modprobe and lsmod use"""
+    name = path.rpartition("/")[2]
+    for suffix in module_suffixes:
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+    return name.replace("-", "_")
+
+
+class ModuleDeps:
+    """modules.dep as module -> the modules it needs directly"""
+
+    def __init__(self, deps: Optional[dict[str, list[str]]] = None) -> None:
+        self.deps: dict[str, list[str]] = deps or {}
+        self._closures: dict[str, frozenset[str]] = {}
+
+    @classmethod
+    def parse(cls, lines: Iterable[str]) -> "ModuleDeps":
+        # kernel/drivers/nvme/host/nvme.ko.xz: kernel/drivers/nvme/host/nvme-core.ko.xz
+        deps: dict[str, list[str]] = {}
+        for line in lines:
+            module, sep, needs = line.partition(":")
+            if sep:
+                deps[module_name(module)] = [module_name(need) for need in needs.split()]
+        return cls(deps)
+
+    def closure(self, module: str) -> frozenset[str]:
+        """every module loading module loads, without itself"""
+        if (cached := self._closures.get(module)) is not None:
+            return cached
+        seen: set[str] = set()
+        stack = list(self.deps.get(module, []))
+        while stack:
+            need = stack.pop()
+            if need not in seen:
+                seen.add(need)
+                stack.extend(self.deps.get(need, []))
+        seen.discard(module)
+        closure = self._closures[module] = frozenset(seen)
+        return closure
+
+    def minimal_cover(self, modules: Iterable[str]) -> list[str]:
+        """the modules that aren't loaded as a dependency of another one of modules anyway, in order"""
+        wanted = list(dict.fromkeys(modules))
+        pulled_in: set[str] = set()
+        for module in wanted:
+            pulled_in |= self.closure(module)
+        return [module for module in wanted if module not in pulled_in]
+
+
+def load_module_deps(host_root: Path = Path("/")) -> ModuleDeps:
+    """modules.dep of the running kernel, empty without one"""
+    dep_file = find_modules_file(host_root, kernel_release(host_root), "modules.dep")
+    if dep_file is None:
+        return ModuleDeps()
+    with open(dep_file, encoding="utf-8", errors="replace") as deps:
+        return ModuleDeps.parse(deps)
+
+
+def device_modules(host_root: Path, device_dir: Path) -> Iterator[str]:
+    """the modules of the drivers bound to device_dir and its parents, from the root of the device tree down.
+    drivers built into the kernel have no module and are left out"""
+    devices_root = host_root.joinpath("sys/devices").resolve()
+    modules: list[str] = []
+    current = device_dir.resolve()
+    while current != devices_root and devices_root in current.parents:
+        module_link = current.joinpath("driver/module")
+        if module_link.exists():
+            modules.append(module_link.resolve().name)
+        current = current.parent
+    return reversed(modules)
+
+
+def block_stack_dirs(block_dir: Path) -> Iterator[Path]:
+    """block_dir and the devices below it: the partitions, disks and members of device mapper and md devices"""
+    yield block_dir
+    slaves = block_dir.joinpath("slaves")
+    if slaves.is_dir():
+        for slave in sorted(slaves.iterdir()):
+            yield from block_stack_dirs(slave)
+
+
+def is_keyboard(input_dir: Path) -> bool:
+    # like udev's input_id: a keyboard has the first 32 keys, KEY_ESC to KEY_D, except KEY_RESERVED
+    try:
+        words = input_dir.joinpath("capabilities/key").read_text("utf-8").split()
+    except OSError:
+        return False
+    return bool(words) and int(words[-1], 16) & 0xFFFFFFFE == 0xFFFFFFFE
+
+
+def keyboard_dirs(host_root: Path) -> Iterator[Path]:
+    input_class = host_root.joinpath("sys/class/input")
+    if input_class.is_dir():
+        for input_dir in sorted(input_class.glob("input*")):
+            if is_keyboard(input_dir):
+                yield input_dir
+
+
+def boot_device_dirs(host_root: Path, root_dir: Path, partitions: Iterable[Partition]) -> Iterator[Path]:
+    mountpoints = boot_mounts(root_dir)
+    for part in partitions:
+        if part.mountpoint in mountpoints and (block_dir := block_device_dir(host_root, part)) is not None:
+            yield from block_stack_dirs(block_dir)
+    yield from keyboard_dirs(host_root)
+
+
+def initrd_modules(host_root: Path, root_dir: Path, partitions: Iterable[Partition]) -> list[str]:
+    modules = [
+        module
+        for device_dir in boot_device_dirs(host_root, root_dir, partitions)
+        for module in device_modules(host_root, device_dir)
+    ]
+    return load_module_deps(host_root).minimal_cover(modules)
+
+
+def initrd_section(
+    nix_hw_config: NixConfigAttrs,
+    root_dir: Path,
+    partitions: Optional[Iterable[Partition]] = None,
+    host_root: Path = Path("/"),
+) -> None:
+    if partitions is None:
+        partitions = list_partitions(root_dir)
+    nix_hw_config.initrd_available_kernel_modules.extend(initrd_modules(host_root, root_dir, partitions))
@@ -1,23 +1,91 @@
+import argparse
+import sys
 from pathlib import Path
-
-from icecream import ic
+from typing import Optional
 
 from nixos_gen_config import auxiliary_functions as af
 from nixos_gen_config.arguments import process_args
 from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.devices import device_source
+from nixos_gen_config.fingerprint import cache_file_name, hardware_fingerprint, load_cached_config, save_cached_config
 from nixos_gen_config.generate_hw_config import generate_hw_config
-from nixos_gen_config.hardware import cpu_section, udev_section, virt_section
-from nixos_gen_config.partitions import get_fs
-from nixos_gen_config.write_config import write_hw_config, write_nixos_config
+from nixos_gen_config.sections import Section, live_sections, run_sections
+from nixos_gen_config.timings import timings
+from nixos_gen_config.write_config import create_config_dir, write_hw_config, write_nixos_config
 
 
-def main() -> None:
-    nix_hw_config = NixConfigAttrs()
-    nix_nixos_config = NixConfigAttrs()
+def render(nix_hw_config: NixConfigAttrs) -> str:
+    with timings.timer("render"):
+        return generate_hw_config(nix_hw_config)
 
-    args = process_args()
-    if not args.debug:
-        ic.disable()
+
+def report_timings(output_format: str, timings_file: Optional[Path]) -> None:
+    report = timings.report(output_format)
+    if timings_file:
+        timings_file.write_text(report + "\n", "utf-8")
+    else:
+        print(report, file=sys.stderr)
+
+
+def sections_of(args: argparse.Namespace, root_dir: Path) -> list[Section]:
+    return live_sections(
+        root_dir,
+        args.no_filesystems,
+        device_source(args.device_backend),
+        args.minimal_initrd,
+        args.cpu_profile,
+        args.memory_tuning,
+    )
+
+
+def output_options(args: argparse.Namespace) -> str:
+    """the options besides --root and --no-filesystems that change the output, part of the cache key"""
+    return f"minimal_initrd={args.minimal_initrd} cpu_profile={args.cpu_profile} memory_tuning={args.memory_tuning}"
+
+
+def detect_attrs(args: argparse.Namespace, root_dir: Path) -> NixConfigAttrs:
+    return run_sections(sections_of(args, root_dir), args.jobs)
+
+
+def detect(args: argparse.Namespace, root_dir: Path) -> str:
+    return render(detect_attrs(args, root_dir))
+
+
+def generate_live_config(args: argparse.Namespace, root_dir: Path, config_dir: Path) -> str:
+    """the hardware configuration of this machine. unless --no-cache is given the result of the last run is reused
+    when the hardware fingerprint hasn't changed since, which skips the udev walk and rendering"""
+    if args.no_cache:
+        return detect(args, root_dir)
+
+    cache_file = config_dir.joinpath(cache_file_name)
+    with timings.timer("fingerprint"):
+        fingerprint = hardware_fingerprint(root_dir, args.no_filesystems, options=output_options(args))
+    hw_config = load_cached_config(cache_file, fingerprint)
+    if hw_config is None:
+        hw_config = detect(args, root_dir)
+        # --show-hardware-config doesn't write anything below config_dir
+        if not args.show_hardware_config:
+            create_config_dir(config_dir)
+            save_cached_config(cache_file, fingerprint, hw_config)
+    return hw_config
+
+
+def live_attrs(args: argparse.Namespace, root_dir: Path, config_dir: Path) -> NixConfigAttrs:
+    """the hardware configuration of this machine for --check and --diff, which write nothing.
+    the cached config of an unchanged hardware fingerprint is parsed back instead of running the detection"""
+    from nixos_gen_config.diff_config import parse_hw_config
+
+    if not args.no_cache:
+        with timings.timer("fingerprint"):
+            fingerprint = hardware_fingerprint(root_dir, args.no_filesystems, options=output_options(args))
+        cached = load_cached_config(config_dir.joinpath(cache_file_name), fingerprint)
+        if cached is not None:
+            return parse_hw_config(cached)
+    return detect_attrs(args, root_dir)
+
+
+def run(args: argparse.Namespace) -> None:
+    nix_nixos_config = NixConfigAttrs()
     out_dir: Path = Path(args.dir).resolve()
     root_dir: Path = Path(args.root).resolve()
     overwrite_configuration: bool = args.force
@@ -26,19 +94,96 @@ def main() -> None:
 
     config_dir = af.get_config_dir(out_dir, root_dir)
 
-    udev_section(nix_hw_config)
-    virt_section(nix_hw_config)
-    cpu_section(nix_hw_config)
+    if args.capture:
+        from nixos_gen_config.snapshot import capture_snapshot
+
+        with timings.timer("capture"):
+            capture_snapshot(args.capture, source=device_source(args.device_backend))
+        print(f"Wrote hardware snapshot {args.capture}")
+        return
+
+    if args.batch:
+        from nixos_gen_config.batch import run_batch
+
+        # the detection runs in the worker processes, only the whole run is timed
+        with timings.timer("batch"):
+            failed = run_batch(
+                args.batch, out_dir, root_dir, no_filesystems, args.jobs, args.cpu_profile, args.memory_tuning
+            )
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.remote:
+        from nixos_gen_config.remote import run_remote
+
+        with timings.timer("remote"):
+            failed = run_remote(
+                args.remote,
+                out_dir,
+                root_dir,
+                no_filesystems,
+                args.jobs,
+                args.remote_python,
+                cpu_profile=args.cpu_profile,
+                memory_tuning=args.memory_tuning,
+                timeout=args.remote_timeout,
+            )
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.watch:
+        from nixos_gen_config.watch import watch
+
+        watch(sections_of(args, root_dir), config_dir, debounce=args.watch_debounce)
+        return
 
-    if not no_filesystems:
-        get_fs(nix_hw_config, root_dir)
+    if args.from_snapshot:
+        import tarfile
 
+        from nixos_gen_config.snapshot import open_snapshot
+
+        try:
+            with open_snapshot(args.from_snapshot) as snapshot:
+                sections = snapshot.sections(root_dir, no_filesystems, args.cpu_profile, args.memory_tuning)
+                nix_hw_config = run_sections(sections, args.jobs)
+        except (OSError, ValueError, tarfile.TarError) as error:
+            print(f"Reading the snapshot {args.from_snapshot} failed: {error}")
+            sys.exit(1)
+    elif args.check or args.diff:
+        nix_hw_config = live_attrs(args, root_dir, config_dir)
+
+    if args.check or args.diff:
+        from nixos_gen_config.diff_config import check_hw_config
+
+        sys.exit(check_hw_config(nix_hw_config, config_dir, args.diff))
+
+    hw_config = render(nix_hw_config) if args.from_snapshot else generate_live_config(args, root_dir, config_dir)
     if show_hardware_config:
-        print(generate_hw_config(nix_hw_config))
+        print(hw_config)
     else:
-        write_hw_config(nix_hw_config, config_dir)
+        with timings.timer("write"):
+            write_hw_config(hw_config, config_dir)
         write_nixos_config(nix_nixos_config, config_dir, overwrite_configuration)
 
 
+def main() -> None:
+    args = process_args()
+    if args.debug:
+        # only pay for icecream when debugging
+        from icecream import ic
+
+        ic.enable()
+    if args.timings:
+        timings.enabled = True
+    try:
+        run(args)
+    finally:
+        # also when a mode returns early or exits, e.g. --check, or --watch is interrupted
+        if args.timings:
+            report_timings(args.timings, args.timings_file)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,149 @@
+# resolve device MODALIAS strings to kernel modules through modules.alias, like modprobe does,
+# for devices whose driver isn't loaded yet
+import json
+import os
+import platform
+import re
+from fnmatch import translate
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+from nixos_gen_config.virtualisation import read_host_file
+from nixos_gen_config.write_config import write_config_file
+
+INDEX_VERSION = 1
+# where the modules of a kernel release live, relative to the host root. NixOS has no /lib/modules
+modules_dirs: list[str] = [
+    "lib/modules/{release}",
+    "run/booted-system/kernel-modules/lib/modules/{release}",
+    "run/current-system/kernel-modules/lib/modules/{release}",
+]
+wildcards = re.compile(r"[*?\[]")
+
+Alias = tuple[str, str]
+
+
+def alias_bus(pattern: str) -> str:
+    """the bus of a modalias or alias pattern, pci for pci:v00008086d..."""
+    bus, sep, _ = pattern.partition(":")
+    return bus if sep and not wildcards.search(bus) else ""
+
+
+def fixed_prefix(pattern: str) -> str:
+    """the text before the first wildcard, every modalias the pattern matches starts with it"""
+    match = wildcards.search(pattern)
+    return pattern[: match.start()] if match else pattern
+
+
+def parse_modules_alias(lines: Iterable[str]) -> Iterator[Alias]:
+    # alias pci:v*d*sv*sd*bc0Csc03i30* xhci_pci
+    for line in lines:
+        if not line.startswith("alias "):
+            continue
+        fields = line.split()
+        if len(fields) == 3:
+            yield fields[1], fields[2]
+
+
+class AliasIndex:
+    """the patterns of modules.alias keyed by bus and the fixed text before their first wildcard.
+    a lookup checks one dict entry per distinct prefix length of the bus and only globs the few patterns found
+    there, instead of matching every pattern of the file against every device"""
+
+    def __init__(self, by_bus: Optional[dict[str, dict[str, list[Alias]]]] = None) -> None:
+        # bus -> fixed prefix -> [(pattern, module)] in file order
+        self.by_bus: dict[str, dict[str, list[Alias]]] = by_bus or {}
+        self.prefix_lengths: dict[str, list[int]] = {
+            bus: sorted({len(prefix) for prefix in prefixes}) for bus, prefixes in self.by_bus.items()
+        }
+        self._compiled: dict[str, Callable[[str], Optional[re.Match[str]]]] = {}
+
+    @classmethod
+    def build(cls, aliases: Iterable[Alias]) -> "AliasIndex":
+        by_bus: dict[str, dict[str, list[Alias]]] = {}
+        for pattern, module in aliases:
+            by_bus.setdefault(alias_bus(pattern), {}).setdefault(fixed_prefix(pattern), []).append((pattern, module))
+        return cls(by_bus)
+
+    def matching_aliases(self, modalias: str) -> Iterator[Alias]:
+        bus = alias_bus(modalias)
+        # patterns with a wildcard in their bus, like acpi*:INT33D5:*, are kept without one
+        for candidate_bus in (bus, "") if bus else ("",):
+            prefixes = self.by_bus.get(candidate_bus, {})
+            for length in self.prefix_lengths.get(candidate_bus, []):
+                if length > len(modalias):
+                    break
+                for pattern, module in prefixes.get(modalias[:length], ()):
+                    if (matcher := self._compiled.get(pattern)) is None:
+                        matcher = self._compiled[pattern] = re.compile(translate(pattern)).match
+                    if matcher(modalias):
+                        yield pattern, module
+
+    def modules(self, modalias: str) -> list[str]:
+        """every module with an alias matching modalias, each once"""
+        return list(dict.fromkeys(module for _, module in self.matching_aliases(modalias)))
+
+    def to_json(self) -> dict[str, dict[str, list[Alias]]]:
+        return self.by_bus
+
+    @classmethod
+    def from_json(cls, by_bus: dict[str, dict[str, list[Alias]]]) -> "AliasIndex":
+        # json has lists where the index has tuples, both unpack the same
+        return cls(by_bus)
+
+
+def kernel_release(host_root: Path = Path("/")) -> str:
+    release = read_host_file(host_root, "/proc/sys/kernel/osrelease")
+    if release is None and host_root == Path("/"):
+        release = platform.release()
+    return release or ""
+
+
+def find_modules_file(host_root: Path, release: str, name: str) -> Optional[Path]:
+    """name in the modules directory of release, like modules.alias or modules.dep"""
+    for modules_dir in modules_dirs:
+        path = host_root.joinpath(modules_dir.format(release=release), name)
+        if path.exists():
+            return path
+    return None
+
+
+def find_modules_alias(host_root: Path, release: str) -> Optional[Path]:
+    return find_modules_file(host_root, release, "modules.alias")
+
+
+def default_cache_dir() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home().joinpath(".cache")).joinpath("nixos-gen-config")
+
+
+def load_alias_index(host_root: Path = Path("/"), cache_dir: Optional[Path] = None) -> Optional[AliasIndex]:
+    """the alias index of the running kernel of host_root, None without modules.alias.
+    with cache_dir the index is kept there per kernel release and rebuilt when modules.alias changes"""
+    release = kernel_release(host_root)
+    alias_file = find_modules_alias(host_root, release)
+    if alias_file is None:
+        return None
+    stat = alias_file.stat()
+    source = {"version": INDEX_VERSION, "path": str(alias_file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    cache_file = cache_dir.joinpath(f"modules.alias-{release}.json") if cache_dir else None
+    if cache_file is not None:
+        try:
+            with open(cache_file, encoding="utf-8") as cache:
+                cached = json.load(cache)
+            if cached.get("source") == source:
+                return AliasIndex.from_json(cached["index"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # missing or broken, rebuilt below
+            pass
+
+    with open(alias_file, encoding="utf-8", errors="replace") as aliases:
+        index = AliasIndex.build(parse_modules_alias(aliases))
+
+    if cache_file is not None:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            write_config_file(cache_file, json.dumps({"source": source, "index": index.to_json()}))
+        except OSError:
+            pass
+    return index
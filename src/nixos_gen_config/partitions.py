@@ -1,47 +1,459 @@
+import os
+import re
+from dataclasses import dataclass
 from pathlib import Path
 from string import Template
-
-import psutil
-import pyudev
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, NamedTuple, Optional
 
 from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.devices import DeviceSource, device_source
+from nixos_gen_config.timings import timings
+
+if TYPE_CHECKING:
+    import pyudev
 
 fsTemplate: Template = Template(
     """
   fileSystems."${mountpoint}" =
     { device = "${device}";
-      fsType = "${filesystem}";
+      fsType = "${filesystem}";${extra}
     };
 """
 )
 special_fs: list[str] = ["/proc", "/dev", "/sys", "/run", "/var/lib/nfs/rpc_pipefs"]
+# the mounts the initrd has to get to before switching to the system, relative to root_dir.
+# NixOS already mounts all of them but /boot in stage 1 (pathsNeededForBoot), and adds their fsType to
+# boot.initrd.supportedFilesystems, only the block stacks below them need configuring
+boot_mountpoints: list[str] = ["/", "/nix", "/boot", "/var"]
+# storage class -> the io scheduler udev sets for its disks, and the kernel names of those disks
+io_schedulers: dict[str, tuple[str, str]] = {
+    "nvme": ("none", "nvme[0-9]*n[0-9]*"),
+    "virtio": ("none", "vd[a-z]*"),
+    "ssd": ("mq-deadline", "sd[a-z]*"),
+    "hdd": ("bfq", "sd[a-z]*"),
+}
+# the classes whose disks don't need the access time written on every read
+flash_classes: frozenset[str] = frozenset({"nvme", "ssd"})
+# what BlockStacks reads of a block device, relative to its /sys directory. md/level only marks md devices,
+# the queue files are the storage class of disks
+block_device_files: list[str] = [
+    "dev",
+    "partition",
+    "dm/uuid",
+    "dm/name",
+    "md/level",
+    "queue/rotational",
+    "queue/discard_max_bytes",
+]
+# the udev properties BlockDeviceIndex reads
+block_index_properties: list[str] = ["DEVNAME", "MAJOR", "MINOR", "ID_FS_UUID", "ID_PART_ENTRY_UUID", "ID_FS_LABEL"]
+
+
+class Partition(NamedTuple):
+    device: str
+    mountpoint: str
+    fstype: str
+    # only known when read from mountinfo
+    devnum: str = ""
+
+
+mountinfo_escape = re.compile(r"\\([0-7]{3})")
+
+
+def unescape_mountinfo(field: str) -> str:
+    """undo the octal escaping of spaces, tabs, newlines and backslashes"""
+    if "\\" not in field:
+        return field
+    return mountinfo_escape.sub(lambda match: chr(int(match.group(1), 8)), field)
+
+
+def wanted_mounts(root_dir: Path) -> Callable[[str], bool]:
+    """a check if a mount point belongs in the config: below root_dir and not in one of the special_fs.
+    the prefixes are built once so checking a mount point is a couple of str.startswith calls"""
+    root = str(root_dir).rstrip("/")
+    special_mounts = frozenset(f"{root}{special}" for special in special_fs)
+    special_prefixes = tuple(f"{special}/" for special in special_mounts)
+    root_prefix = f"{root}/"
+
+    def is_wanted(mountpoint: str) -> bool:
+        if not mountpoint.startswith(root_prefix) and mountpoint != root:
+            return False
+        return mountpoint not in special_mounts and not mountpoint.startswith(special_prefixes)
+
+    return is_wanted
+
+
+def iter_mountinfo(root_dir: Optional[Path] = None, path: Path = Path("/proc/self/mountinfo")) -> Iterator[Partition]:
+    """mounts from mountinfo, one line at a time. with root_dir the lines of unwanted mounts
+    are dropped right after reading their mount point"""
+    is_wanted = wanted_mounts(root_dir) if root_dir is not None else None
+    scanned = 0
+    with open(path, encoding="utf-8", errors="surrogateescape") as mountinfo:
+        for scanned, line in enumerate(mountinfo, start=1):
+            # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+            fields = line.split(" ", 6)
+            mountpoint = fields[4]
+            if "\\" in mountpoint:
+                mountpoint = unescape_mountinfo(mountpoint)
+            if is_wanted is not None and not is_wanted(mountpoint):
+                continue
+
+            rest = fields[6]
+            # a variable number of optional fields ends with a lone -
+            tail = rest[2:] if rest.startswith("- ") else rest.partition(" - ")[2]
+            fstype, source = (tail.split(" ", 2) + [""])[:2]
+            yield Partition(unescape_mountinfo(source.rstrip("\n")), mountpoint, fstype, fields[2])
+    timings.count("mounts scanned", scanned)
+
+
+def list_partitions(root_dir: Optional[Path] = None) -> Iterable[Partition]:
+    """every mount, or with root_dir only the wanted ones. psutil is only used without /proc/self/mountinfo"""
+    if Path("/proc/self/mountinfo").exists():
+        return iter_mountinfo(root_dir)
+
+    import psutil
+
+    partitions = (Partition(part.device, part.mountpoint, part.fstype) for part in psutil.disk_partitions(all=True))
+    if root_dir is None:
+        return partitions
+    is_wanted = wanted_mounts(root_dir)
+    return (part for part in partitions if is_wanted(part.mountpoint))
+
+
+@dataclass(frozen=True)
+class BlockDevice:
+    devname: str
+    devnum: str
+    uuid: str = ""
+    partuuid: str = ""
+    label: str = ""
+
+
+class BlockDeviceIndex:
+    """block devices keyed by DEVNAME and major:minor, built from a single pass over the udev block subsystem"""
+
+    def __init__(self, devices: Iterable["pyudev.Device"]) -> None:
+        self.by_devname: dict[str, BlockDevice] = {}
+        self.by_devnum: dict[str, BlockDevice] = {}
+        device: pyudev.Device
+        for device in devices:
+            block_device = BlockDevice(
+                devname=device.get("DEVNAME") or "",
+                devnum=f'{device.get("MAJOR")}:{device.get("MINOR")}',
+                uuid=device.get("ID_FS_UUID") or "",
+                partuuid=device.get("ID_PART_ENTRY_UUID") or "",
+                label=device.get("ID_FS_LABEL") or "",
+            )
+            if block_device.devname:
+                self.by_devname[block_device.devname] = block_device
+            self.by_devnum[block_device.devnum] = block_device
+
+    @classmethod
+    def from_source(cls, source: DeviceSource) -> "BlockDeviceIndex":
+        return cls(source.devices({"block": block_index_properties}))
+
+    def lookup(self, devname: str) -> Optional[BlockDevice]:
+        return self.by_devname.get(devname)
+
+    def lookup_devnum(self, devnum: str) -> Optional[BlockDevice]:
+        return self.by_devnum.get(devnum)
+
+
+def boot_mounts(root_dir: Path) -> set[str]:
+    root = str(root_dir).rstrip("/")
+    return {f"{root}{mountpoint}".rstrip("/") or "/" for mountpoint in boot_mountpoints}
+
 
+def block_device_dir(host_root: Path, part: Partition) -> Optional[Path]:
+    """the /sys directory of the block device of a mount"""
+    if part.devnum:
+        path = host_root.joinpath("sys/dev/block", part.devnum)
+        if path.exists():
+            return path
+    # btrfs mounts have an anonymous device number, their source is the real device
+    name = part.device.rpartition("/")[2]
+    if part.device.startswith("/dev/mapper/"):
+        for dm_name in host_root.joinpath("sys/class/block").glob("dm-*/dm/name"):
+            if dm_name.read_text("utf-8").strip() == name:
+                return dm_name.parent.parent
+    path = host_root.joinpath("sys/class/block", name)
+    return path if part.device.startswith("/dev/") and path.exists() else None
 
-def get_stable_device_path(devices: pyudev.Device, part_device: str) -> str:
-    stable_device_path: str = ""
-    for device in devices:
-        if device.get("DEVNAME") == part_device:
-            uuid = device.get("ID_FS_UUID")
-            stable_device_path = f"/dev/disk/by-uuid/{uuid}"
-    return stable_device_path
 
+def read_sys_file(path: Path) -> str:
+    try:
+        return path.read_text("utf-8").strip()
+    except OSError:
+        return ""
 
-def get_fs(nix_hw_config: NixConfigAttrs, root_dir: Path) -> None:
 
-    context: pyudev.Context = pyudev.Context()
-    devices: pyudev.Device = context.list_devices(subsystem="block")
+@dataclass(frozen=True)
+class BlockLayer:
+    """a block device of a stack, what the initrd has to set up to get to the device above it"""
 
-    for part in psutil.disk_partitions(all=True):
-        if not part.mountpoint.startswith(str(root_dir)):
+    kind: str  # crypt, lvm, md, bcache or "" for a plain disk or partition
+    name: str
+    devnum: str
+    dm_name: str = ""
+    dm_uuid: str = ""
+    slaves: tuple[str, ...] = ()
+
+    @classmethod
+    def read(cls, block_dir: Path) -> "BlockLayer":
+        dm_uuid = read_sys_file(block_dir.joinpath("dm/uuid"))
+        name = block_dir.resolve().name
+        kind = ""
+        if dm_uuid.startswith("CRYPT-"):
+            kind = "crypt"
+        elif dm_uuid.startswith("LVM-"):
+            kind = "lvm"
+        elif block_dir.joinpath("md").is_dir():
+            kind = "md"
+        elif name.startswith("bcache"):
+            kind = "bcache"
+        slaves = block_dir.joinpath("slaves")
+        return cls(
+            kind=kind,
+            name=name,
+            devnum=read_sys_file(block_dir.joinpath("dev")),
+            dm_name=read_sys_file(block_dir.joinpath("dm/name")),
+            dm_uuid=dm_uuid,
+            slaves=tuple(sorted(os.listdir(slaves))) if slaves.is_dir() else (),
+        )
+
+    def luks_uuid(self) -> str:
+        """the LUKS header UUID in the dm uuid, CRYPT-LUKS2-<uuid without dashes>-<name>"""
+        parts = self.dm_uuid.split("-")
+        if len(parts) < 3 or len(parts[2]) != 32:
+            return ""
+        uuid = parts[2]
+        return f"{uuid[:8]}-{uuid[8:12]}-{uuid[12:16]}-{uuid[16:20]}-{uuid[20:]}"
+
+
+@dataclass(frozen=True)
+class Disk:
+    """the queue of a whole disk, what the storage class and io tuning depend on"""
+
+    name: str
+    transport: str  # nvme, virtio, sata, scsi, usb or "" when unknown
+    rotational: bool
+    discard: bool
+
+    @classmethod
+    def read(cls, disk_dir: Path) -> "Disk":
+        path = disk_dir.resolve()
+        parts = set(path.parts)
+        if not disk_dir.joinpath("queue").is_dir():
+            # nothing we could tune
+            transport = ""
+        elif "nvme" in parts:
+            transport = "nvme"
+        elif path.name.startswith("vd") or any(part.startswith("virtio") for part in parts):
+            transport = "virtio"
+        elif any(part.startswith("usb") for part in parts):
+            transport = "usb"
+        elif any(part.startswith("ata") for part in parts):
+            transport = "sata"
+        elif path.name.startswith("sd"):
+            transport = "scsi"
+        else:
+            transport = ""
+        discard_max_bytes = read_sys_file(disk_dir.joinpath("queue/discard_max_bytes"))
+        return cls(
+            name=path.name,
+            transport=transport,
+            rotational=read_sys_file(disk_dir.joinpath("queue/rotational")) == "1",
+            discard=discard_max_bytes.isdigit() and int(discard_max_bytes) > 0,
+        )
+
+    @property
+    def storage_class(self) -> str:
+        """nvme, virtio, ssd or hdd, empty for removable and unknown disks which get no tuning.
+        virtio disks say they are rotational whatever backs them, the host schedules their io"""
+        if self.transport in ("nvme", "virtio"):
+            return self.transport
+        if self.transport in ("sata", "scsi"):
+            return "hdd" if self.rotational else "ssd"
+        return ""
+
+
+class BlockStacks:
+    """the slaves graph of /sys/class/block, read lazily and once per device however many mounts share it"""
+
+    def __init__(self, host_root: Path = Path("/")) -> None:
+        self.host_root = host_root
+        self.layers: dict[str, BlockLayer] = {}
+        self.disks: dict[str, Disk] = {}
+        self.mount_dirs: dict[tuple[str, str], Optional[Path]] = {}
+
+    def layer(self, block_dir: Path) -> BlockLayer:
+        name = block_dir.resolve().name
+        if (layer := self.layers.get(name)) is None:
+            layer = self.layers[name] = BlockLayer.read(block_dir)
+        return layer
+
+    def stack(self, block_dir: Path) -> Iterator[BlockLayer]:
+        """the device of block_dir and every device below it, top down"""
+        layer = self.layer(block_dir)
+        yield layer
+        for slave in layer.slaves:
+            yield from self.stack(self.host_root.joinpath("sys/class/block", slave))
+
+    def mount_dir(self, part: Partition) -> Optional[Path]:
+        # btrfs subvolumes and bind mounts share their device
+        key = (part.devnum, part.device)
+        if key not in self.mount_dirs:
+            self.mount_dirs[key] = block_device_dir(self.host_root, part)
+        return self.mount_dirs[key]
+
+    def mount_stack(self, part: Partition) -> list[BlockLayer]:
+        block_dir = self.mount_dir(part)
+        return list(self.stack(block_dir)) if block_dir is not None else []
+
+    def disk(self, block_dir: Path) -> Disk:
+        # the queue of a partition is the one of its disk
+        disk_dir = block_dir.resolve()
+        if disk_dir.joinpath("partition").exists():
+            disk_dir = disk_dir.parent
+        if (disk := self.disks.get(disk_dir.name)) is None:
+            disk = self.disks[disk_dir.name] = Disk.read(disk_dir)
+        return disk
+
+    def mount_disks(self, part: Partition) -> list[Disk]:
+        """the disks at the bottom of the stack of a mount"""
+        block_dir = self.mount_dir(part)
+        if block_dir is None:
+            return []
+        return [self.disk(self.layer_dir(layer)) for layer in self.stack(block_dir) if not layer.slaves]
+
+    def layer_dir(self, layer: BlockLayer) -> Path:
+        return self.host_root.joinpath("sys/class/block", layer.name)
+
+
+def block_tree(host_root: Path = Path("/")) -> tuple[dict[str, str], dict[str, str]]:
+    """the files and symlinks of /sys BlockStacks reads, as (files, links) relative to host_root.
+    a snapshot writes them back to replay the stacks and disks of its mounts"""
+    files: dict[str, str] = {}
+    links: dict[str, str] = {}
+    for base in ("sys/class/block", "sys/dev/block"):
+        try:
+            names = sorted(os.listdir(host_root.joinpath(base)))
+        except OSError:
             continue
+        for name in names:
+            entry = host_root.joinpath(base, name)
+            if entry.is_symlink():
+                links[f"{base}/{name}"] = os.readlink(entry)
+            if base != "sys/class/block":
+                continue
+            device_dir = entry.resolve()
+            try:
+                relative = device_dir.relative_to(host_root.resolve()).as_posix()
+            except ValueError:
+                continue
+            for device_file in block_device_files:
+                try:
+                    files[f"{relative}/{device_file}"] = device_dir.joinpath(device_file).read_text("utf-8")
+                except OSError:
+                    pass
+            slaves = device_dir.joinpath("slaves")
+            for slave in sorted(os.listdir(slaves)) if slaves.is_dir() else ():
+                links[f"{relative}/slaves/{slave}"] = os.readlink(slaves.joinpath(slave))
+    return files, links
+
+
+def boot_stack_section(nix_hw_config: NixConfigAttrs, stack: list[BlockLayer], block_index: BlockDeviceIndex) -> None:
+    """add what the initrd needs to assemble the stack of a boot mount"""
+    for index, layer in enumerate(stack):
+        if layer.kind == "crypt":
+            # the LUKS header is on the device right below, udev knows it as a crypto_LUKS filesystem
+            below = block_index.lookup_devnum(stack[index + 1].devnum) if index + 1 < len(stack) else None
+            uuid = (below.uuid if below else "") or layer.luks_uuid()
+            if uuid:
+                nix_hw_config.attrs.append(
+                    f'boot.initrd.luks.devices."{layer.dm_name}".device = "/dev/disk/by-uuid/{uuid}";'
+                )
+        elif layer.kind == "lvm":
+            nix_hw_config.initrd_kernel_modules.append("dm-snapshot")
+        elif layer.kind == "md":
+            nix_hw_config.attrs.append("boot.swraid.enable = true;")
+        elif layer.kind == "bcache":
+            nix_hw_config.initrd_available_kernel_modules.append("bcache")
+
+
+def scheduler_rules(classes: Iterable[str]) -> str:
+    """udev rules setting the io scheduler of the disks of classes, one per line"""
+    rules: list[str] = []
+    for storage_class in classes:
+        scheduler, kernel = io_schedulers[storage_class]
+        rotational = ""
+        if storage_class in ("ssd", "hdd"):
+            # sata ssds and hdds share their names
+            rotational = f', ATTR{{queue/rotational}}=="{int(storage_class == "hdd")}"'
+        rules.append(
+            f'ACTION=="add|change", KERNEL=="{kernel}", ENV{{DEVTYPE}}=="disk"{rotational}, '
+            f'ATTR{{queue/scheduler}}="{scheduler}"'
+        )
+    return "".join(f"    {rule}\n" for rule in rules)
 
-        if [x for x in special_fs if x in part.mountpoint]:
+
+def storage_section(nix_hw_config: NixConfigAttrs, disks: Iterable[Disk]) -> None:
+    """fstrim and io schedulers for the storage classes of the disks below the mounts"""
+    disks = list(disks)
+    if any(disk.discard and disk.storage_class for disk in disks):
+        nix_hw_config.attrs.append("services.fstrim.enable = lib.mkDefault true;")
+    present = {disk.storage_class for disk in disks}
+    classes = [storage_class for storage_class in io_schedulers if storage_class in present]
+    if classes:
+        nix_hw_config.attrs.append(f"services.udev.extraRules = ''\n{scheduler_rules(classes)}  '';")
+
+
+def get_stable_device_path(block_index: BlockDeviceIndex, part_device: str, devnum: str = "") -> str:
+    # /dev/root and the sources of bind mounts aren't udev names, their device number still is
+    block_device = block_index.lookup(part_device) or (block_index.lookup_devnum(devnum) if devnum else None)
+    if block_device and block_device.uuid:
+        return f"/dev/disk/by-uuid/{block_device.uuid}"
+    return ""
+
+
+def get_fs(
+    nix_hw_config: NixConfigAttrs,
+    root_dir: Path,
+    block_index: Optional[BlockDeviceIndex] = None,
+    partitions: Optional[Iterable[Partition]] = None,
+    source: Optional[DeviceSource] = None,
+    host_root: Path = Path("/"),
+) -> None:
+    if block_index is None:
+        block_index = BlockDeviceIndex.from_source(source or device_source())
+    if partitions is None:
+        partitions = list_partitions(root_dir)
+
+    is_wanted = wanted_mounts(root_dir)
+    # only the mounts the initrd needs get their block stack walked
+    boot = boot_mounts(root_dir)
+    stacks = BlockStacks(host_root)
+    mounted_disks: dict[str, Disk] = {}
+    kept = 0
+    for part in partitions:
+        if not is_wanted(part.mountpoint):
             continue
+        kept += 1
 
-        stable_device_path: str = get_stable_device_path(devices, part.device)
+        stable_device_path: str = get_stable_device_path(block_index, part.device, part.devnum)
 
         # if stable_device_path then use that
         device_name: str = stable_device_path or part.device
 
-        f_s = fsTemplate.substitute(mountpoint=part.mountpoint, device=device_name, filesystem=part.fstype)
+        extra = ""
+        if part.mountpoint in boot:
+            boot_stack_section(nix_hw_config, stacks.mount_stack(part), block_index)
+        disks = stacks.mount_disks(part)
+        mounted_disks.update((disk.name, disk) for disk in disks)
+        if disks and all(disk.storage_class in flash_classes for disk in disks):
+            extra += '\n      options = [ "noatime" ];'
+
+        f_s = fsTemplate.substitute(mountpoint=part.mountpoint, device=device_name, filesystem=part.fstype, extra=extra)
         nix_hw_config.fsattrs.append(f_s)
+    storage_section(nix_hw_config, mounted_disks.values())
+    timings.count("mounts kept", kept)
@@ -0,0 +1,63 @@
+# the PCI rules of hardware.py as data keyed by numeric ids, so each device costs a dict lookup however long the
+# tables get. the ids are the ones the kernel puts in the uevent of every PCI device, copied from its sysfs
+# vendor, device and class attributes:
+#   PCI_ID=14E4:43A0     vendor:device, upper case hex
+#   PCI_CLASS=C0330      class << 16 | subclass << 8 | prog-if, hex without leading zeros
+from typing import Optional
+
+# https://github.com/systemd/systemd/blob/main/hwdb.d/20-pci-classes.hwdb
+# the bound driver of a device of these classes is needed in the initrd
+initrd_pci_classes: frozenset[int] = frozenset(
+    {
+        0x01,  # Mass storage controller
+    }
+)
+initrd_pci_subclasses: frozenset[int] = frozenset(
+    {
+        0x0C00,  # FireWire (IEEE 1394)
+        0x0C03,  # USB controller
+    }
+)
+
+# vendor:device -> initrd module. for some of these the device loads something that has a driver different
+# to itself
+pci_device_modules: dict[str, str] = {
+    "1AF4:1004": "virtio_scsi",  # Virtio SCSI
+    "1AF4:1048": "virtio_scsi",  # Virtio 1.0 SCSI
+}
+
+# vendor:device of the Broadcom wifi chips that need broadcom_sta
+broadcom_sta_ids: frozenset[str] = frozenset(
+    {
+        "14E4:4311",  # BCM4311
+        "14E4:43A0",  # BCM4360
+        "14E4:432B",  # BCM4322
+        "14E4:4727",  # BCM4313
+        "14E4:4315",  # BCM4312
+        "14E4:4328",  # BCM4321
+        "14E4:4365",  # BCM43142
+        "14E4:4353",  # BCM43224
+        "14E4:4357",  # BCM43225
+        "14E4:4358",  # BCM43227
+        "14E4:4359",  # BCM43228
+        "14E4:4331",  # BCM4331
+        "14E4:43B1",  # BCM4352
+        # more devices probably belong here. however it is really tedious to go through them
+        # https://linux-hardware.org/?view=search&vendor=Broadcom&typeid=net%2Fwireless#list
+        # https://github.com/systemd/systemd/blob/main/hwdb.d/20-pci-vendor-model.hwdb
+    }
+)
+
+
+def parse_pci_class(pci_class: Optional[str]) -> Optional[int]:
+    """the numeric PCI_CLASS, None if it's missing or malformed"""
+    if not pci_class:
+        return None
+    try:
+        return int(pci_class, 16)
+    except ValueError:
+        return None
+
+
+def is_initrd_class(pci_class: int) -> bool:
+    return pci_class >> 16 in initrd_pci_classes or pci_class >> 8 in initrd_pci_subclasses
@@ -0,0 +1,235 @@
+# --remote: generate the hardware configuration of other machines without installing anything on them.
+# collector.py is sent to the python3 of the target through a transport, which reads every detector input there in
+# one exec and sends it back as one payload. the detection itself runs here, on a host root rebuilt from the payload
+import gzip
+import json
+import subprocess
+import sys
+import tempfile
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import Any, Iterator, Optional, Sequence
+
+from nixos_gen_config import collector
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.hardware import CpuInfo, udev_rules
+from nixos_gen_config.modalias import modules_dirs
+from nixos_gen_config.partitions import block_device_files, iter_mountinfo
+from nixos_gen_config.pci_ids import initrd_pci_classes, initrd_pci_subclasses
+from nixos_gen_config.sections import run_sections
+from nixos_gen_config.snapshot import (
+    SNAPSHOT_VERSION,
+    Snapshot,
+    snapshot_files,
+    snapshot_globs,
+    snapshot_properties,
+    write_host_links,
+)
+from nixos_gen_config.virtualisation import detect_virt, virt_host_files, virt_host_paths
+from nixos_gen_config.write_config import write_config_file
+
+mountinfo_file = "proc/self/mountinfo"
+# seconds ssh may take to connect, and a whole collection may take before the host counts as failed
+connect_timeout = 10
+collect_timeout = 300.0
+# what open_payload reads of a collector payload
+payload_keys = ("files", "exists", "devices", "virt")
+
+
+class Transport(ABC):
+    """runs a python program on a host, given as source on stdin, and returns its stdout"""
+
+    # None waits for the program however long it takes
+    timeout: Optional[float] = None
+
+    @abstractmethod
+    def command(self) -> list[str]:
+        """the command starting a python3 on the host that reads its program from stdin"""
+
+    def run(self, program: str) -> bytes:
+        try:
+            result = subprocess.run(
+                self.command(), input=program.encode(), capture_output=True, check=False, timeout=self.timeout
+            )
+        except subprocess.TimeoutExpired as error:
+            # a hung host fails like one that is down instead of holding its worker forever
+            raise RuntimeError(f"{' '.join(self.command())} timed out after {self.timeout:g}s") from error
+        if result.returncode != 0:
+            stderr = result.stderr.decode(errors="replace").strip()
+            raise RuntimeError(f"{' '.join(self.command())} exited with {result.returncode}: {stderr}")
+        return result.stdout
+
+
+class LocalTransport(Transport):
+    """runs the collector on this machine, with the python running us unless python is given"""
+
+    def __init__(self, python: Optional[str] = None, timeout: Optional[float] = None) -> None:
+        self.python = python or sys.executable
+        self.timeout = timeout
+
+    def command(self) -> list[str]:
+        return [self.python, "-"]
+
+
+class SshTransport(Transport):
+    def __init__(
+        self,
+        host: str,
+        python: str = "python3",
+        ssh: Sequence[str] = ("ssh",),
+        timeout: Optional[float] = collect_timeout,
+    ) -> None:
+        self.host = host
+        self.python = python
+        self.ssh = list(ssh)
+        self.timeout = timeout
+
+    def command(self) -> list[str]:
+        # BatchMode keeps a host that asks for a password from blocking the others, the timeouts one that
+        # doesn't answer or stops answering
+        return [
+            *self.ssh,
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            f"ConnectTimeout={connect_timeout}",
+            "-o",
+            "ServerAliveInterval=15",
+            "-o",
+            "ServerAliveCountMax=3",
+            self.host,
+            self.python,
+            "-",
+        ]
+
+
+def collector_request(host_root: Path = Path("/")) -> dict[str, Any]:
+    """what the collector reads: the inputs of every detector the live run and --capture read"""
+    return {
+        "version": SNAPSHOT_VERSION,
+        "host_root": str(host_root),
+        "files": list(dict.fromkeys([*snapshot_files, *virt_host_files, mountinfo_file])),
+        "globs": snapshot_globs,
+        "block_files": block_device_files,
+        "exists": virt_host_paths,
+        "devices": {subsystem: sorted(snapshot_properties(subsystem)) for subsystem in udev_rules},
+        "modules_alias": [f"{modules_dir}/modules.alias" for modules_dir in modules_dirs],
+        # the unbound pci devices whose alias lines are sent back, like hardware.unbound_modalias
+        "initrd_pci_classes": sorted(initrd_pci_classes),
+        "initrd_pci_subclasses": sorted(initrd_pci_subclasses),
+        "virt": True,
+    }
+
+
+def collector_program(request: dict[str, Any]) -> str:
+    # the request is appended to the source as a call of its main
+    source = Path(collector.__file__).read_text("utf-8")
+    return f"{source}\n\nmain(json.loads({json.dumps(request)!r}))\n"
+
+
+def collect(transport: Transport, host_root: Path = Path("/")) -> dict[str, Any]:
+    """the detector inputs of the host behind transport, one exec of the collector"""
+    payload: dict[str, Any] = json.loads(
+        gzip.decompress(transport.run(collector_program(collector_request(host_root))))
+    )
+    if not isinstance(payload, dict):
+        raise ValueError("collector payload is not an object")
+    if payload.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"collector payload has version {payload.get('version')}, expected {SNAPSHOT_VERSION}")
+    if missing := [key for key in payload_keys if key not in payload]:
+        # a failed host instead of a KeyError ending run_remote for all of them
+        raise ValueError(f"collector payload has no {', '.join(missing)}")
+    return payload
+
+
+def write_host_root(payload: dict[str, Any], host_root: Path) -> None:
+    for name in payload["exists"]:
+        if name not in payload["files"]:
+            host_root.joinpath(name).mkdir(parents=True, exist_ok=True)
+    for name, content in payload["files"].items():
+        path = PurePosixPath(name)
+        # the payload comes from another machine, keep it below host_root
+        if path.is_absolute() or ".." in path.parts:
+            continue
+        target = host_root.joinpath(*path.parts)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(content, "utf-8")
+    write_host_links(payload.get("links", {}), host_root)
+
+
+@contextmanager
+def open_payload(payload: dict[str, Any], root_dir: Path) -> Iterator[Snapshot]:
+    """the payload as a Snapshot, its files written to a temporary host root"""
+    with tempfile.TemporaryDirectory(prefix="nixos-gen-config-") as tmpdir:
+        host_root = Path(tmpdir)
+        write_host_root(payload, host_root)
+        mountinfo = host_root.joinpath(mountinfo_file)
+        partitions = list(iter_mountinfo(root_dir, mountinfo)) if mountinfo.exists() else []
+        cpuinfo = CpuInfo.read(host_root.joinpath("proc/cpuinfo"))
+        yield Snapshot(
+            host_root=host_root,
+            virt=detect_virt(cpuinfo, host_root) or payload["virt"] or "none",
+            devices=payload["devices"],
+            partitions=partitions,
+        )
+
+
+def generate_remote_config(
+    transport: Transport,
+    root_dir: Path,
+    no_filesystems: bool,
+    cpu_profile: str = "auto",
+    memory_tuning: bool = False,
+    name: str = "",
+) -> str:
+    payload = collect(transport)
+    with open_payload(payload, root_dir) as snapshot:
+        snapshot.name = name
+        return generate_hw_config(run_sections(snapshot.sections(root_dir, no_filesystems, cpu_profile, memory_tuning)))
+
+
+def run_remote(
+    hosts: Sequence[str],
+    out_dir: Path,
+    root_dir: Path,
+    no_filesystems: bool,
+    jobs: int,
+    python: str = "python3",
+    cpu_profile: str = "auto",
+    memory_tuning: bool = False,
+    timeout: float = collect_timeout,
+) -> int:
+    """generate the hardware configuration of every host into out_dir/<host>/, collecting from several hosts
+    at once. progress and errors are printed as the hosts finish, returns the number of failed hosts"""
+    failed = 0
+    # the hosts mostly wait on ssh, threads are enough
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures: dict[Future[str], str] = {
+            executor.submit(
+                generate_remote_config,
+                SshTransport(host, python, timeout=timeout),
+                root_dir,
+                no_filesystems,
+                cpu_profile,
+                memory_tuning,
+                host,
+            ): host
+            for host in hosts
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            host = futures[future]
+            try:
+                hw_config = future.result()
+            except (OSError, ValueError, RuntimeError) as error:
+                failed += 1
+                print(f"[{done}/{len(hosts)}] {host}: failed: {error}", file=sys.stderr, flush=True)
+                continue
+            # user@host is written to host/
+            config_dir = out_dir.joinpath(host.rpartition("@")[2])
+            config_dir.mkdir(parents=True, exist_ok=True)
+            config_file = config_dir.joinpath("hardware-configuration.nix")
+            write_config_file(config_file, hw_config)
+            print(f"[{done}/{len(hosts)}] {host}: wrote {config_file}", flush=True)
+    return failed
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.devices import DeviceSource, device_source
+from nixos_gen_config.hardware import CpuInfo, cpu_section, memory_section, udev_section, virt_section
+from nixos_gen_config.initrd import initrd_section
+from nixos_gen_config.partitions import get_fs
+from nixos_gen_config.timings import timings
+
+Section = Callable[[NixConfigAttrs], None]
+
+
+def live_sections(
+    root_dir: Path,
+    no_filesystems: bool,
+    source: Optional[DeviceSource] = None,
+    minimal_initrd: bool = False,
+    cpu_profile: str = "auto",
+    memory_tuning: bool = False,
+) -> list[Section]:
+    """the detection sections reading the running host"""
+    cpuinfo = CpuInfo.read()
+    source = source or device_source()
+    sections: list[Section] = [
+        partial(udev_section, source=source, initrd_modules=not minimal_initrd),
+        partial(virt_section, cpuinfo=cpuinfo),
+        partial(cpu_section, cpuinfo=cpuinfo, profile=cpu_profile),
+    ]
+    if memory_tuning:
+        sections.append(partial(memory_section, label=""))
+    if minimal_initrd:
+        sections.append(partial(initrd_section, root_dir=root_dir))
+    if not no_filesystems:
+        sections.append(partial(get_fs, root_dir=root_dir, source=source))
+    return sections
+
+
+def section_name(section: Section) -> str:
+    while isinstance(section, partial):
+        section = section.func
+    return getattr(section, "__name__", repr(section))
+
+
+def run_section(section: Section, fragment: NixConfigAttrs) -> None:
+    with timings.timer(f"section {section_name(section)}"):
+        section(fragment)
+
+
+def run_sections(sections: Sequence[Section], jobs: int = 1) -> NixConfigAttrs:
+    """run every section into its own fragment and merge the fragments in the order of sections,
+    so the result doesn't depend on which section finishes first.
+    jobs <= 1 runs the sections one after another in the calling thread"""
+    fragments: list[NixConfigAttrs] = [NixConfigAttrs() for _ in sections]
+    if jobs <= 1:
+        for section, fragment in zip(sections, fragments):
+            run_section(section, fragment)
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(run_section, section, fragment) for section, fragment in zip(sections, fragments)
+            ]
+            for future in futures:
+                # re-raises the exception of a failed section
+                future.result()
+
+    nix_config = NixConfigAttrs()
+    for fragment in fragments:
+        nix_config.merge(fragment)
+    return nix_config
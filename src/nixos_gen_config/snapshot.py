@@ -0,0 +1,230 @@
+import io
+import json
+import os
+import tarfile
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path, PurePosixPath
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from nixos_gen_config.hardware import (
+    CpuInfo,
+    cpu_section,
+    cpufreq_globs,
+    memory_globs,
+    memory_section,
+    unbound_modalias,
+    udev_properties,
+    udev_rules,
+    udev_section,
+    virt_section,
+)
+from nixos_gen_config.devices import DeviceSource, device_source
+from nixos_gen_config.modalias import default_cache_dir, kernel_release, load_alias_index
+from nixos_gen_config.partitions import (
+    BlockDeviceIndex,
+    Partition,
+    block_index_properties,
+    block_tree,
+    get_fs,
+    list_partitions,
+)
+from nixos_gen_config.sections import Section
+from nixos_gen_config.virtualisation import detect_virt, systemd_detect_virt
+
+if TYPE_CHECKING:
+    import pyudev
+
+# 2: the pci rules read PCI_ID and PCI_CLASS instead of the hwdb names
+# 3: the block device tree of /sys is recorded, files under host/ and its symlinks in links
+# 4: with the queue files of the disks in the block device tree
+# 5: partitions are device, mountpoint, fstype and devnum
+SNAPSHOT_VERSION = 5
+# the host files the detectors read, relative to the host root. they are stored under host/ in the archive
+snapshot_files: list[str] = [
+    "proc/cpuinfo",
+    "proc/sys/kernel/osrelease",
+]
+# the host files whose names depend on the host, e.g. one cpufreq dir per policy
+snapshot_globs: list[str] = [*cpufreq_globs, *memory_globs]
+compressions: dict[str, str] = {".gz": "gz", ".xz": "xz", ".bz2": "bz2", ".tar": ""}
+
+
+@dataclass
+class Snapshot:
+    """the inputs of every detector, either captured from a host or loaded from an archive"""
+
+    host_root: Path
+    virt: str
+    devices: dict[str, list[dict[str, str]]]
+    partitions: list[Partition]
+    # the host in what is reported, empty for a single one
+    name: str = ""
+
+    def sections(
+        self, root_dir: Path, no_filesystems: bool, cpu_profile: str = "auto", memory_tuning: bool = False
+    ) -> list[Section]:
+        cpuinfo = CpuInfo.read(self.host_root.joinpath("proc/cpuinfo"))
+        udev_devices = [device for subsystem in udev_rules for device in self.devices.get(subsystem, [])]
+        sections: list[Section] = [
+            partial(udev_section, devices=udev_devices, host_root=self.host_root),
+            partial(virt_section, virt=self.virt),
+            partial(cpu_section, cpuinfo=cpuinfo, host_root=self.host_root, profile=cpu_profile),
+        ]
+        if memory_tuning:
+            sections.append(partial(memory_section, host_root=self.host_root, label=self.name))
+        if not no_filesystems:
+            block_index = BlockDeviceIndex(self.devices.get("block", []))
+            sections.append(
+                partial(
+                    get_fs,
+                    root_dir=root_dir,
+                    block_index=block_index,
+                    partitions=self.partitions,
+                    host_root=self.host_root,
+                )
+            )
+        return sections
+
+
+def snapshot_properties(subsystem: str) -> set[str]:
+    properties = udev_properties(subsystem)
+    if subsystem == "block":
+        properties.update(block_index_properties)
+    return properties
+
+
+def capture_devices(source: DeviceSource) -> dict[str, list[dict[str, str]]]:
+    """the udev properties the rules and the block index read, from one walk over their subsystems"""
+    wanted: dict[str, list[str]] = {subsystem: sorted(snapshot_properties(subsystem)) for subsystem in udev_rules}
+    devices: dict[str, list[dict[str, str]]] = {subsystem: [] for subsystem in udev_rules}
+    device: pyudev.Device
+    for device in source.devices(wanted):
+        subsystem: str = device.get("SUBSYSTEM")
+        properties = {prop: str(device.get(prop)) for prop in wanted.get(subsystem, ()) if device.get(prop)}
+        if properties.keys() - {"SUBSYSTEM"}:
+            devices[subsystem].append(properties)
+    return devices
+
+
+def read_first_cpu(path: Path) -> str:
+    """the first processor block of /proc/cpuinfo, which is all CpuInfo reads"""
+    lines: list[str] = []
+    with open(path, encoding="utf-8") as cpuinfo:
+        for line in cpuinfo:
+            if not line.strip() and lines:
+                break
+            lines.append(line)
+    return "".join(lines)
+
+
+def capture_modules_alias(devices: dict[str, list[dict[str, str]]], host_root: Path) -> dict[str, str]:
+    """the modules.alias lines matching the pci devices without a driver. the whole file is large and
+    replaying only ever looks these up"""
+    unbound = [modalias for device in devices.get("pci", []) if (modalias := unbound_modalias(device))]
+    if not unbound:
+        return {}
+    alias_index = load_alias_index(host_root, default_cache_dir() if host_root == Path("/") else None)
+    if alias_index is None:
+        return {}
+    aliases = dict.fromkeys(alias for modalias in unbound for alias in alias_index.matching_aliases(modalias))
+    lines = "".join(f"alias {pattern} {module}\n" for pattern, module in aliases)
+    return {f"lib/modules/{kernel_release(host_root)}/modules.alias": lines}
+
+
+def add_file(tar: tarfile.TarFile, name: str, content: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(content))
+
+
+def capture_snapshot(archive: Path, host_root: Path = Path("/"), source: Optional[DeviceSource] = None) -> None:
+    files: dict[str, str] = {"proc/cpuinfo": read_first_cpu(host_root.joinpath("proc/cpuinfo"))}
+    for snapshot_file in snapshot_files:
+        if snapshot_file not in files and host_root.joinpath(snapshot_file).exists():
+            files[snapshot_file] = host_root.joinpath(snapshot_file).read_text("utf-8")
+    for pattern in snapshot_globs:
+        for path in sorted(host_root.glob(pattern)):
+            files.setdefault(path.relative_to(host_root).as_posix(), path.read_text("utf-8"))
+
+    block_files, links = block_tree(host_root)
+    files.update(block_files)
+
+    cpuinfo = CpuInfo.parse(files["proc/cpuinfo"].splitlines())
+    devices = capture_devices(source or device_source())
+    files.update(capture_modules_alias(devices, host_root))
+    metadata = {
+        "version": SNAPSHOT_VERSION,
+        "virt": detect_virt(cpuinfo, host_root) or systemd_detect_virt(),
+        "devices": devices,
+        "partitions": [list(part) for part in list_partitions()],
+        "links": links,
+    }
+
+    compression = compressions.get(archive.suffix, "xz")
+    with tarfile.open(archive, f"w:{compression}") as tar:  # type: ignore[call-overload]
+        add_file(tar, "snapshot.json", json.dumps(metadata, separators=(",", ":")).encode())
+        for name, content in files.items():
+            add_file(tar, f"host/{name}", content.encode())
+
+
+def extract_host_files(tar: tarfile.TarFile, host_root: Path) -> None:
+    # only regular files below host/, the archive may come from any machine
+    for member in tar.getmembers():
+        path = PurePosixPath(member.name)
+        if not member.isfile() or path.parts[0] != "host" or ".." in path.parts or path.is_absolute():
+            continue
+        extracted = tar.extractfile(member)
+        if extracted is None:
+            continue
+        target = host_root.joinpath(*path.parts[1:])
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(extracted.read())
+
+
+def write_host_links(links: dict[str, str], host_root: Path) -> None:
+    """the recorded symlinks of /sys, only those inside host_root pointing inside host_root"""
+    root = os.path.normpath(host_root)
+    for name, target in links.items():
+        path = PurePosixPath(name)
+        if path.is_absolute() or ".." in path.parts or os.path.isabs(target):
+            continue
+        link = host_root.joinpath(*path.parts)
+        if os.path.commonpath([root, os.path.normpath(link.parent.joinpath(target))]) != root:
+            continue
+        link.parent.mkdir(parents=True, exist_ok=True)
+        if not os.path.lexists(link):
+            link.symlink_to(target)
+
+
+@contextmanager
+def open_snapshot(archive: Path) -> Iterator[Snapshot]:
+    with tempfile.TemporaryDirectory(prefix="nixos-gen-config-") as tmpdir, tarfile.open(archive, "r:*") as tar:
+        try:
+            snapshot_json = tar.extractfile("snapshot.json")
+        except KeyError:
+            snapshot_json = None
+        if snapshot_json is None:
+            raise ValueError(f"{archive} is not a hardware snapshot")
+        metadata = json.load(snapshot_json)
+        if not isinstance(metadata, dict):
+            raise ValueError(f"{archive} is not a hardware snapshot")
+        if metadata.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"{archive} has snapshot version {metadata.get('version')}, expected {SNAPSHOT_VERSION}")
+
+        host_root = Path(tmpdir)
+        try:
+            snapshot = Snapshot(
+                host_root=host_root,
+                virt=metadata["virt"],
+                devices=metadata["devices"],
+                partitions=[Partition(*part) for part in metadata["partitions"]],
+            )
+        except KeyError as error:
+            raise ValueError(f"{archive} is not a hardware snapshot, snapshot.json has no {error}") from error
+        extract_host_files(tar, host_root)
+        write_host_links(metadata.get("links", {}), host_root)
+        yield snapshot
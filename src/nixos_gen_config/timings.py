@@ -0,0 +1,52 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Union
+
+
+class Timings:
+    """wall times and counters of the hot paths of a run, reported by --timings.
+    recording is a no-op until enabled, sections in other threads may record at the same time"""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.times: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """add the wall time of the with block to name"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.times[name] = self.times.get(name, 0.0) + elapsed
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self, output_format: str = "text") -> str:
+        if output_format == "json":
+            report: dict[str, dict[str, Union[float, int]]] = {
+                "times_ms": {name: round(seconds * 1e3, 3) for name, seconds in self.times.items()},
+                "counters": dict(self.counters),
+            }
+            return json.dumps(report, indent=2)
+        width = max((len(name) for name in [*self.times, *self.counters]), default=0)
+        lines = [f"{name:<{width}} {seconds * 1e3:10.3f}ms" for name, seconds in self.times.items()]
+        lines += [f"{name:<{width}} {value:10d}" for name, value in self.counters.items()]
+        return "\n".join(lines)
+
+
+# the recorder of this process
+timings = Timings()
@@ -0,0 +1,162 @@
+# in-process equivalent of systemd-detect-virt, following the checks and identifiers of systemd's src/basic/virt.c.
+# CPUID isn't available to us so detect_virt returns None when it can't tell and the caller falls back
+# to running systemd-detect-virt
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from nixos_gen_config.timings import timings
+
+if TYPE_CHECKING:
+    from nixos_gen_config.hardware import CpuInfo
+
+# https://github.com/systemd/systemd/blob/main/src/basic/virt.c dmi_vendor_table
+dmi_vendors: dict[str, str] = {
+    "KVM": "kvm",
+    "OpenStack": "kvm",
+    "KubeVirt": "kvm",
+    "Amazon EC2": "amazon",
+    "QEMU": "qemu",
+    "VMware": "vmware",
+    "VMW": "vmware",
+    "innotek GmbH": "oracle",
+    "VirtualBox": "oracle",
+    "Oracle Corporation": "oracle",
+    "Xen": "xen",
+    "Bochs": "bochs",
+    "Parallels": "parallels",
+    "BHYVE": "bhyve",
+    "Hyper-V": "microsoft",
+    "Apple Virtualization": "apple",
+    "Google Compute Engine": "google",
+}
+dmi_files: list[str] = ["product_name", "sys_vendor", "board_vendor", "bios_vendor", "product_version"]
+
+known_containers: list[str] = [
+    "lxc",
+    "lxc-libvirt",
+    "systemd-nspawn",
+    "docker",
+    "podman",
+    "rkt",
+    "wsl",
+    "proot",
+    "pouch",
+]
+
+# the host files detect_virt reads and the paths it only checks the existence of, relative to the host root
+virt_host_files: list[str] = [
+    "proc/sys/kernel/osrelease",
+    "run/host/container-manager",
+    "run/systemd/container",
+    "proc/1/environ",
+    *(f"sys/class/dmi/id/{dmi_file}" for dmi_file in dmi_files),
+    "sys/hypervisor/type",
+    "proc/xen/capabilities",
+    "sys/devices/system/clocksource/clocksource0/available_clocksource",
+]
+virt_host_paths: list[str] = ["proc/vz", "proc/bc", "proc/xen", "run/.containerenv", ".dockerenv"]
+
+
+def read_host_file(host_root: Path, path: str) -> Optional[str]:
+    try:
+        return host_root.joinpath(path.lstrip("/")).read_text("utf-8", errors="replace").strip()
+    except OSError:
+        return None
+
+
+def container_from_string(name: str) -> str:
+    return name if name in known_containers else "container-other"
+
+
+def detect_container(host_root: Path = Path("/")) -> str:
+    if host_root.joinpath("proc/vz").exists() and not host_root.joinpath("proc/bc").exists():
+        return "openvz"
+
+    osrelease = read_host_file(host_root, "/proc/sys/kernel/osrelease") or ""
+    if "Microsoft" in osrelease or "WSL" in osrelease:
+        return "wsl"
+
+    for manager_file in ("/run/host/container-manager", "/run/systemd/container"):
+        if manager := read_host_file(host_root, manager_file):
+            return container_from_string(manager)
+
+    environ = read_host_file(host_root, "/proc/1/environ") or ""
+    for variable in environ.split("\0"):
+        if variable.startswith("container="):
+            return container_from_string(variable[len("container=") :])
+
+    if host_root.joinpath("run/.containerenv").exists():
+        return "podman"
+    if host_root.joinpath(".dockerenv").exists():
+        return "docker"
+    return "none"
+
+
+def detect_vm_dmi(host_root: Path) -> Optional[str]:
+    """vm identifier from the DMI strings, "none" if none matched, None without DMI"""
+    dmi_found = False
+    for dmi_file in dmi_files:
+        value = read_host_file(host_root, f"/sys/class/dmi/id/{dmi_file}")
+        if value is None:
+            continue
+        dmi_found = True
+        for vendor, virt in dmi_vendors.items():
+            if value.startswith(vendor):
+                return virt
+
+    if not dmi_found:
+        return None
+    # Hyper-V shares its vendor with Surface and other bare metal Microsoft machines, systemd tells them apart
+    # with the CPUID vendor which we can't read
+    if read_host_file(host_root, "/sys/class/dmi/id/sys_vendor") == "Microsoft Corporation":
+        if read_host_file(host_root, "/sys/class/dmi/id/product_name") == "Virtual Machine":
+            return "microsoft"
+    return "none"
+
+
+def detect_vm(cpuinfo: "CpuInfo", host_root: Path = Path("/")) -> Optional[str]:
+    dmi = detect_vm_dmi(host_root)
+    if dmi in ("oracle", "xen", "amazon"):
+        return dmi
+
+    if read_host_file(host_root, "/sys/hypervisor/type") == "xen" or host_root.joinpath("proc/xen").exists():
+        # dom0 is the host, not a guest
+        if "control_d" not in (read_host_file(host_root, "/proc/xen/capabilities") or ""):
+            return "xen"
+
+    if dmi == "qemu":
+        # systemd gets kvm from the CPUID vendor when qemu uses kvm acceleration, kvm-clock is only offered there
+        clocksources = read_host_file(host_root, "/sys/devices/system/clocksource/clocksource0/available_clocksource")
+        if "kvm-clock" in (clocksources or "").split():
+            return "kvm"
+    if dmi not in (None, "none"):
+        return dmi
+
+    if cpuinfo.vendor_id == "User Mode Linux":
+        return "uml"
+
+    if "hypervisor" in cpuinfo.flags:
+        # a hypervisor we can only identify through CPUID
+        return None
+    return dmi
+
+
+def detect_virt(cpuinfo: "CpuInfo", host_root: Path = Path("/")) -> Optional[str]:
+    """same identifier systemd-detect-virt would print, None when it can't be decided without it"""
+    container = detect_container(host_root)
+    if container != "none":
+        return container
+    return detect_vm(cpuinfo, host_root)
+
+
+def systemd_detect_virt() -> str:
+    # only needed when detect_virt can't decide
+    import subprocess
+
+    try:
+        with timings.timer("systemd-detect-virt"):
+            virtcmd = subprocess.run(["systemd-detect-virt"], check=True, capture_output=True, text=True)
+    # systemd-detect-virt exits with 1 when virt = none
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return "none"
+    return str(virtcmd.stdout).strip()
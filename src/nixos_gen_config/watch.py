@@ -0,0 +1,150 @@
+# --watch: keep hardware-configuration.nix up to date while devices are hot-added and removed.
+# one process listens for udev events, reruns only the sections reading the subsystems of the events
+# and rewrites the file only when the rendered config changed. udev_section is split into one section per
+# subsystem, so a burst of block events doesn't walk the pci and input devices again
+import sys
+import time
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Optional, Protocol, Sequence
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.hardware import udev_rules
+from nixos_gen_config.sections import Section, run_section, section_name
+from nixos_gen_config.write_config import create_config_dir, write_config_file
+
+if TYPE_CHECKING:
+    import pyudev
+
+# section name -> the udev subsystems whose events change its result. sections not listed only read things that
+# don't change at runtime, like the cpu
+section_subsystems: dict[str, frozenset[str]] = {
+    "udev_section": frozenset(udev_rules),
+    "get_fs": frozenset({"block"}),
+    "initrd_section": frozenset({"block", "input"}),
+}
+
+
+class Monitor(Protocol):
+    def poll(self, timeout: Optional[float] = None) -> Any: ...
+
+
+def split_udev_section(sections: Iterable[Section]) -> list[Section]:
+    """sections with udev_section replaced by one udev_section per subsystem, in the order it merges them"""
+    split: list[Section] = []
+    for section in sections:
+        if section_name(section) == "udev_section":
+            # udev_section and partials of it, which take subsystems
+            udev_section: Callable[..., None] = section
+            split.extend(partial(udev_section, subsystems=(subsystem,)) for subsystem in udev_rules)
+        else:
+            split.append(section)
+    return split
+
+
+def section_watches(section: Section) -> frozenset[str]:
+    """the udev subsystems whose events change the result of section"""
+    if isinstance(section, partial) and "subsystems" in section.keywords:
+        return frozenset(section.keywords["subsystems"])
+    return section_subsystems.get(section_name(section), frozenset())
+
+
+class IncrementalConfig:
+    """the fragment of every section kept between runs, so an event only reruns the sections it affects"""
+
+    def __init__(self, sections: Sequence[Section]) -> None:
+        self.sections = split_udev_section(sections)
+        self.fragments: list[NixConfigAttrs] = [NixConfigAttrs() for _ in self.sections]
+        self.refresh(None)
+
+    def refresh(self, subsystems: Optional[Iterable[str]]) -> list[str]:
+        """rerun the sections reading any of subsystems, all of them for None. returns the names of the rerun ones"""
+        changed = None if subsystems is None else frozenset(subsystems)
+        rerun: list[str] = []
+        for index, section in enumerate(self.sections):
+            name = section_name(section)
+            if changed is not None and not changed & section_watches(section):
+                continue
+            fragment = NixConfigAttrs()
+            run_section(section, fragment)
+            self.fragments[index] = fragment
+            rerun.append(name)
+        return rerun
+
+    def config(self) -> NixConfigAttrs:
+        nix_config = NixConfigAttrs()
+        for fragment in self.fragments:
+            nix_config.merge(fragment)
+        return nix_config
+
+    def render(self) -> str:
+        return generate_hw_config(self.config())
+
+
+def collect_events(monitor: Monitor, debounce: float, max_delay: float) -> set[str]:
+    """block until an event arrives, then keep collecting until debounce seconds pass without one.
+    a burst, like a disk shelf attaching dozens of disks, becomes a single set of subsystems.
+    max_delay bounds how long a never ending burst can hold back the update"""
+    subsystems: set[str] = set()
+    device: Optional["pyudev.Device"] = monitor.poll()
+    deadline = time.monotonic() + max_delay
+    while device is not None:
+        subsystems.add(device.subsystem)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        device = monitor.poll(timeout=min(debounce, remaining))
+    return subsystems
+
+
+def udev_monitor(subsystems: Iterable[str]) -> "pyudev.Monitor":
+    import pyudev
+
+    # events from udev arrive after its rules ran, so the udev database already has the new properties
+    monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+    for subsystem in subsystems:
+        monitor.filter_by(subsystem)
+    monitor.start()
+    return monitor
+
+
+def watched_subsystems(sections: Iterable[Section]) -> set[str]:
+    return {subsystem for section in sections for subsystem in section_watches(section)}
+
+
+def write_if_changed(hw_config: str, config_file: Path) -> None:
+    if write_config_file(config_file, hw_config):
+        print(f"Writing {config_file}", flush=True)
+
+
+def watch(
+    sections: Sequence[Section],
+    config_dir: Path,
+    monitor: Optional[Monitor] = None,
+    debounce: float = 1.0,
+    max_delay: float = 10.0,
+) -> None:
+    """write the hardware configuration and update it on every burst of udev events until interrupted"""
+    create_config_dir(config_dir)
+    config_file = config_dir.joinpath("hardware-configuration.nix")
+    incremental = IncrementalConfig(sections)
+    write_if_changed(incremental.render(), config_file)
+
+    if monitor is None:
+        try:
+            monitor = udev_monitor(sorted(watched_subsystems(sections)))
+        except (ImportError, OSError) as error:
+            print(f"Listening for udev events failed: {error}")
+            sys.exit(1)
+
+    try:
+        while True:
+            subsystems = collect_events(monitor, debounce, max_delay)
+            if not subsystems:
+                # the monitor is gone
+                return
+            if incremental.refresh(subsystems):
+                write_if_changed(incremental.render(), config_file)
+    except KeyboardInterrupt:
+        pass
@@ -1,8 +1,10 @@
+import hashlib
+import os
 import sys
+import tempfile
 from pathlib import Path
 
 from nixos_gen_config.classes import NixConfigAttrs
-from nixos_gen_config.generate_hw_config import generate_hw_config
 from nixos_gen_config.generate_nixos_config import generate_nixos_config
 
 
@@ -17,13 +19,56 @@ def create_config_dir(config_dir: Path) -> None:
         sys.exit(1)
 
 
-def write_hw_config(nix_hw_config: NixConfigAttrs, config_dir: Path) -> None:
+def file_sha256(path: Path) -> str:
+    """sha256 of the file, empty if it can't be read"""
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+def write_config_file(config_file: Path, content: str) -> bool:
+    """replace config_file with content atomically, returns False without touching it when it already has content.
+    the content goes to a temporary file next to it which is synced and then renamed over config_file,
+    so a crash leaves either the old or the new file and never a partial one"""
+    data = content.encode("utf-8")
+    if file_sha256(config_file) == hashlib.sha256(data).hexdigest():
+        return False
+
+    try:
+        mode = config_file.stat().st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o644
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{config_file.name}.", dir=config_file.parent)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fchmod(tmp_file.fileno(), mode)
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_name, config_file)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+    # the rename itself is only durable once the directory is synced
+    dir_fd = os.open(config_file.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return True
+
+
+def write_hw_config(hw_config: str, config_dir: Path) -> None:
     create_config_dir(config_dir)
     config_file: Path = Path(f"{config_dir}/hardware-configuration.nix")
-    print(f"Writing {config_file}")
     try:
-        with open(config_file, "w", encoding="utf-8") as t_f:
-            t_f.write(generate_hw_config(nix_hw_config))
+        if write_config_file(config_file, hw_config):
+            print(f"Writing {config_file}")
+        else:
+            print(f"{config_file} is up to date")
     except PermissionError:
         print(f"Creation of {config_file} failed due to a permission error. run script as root.")
         sys.exit(1)
@@ -0,0 +1,160 @@
+"""times every stage of a run on synthetic machines of growing size and prints the results as JSON.
+
+    PYTHONPATH=src python -m tests.benchmark_suite [--quick] [--output results.json]
+
+every result is the best average of a few repeats, compare runs on the same machine only"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import timeit
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.hardware import cpu_section, udev_section
+from nixos_gen_config.partitions import BlockDeviceIndex, Partition, get_fs, get_stable_device_path
+from nixos_gen_config.write_config import write_config_file
+
+DEVICE_SCALES = [10, 100, 1_000, 10_000]
+MOUNT_SCALES = [10, 1_000, 10_000, 100_000]
+CPU_SCALES = [1, 8, 64, 512]
+QUICK_SCALES = {"devices": [10, 100], "mounts": [10, 100], "cpus": [1, 8]}
+
+Stage = Callable[[], Any]
+
+
+def synthetic_devices(count: int) -> list[dict[str, str]]:
+    """udev devices spread over the pci, block and input subsystems, a third of them matched by a rule"""
+    devices: list[dict[str, str]] = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            device = {"SUBSYSTEM": "pci", "PCI_CLASS": "20000", "PCI_ID": f"8086:{i % 0xFFFF:04X}", "DRIVER": f"drv{i}"}
+            if i % 9 == 0:
+                device.update(PCI_CLASS="C0330", DRIVER="xhci_hcd")
+        elif kind == 1:
+            device = {"SUBSYSTEM": "block", "ID_FS_TYPE": "bcache" if i % 7 == 1 else "ext4"}
+        else:
+            device = {"SUBSYSTEM": "input", "ID_INPUT_KEYBOARD": "1", "ID_USB_DRIVER": f"usbhid{i % 5}"}
+        devices.append(device)
+    return devices
+
+
+def synthetic_block_devices(count: int) -> list[dict[str, str]]:
+    return [
+        {"DEVNAME": f"/dev/vd{i}", "MAJOR": "254", "MINOR": str(i), "ID_FS_UUID": f"{i:08x}-0000-4000-8000-{i:012x}"}
+        for i in range(count)
+    ]
+
+
+def synthetic_partitions(count: int) -> list[Partition]:
+    # every other mount is below a special filesystem and filtered out
+    return [
+        Partition(f"/dev/vd{i}", f"/srv/{i}" if i % 2 == 0 else f"/run/user/{i}", "ext4", f"254:{i}")
+        for i in range(count)
+    ]
+
+
+def synthetic_cpuinfo(cpus: int) -> str:
+    flags = "fpu vme de pse tsc msr pae mce cx8 apic sep mtrr pge mca cmov pat pse36 clflush mmx fxsr sse sse2 svm"
+    block = "processor\t: {i}\nvendor_id\t: AuthenticAMD\nmodel name\t: AMD EPYC 7742 64-Core Processor\n"
+    return "".join(f"{block.format(i=i)}flags\t\t: {flags}\n\n" for i in range(cpus))
+
+
+def best_time(stage: Stage, repeat: int = 3) -> float:
+    """best average seconds per call, the number of calls is picked so a repeat takes about 0.1s"""
+    timer = timeit.Timer(stage)
+    number, _ = timer.autorange()
+    number = max(1, number // 2)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run_fresh(section: Callable[..., None], *args: Any, **kwargs: Any) -> None:
+    """run section into a new config, like every run does"""
+    section(NixConfigAttrs(), *args, **kwargs)
+
+
+def stable_device_paths(block_index: BlockDeviceIndex, partitions: list[Partition]) -> list[str]:
+    return [get_stable_device_path(block_index, part.device) for part in partitions]
+
+
+def config_of(scale: int) -> NixConfigAttrs:
+    """a config with about as many entries as a machine of scale devices and mounts produces"""
+    nix_config = NixConfigAttrs()
+    udev_section(nix_config, synthetic_devices(scale))
+    get_fs(
+        nix_config,
+        Path("/"),
+        block_index=BlockDeviceIndex(synthetic_block_devices(scale)),
+        partitions=synthetic_partitions(scale),
+    )
+    return nix_config
+
+
+def stages(scales: dict[str, list[int]], tmp_dir: Path) -> Iterator[tuple[str, int, Stage]]:
+    for scale in scales["devices"]:
+        yield "udev_section", scale, partial(run_fresh, udev_section, synthetic_devices(scale))
+
+    for scale in scales["mounts"]:
+        block_index = BlockDeviceIndex(synthetic_block_devices(scale))
+        partitions = synthetic_partitions(scale)
+        yield "get_fs", scale, partial(run_fresh, get_fs, Path("/"), block_index=block_index, partitions=partitions)
+        yield "get_stable_device_path", scale, partial(stable_device_paths, block_index, partitions)
+
+    for cpus in scales["cpus"]:
+        host_root = tmp_dir.joinpath(f"cpus-{cpus}")
+        host_root.joinpath("proc").mkdir(parents=True)
+        host_root.joinpath("proc", "cpuinfo").write_text(synthetic_cpuinfo(cpus), "utf-8")
+        yield "cpu_section", cpus, partial(run_fresh, cpu_section, host_root=host_root)
+
+    for scale in scales["mounts"]:
+        nix_config = config_of(scale)
+        hw_config = generate_hw_config(nix_config)
+        config_file = tmp_dir.joinpath(f"hardware-configuration-{scale}.nix")
+        yield "generate_hw_config", scale, partial(generate_hw_config, nix_config)
+
+        def write_changed(config_file: Path = config_file, hw_config: str = hw_config) -> None:
+            config_file.unlink(missing_ok=True)
+            write_config_file(config_file, hw_config)
+
+        yield "write_config", scale, write_changed
+        write_config_file(config_file, hw_config)
+        yield "write_config_unchanged", scale, partial(write_config_file, config_file, hw_config)
+
+
+def run_suite(scales: dict[str, list[int]], repeat: int = 3) -> dict[str, Any]:
+    results: list[dict[str, Any]] = []
+    with tempfile.TemporaryDirectory(prefix="nixos-gen-config-bench-") as tmpdir:
+        for stage, scale, func in stages(scales, Path(tmpdir)):
+            seconds = best_time(func, repeat)
+            results.append({"stage": stage, "scale": scale, "seconds": seconds})
+            print(f"{stage:>24} {scale:>7}: {seconds * 1e3:10.3f}ms", file=sys.stderr, flush=True)
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="only the two smallest scales of every stage")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    scales = QUICK_SCALES if args.quick else {"devices": DEVICE_SCALES, "mounts": MOUNT_SCALES, "cpus": CPU_SCALES}
+    report = json.dumps(run_suite(scales, args.repeat), indent=2)
+    if args.output:
+        args.output.write_text(report + "\n", "utf-8")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
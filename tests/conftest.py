@@ -1,8 +1,10 @@
 # pylint: disable=invalid-name
 # ^ pyudev names ID_VENDOR_ID etc
+import os
+import timeit
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Type
+from typing import Any, Callable, Type
 
 import pytest
 import pyudev
@@ -14,13 +16,14 @@ TEST_ROOT = Path(__file__).parent.resolve()
 class FakeDevice:
     ID_VENDOR_ID: str = ""
     ID_MODEL_ID: str = ""
-    ID_MODEL_FROM_DATABASE: str = ""
     ID_FS_TYPE: str = ""
-    ID_PCI_CLASS_FROM_DATABASE: str = ""
-    ID_PCI_SUBCLASS_FROM_DATABASE: str = ""
+    PCI_ID: str = ""
+    PCI_CLASS: str = ""
+    MODALIAS: str = ""
     DRIVER: str = ""
     ID_INPUT_KEYBOARD: str = ""
     ID_USB_DRIVER: str = ""
+    SUBSYSTEM: str = ""
 
     def get(self, attribute: str) -> pyudev.Attributes:
         return getattr(self, attribute)
@@ -35,6 +38,47 @@ class Helpers:
     def read_asset(asset: str) -> str:
         return str(Path(TEST_ROOT.joinpath("assets", asset)).read_text("utf-8"))
 
+    @staticmethod
+    def make_host(host_root: Path, files: dict[str, str]) -> Path:
+        """write files, given relative to the host root, below host_root"""
+        for name, content in files.items():
+            host_root.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+            host_root.joinpath(name).write_text(content, "utf-8")
+        return host_root
+
+    @staticmethod
+    def benchmarks() -> bool:
+        """whether to time implementations against each other. wall clock comparisons flake on loaded machines,
+        they only run with NIXOS_GEN_CONFIG_BENCHMARKS=1"""
+        return os.environ.get("NIXOS_GEN_CONFIG_BENCHMARKS", "") not in ("", "0")
+
+    @staticmethod
+    def best_time(func: Callable[[], Any], number: int = 20, repeat: int = 5) -> float:
+        """best average seconds per call of func"""
+        return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+    @staticmethod
+    def synthetic_modules_alias(lines: int) -> str:
+        """a modules.alias shaped like the one of a distribution kernel, about 30k lines there.
+        starts with the real aliases of tests/assets/modules.alias"""
+        aliases: list[str] = [Helpers.read_asset("modules.alias")]
+        for i in range(lines):
+            kind = i % 10
+            if kind < 5:
+                pattern = f"pci:v0000{0x1000 + i % 700:04X}d0000{i:04X}sv*sd*bc*sc*i*"
+            elif kind == 5:
+                pattern = f"pci:v0000{0x1000 + i % 700:04X}d0000{i:04X}sv0000{i % 97:04X}sd0000{i % 31:04X}bc*sc*i*"
+            elif kind == 6:
+                pattern = f"usb:v{i % 3000:04X}p{i:04X}d*dc*dsc*dp*ic*isc*ip*in*"
+            elif kind == 7:
+                pattern = f"acpi*:INT{i:04X}:*"
+            elif kind == 8:
+                pattern = f"of:N*T*Cvendor{i % 50},device{i}*"
+            else:
+                pattern = f"hid:b0003g*v0000{i % 3000:04X}p0000{i:04X}"
+            aliases.append(f"alias {pattern} synthetic_{i % 4000}\n")
+        return "".join(aliases)
+
 
 @pytest.fixture
 def helpers() -> Type[Helpers]:
@@ -0,0 +1,48 @@
+from pathlib import Path
+
+import pytest
+
+from nixos_gen_config.batch import host_name, run_batch
+
+from .test_snapshot import EXPECTED, write_snapshot
+
+
+def test_host_name() -> None:
+    assert host_name(Path("web-01.example.com.tar.xz")) == "web-01.example.com"
+    assert host_name(Path("db01.tar")) == "db01"
+
+
+def test_run_batch(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    snapshot_dir = tmp_path.joinpath("snapshots")
+    snapshot_dir.mkdir()
+    for host in ("host1", "host2", "host3"):
+        write_snapshot(snapshot_dir.joinpath(f"{host}.tar.xz"), {})
+    snapshot_dir.joinpath("broken.tar.xz").write_text("not a tarball", "utf-8")
+    snapshot_dir.joinpath("notes.txt").write_text("ignored", "utf-8")
+    out_dir = tmp_path.joinpath("out")
+
+    failed = run_batch(snapshot_dir, out_dir, Path("/"), no_filesystems=False, workers=2)
+
+    assert failed == 1
+    for host in ("host1", "host2", "host3"):
+        assert out_dir.joinpath(host, "hardware-configuration.nix").read_text("utf-8") == EXPECTED
+    assert not out_dir.joinpath("broken").exists()
+    captured = capsys.readouterr()
+    assert captured.out.count("/4] host") == 3
+    assert "broken: failed" in captured.err
+
+
+def test_run_batch_cpu_profile(tmp_path: Path, capfd: pytest.CaptureFixture[str]) -> None:
+    snapshot_dir = tmp_path.joinpath("snapshots")
+    snapshot_dir.mkdir()
+    write_snapshot(snapshot_dir.joinpath("host1.tar.xz"), {})
+    out_dir = tmp_path.joinpath("out")
+
+    failed = run_batch(
+        snapshot_dir, out_dir, Path("/"), no_filesystems=True, workers=1, cpu_profile="throughput", memory_tuning=True
+    )
+    assert failed == 0
+    hw_config = out_dir.joinpath("host1", "hardware-configuration.nix").read_text("utf-8")
+    assert 'powerManagement.cpuFreqGovernor = lib.mkDefault "performance";' in hw_config
+    # the worker reports the topology of the snapshot, which has no numa nodes
+    assert "host1: Memory: 0 numa nodes (), huge page sizes none" in capfd.readouterr().err
@@ -0,0 +1,18 @@
+import json
+
+from .benchmark_suite import run_suite
+
+
+def test_benchmark_suite_smoke() -> None:
+    report = run_suite({"devices": [10], "mounts": [10], "cpus": [2]}, repeat=1)
+    results = json.loads(json.dumps(report))["results"]
+    assert {result["stage"] for result in results} == {
+        "udev_section",
+        "get_fs",
+        "get_stable_device_path",
+        "cpu_section",
+        "generate_hw_config",
+        "write_config",
+        "write_config_unchanged",
+    }
+    assert all(result["seconds"] > 0 for result in results)
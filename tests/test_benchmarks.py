@@ -0,0 +1,261 @@
+from pathlib import Path
+from unittest.mock import patch
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.devices import PyudevSource, SysfsSource, have_libudev
+from nixos_gen_config.hardware import CpuInfo, udev_properties, udev_rules
+from nixos_gen_config.modalias import AliasIndex, parse_modules_alias
+from nixos_gen_config.partitions import block_index_properties, iter_mountinfo, special_fs
+
+from .conftest import Helpers
+
+
+def legacy_cpu_info(path: Path, field: str) -> str:
+    """the per-field parser CpuInfo replaced, kept to benchmark against"""
+    cpudata: dict[str, str] = {}
+    cpuinfo: list[str] = [s for s in (path.read_text("utf-8")).splitlines() if s]
+    for line in cpuinfo:
+        left, right = line.split(":")
+        cpudata[left.strip()] = right.strip()
+    return cpudata[field]
+
+
+def test_bench_cpuinfo() -> None:
+    path = Helpers.root().joinpath("assets", "cpu_info_epyc_256")
+
+    def legacy() -> None:
+        # cpu_section used to look up vendor_id up to twice and flags twice
+        for field in ("vendor_id", "vendor_id", "flags", "flags"):
+            legacy_cpu_info(path, field)
+
+    def snapshot() -> None:
+        cpuinfo = CpuInfo.read(path)
+        for field in ("vendor_id", "vendor_id"):
+            cpuinfo.get(field)
+        assert "svm" in cpuinfo.flags and "vmx" not in cpuinfo.flags
+
+    cpuinfo = CpuInfo.read(path)
+    assert cpuinfo.vendor_id == legacy_cpu_info(path, "vendor_id")
+    assert cpuinfo.flags == frozenset(legacy_cpu_info(path, "flags").split())
+    if not Helpers.benchmarks():
+        return
+    legacy_time = Helpers.best_time(legacy, number=5)
+    snapshot_time = Helpers.best_time(snapshot, number=5)
+    print(f"cpuinfo 256 threads: legacy {legacy_time * 1e3:.3f}ms snapshot {snapshot_time * 1e3:.3f}ms")
+    assert snapshot_time < legacy_time
+
+
+def synthetic_mountinfo(lines: int) -> tuple[str, str]:
+    """a kubernetes node like mount table as (mountinfo, mounts) with lines entries"""
+    mountinfo: list[str] = ["22 1 259:2 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p2 rw\n"]
+    mounts: list[str] = ["/dev/nvme0n1p2 / ext4 rw 0 0\n"]
+    for i in range(1, lines):
+        kind = i % 4
+        if kind == 0:
+            mountpoint, fstype, source = (
+                f"/run/containerd/io.containerd.runtime.v2.task/k8s.io/{i:064x}/rootfs",
+                "overlay",
+                "overlay",
+            )
+        elif kind == 1:
+            mountpoint, fstype, source = f"/run/netns/cni-{i:08x}", "nsfs", "nsfs"
+        elif kind == 2:
+            mountpoint = (
+                f"/var/lib/kubelet/pods/{i:032x}/volumes/kubernetes.io~projected/kube-api-access-{i % 99999:05d}"
+            )
+            fstype, source = "tmpfs", "tmpfs"
+        else:
+            mountpoint, fstype, source = (
+                f"/var/lib/kubelet/pods/{i:032x}/volume-subpaths/config/app/0",
+                "ext4",
+                "/dev/nvme0n1p2",
+            )
+        mountinfo.append(f"{i + 22} 22 0:{i + 40} / {mountpoint} rw,relatime shared:{i} - {fstype} {source} rw\n")
+        mounts.append(f"{source} {mountpoint} {fstype} rw,relatime 0 0\n")
+    return "".join(mountinfo), "".join(mounts)
+
+
+def legacy_get_mounts(root_dir: Path) -> list[str]:
+    """the psutil based filtering get_fs used before iter_mountinfo, kept to benchmark against"""
+    import psutil
+
+    kept: list[str] = []
+    for part in psutil.disk_partitions(all=True):
+        if not part.mountpoint.startswith(str(root_dir)):
+            continue
+        if [x for x in special_fs if x in part.mountpoint]:
+            continue
+        kept.append(part.mountpoint)
+    return kept
+
+
+def test_bench_mountinfo(tmp_path: Path) -> None:
+    import psutil
+
+    mountinfo, mounts = synthetic_mountinfo(100_000)
+    tmp_path.joinpath("self").mkdir()
+    tmp_path.joinpath("self", "mountinfo").write_text(mountinfo, "utf-8")
+    tmp_path.joinpath("self", "mounts").write_text(mounts, "utf-8")
+    root_dir = Path("/")
+
+    def streaming() -> list[str]:
+        return [mount.mountpoint for mount in iter_mountinfo(root_dir, tmp_path.joinpath("self", "mountinfo"))]
+
+    with patch.object(psutil, "PROCFS_PATH", str(tmp_path)):
+        assert streaming() == legacy_get_mounts(root_dir)
+        if not Helpers.benchmarks():
+            return
+        legacy_time = Helpers.best_time(lambda: legacy_get_mounts(root_dir), number=1, repeat=3)
+
+    streaming_time = Helpers.best_time(streaming, number=1, repeat=3)
+    print(f"mountinfo 100k lines: psutil {legacy_time * 1e3:.1f}ms streaming {streaming_time * 1e3:.1f}ms")
+    assert streaming_time < legacy_time
+
+
+def legacy_uniq(list1: list[str]) -> list[str]:
+    """the list membership uniq NixConfigAttrs relied on before OrderedSet, kept to benchmark against"""
+    uniq_list: list[str] = []
+    for item in list1:
+        if item not in uniq_list:
+            uniq_list.append(item)
+    return uniq_list
+
+
+def test_bench_nixconfigattrs() -> None:
+    # a few thousand modules and attrs, each reported by several detectors
+    modules = [f"module_{i % 3000}" for i in range(9000)]
+    attrs = [f"option{i % 2000}.enable = true;" for i in range(6000)]
+
+    def legacy() -> tuple[list[str], list[str]]:
+        fragments = [(modules[i::3], attrs[i::3]) for i in range(3)]
+        merged_modules: list[str] = []
+        merged_attrs: list[str] = []
+        for fragment_modules, fragment_attrs in fragments:
+            merged_modules.extend(fragment_modules)
+            merged_attrs.extend(fragment_attrs)
+        # get_string and generate_hw_config deduplicated on every render
+        return legacy_uniq(merged_modules), legacy_uniq(merged_attrs)
+
+    def ordered_set() -> tuple[list[str], list[str]]:
+        nix_config = NixConfigAttrs()
+        for i in range(3):
+            nix_config.merge(NixConfigAttrs(kernel_modules=modules[i::3], attrs=attrs[i::3]))
+        return list(nix_config.kernel_modules), list(nix_config.attrs)
+
+    assert ordered_set() == legacy()
+    if not Helpers.benchmarks():
+        return
+    legacy_time = Helpers.best_time(legacy, number=1, repeat=3)
+    ordered_set_time = Helpers.best_time(ordered_set, number=1, repeat=3)
+    print(f"NixConfigAttrs 15k values: lists {legacy_time * 1e3:.1f}ms ordered sets {ordered_set_time * 1e3:.1f}ms")
+    assert ordered_set_time < legacy_time
+
+
+def test_bench_modalias() -> None:
+    import re
+    from fnmatch import translate
+
+    aliases = list(parse_modules_alias(Helpers.synthetic_modules_alias(30_000).splitlines()))
+    # every pattern compiled up front, which favours the linear scan
+    compiled = [(re.compile(translate(pattern)).match, module) for pattern, module in aliases]
+    devices = [f"pci:v0000{0x1000 + i % 700:04X}d0000{i * 7:04X}sv00000000sd00000000bc02sc00i00" for i in range(20)]
+    devices += [
+        "pci:v00008086d0000A36Dsv00001028sd0000085Cbc0Csc03i30",
+        "usb:v046DpC52Bd2410dc00dsc00dp00ic03isc01ip01in00",
+    ]
+
+    def linear() -> list[list[str]]:
+        return [list(dict.fromkeys(module for match, module in compiled if match(device))) for device in devices]
+
+    index = AliasIndex.build(aliases)
+
+    def indexed() -> list[list[str]]:
+        return [index.modules(device) for device in devices]
+
+    assert [set(modules) for modules in indexed()] == [set(modules) for modules in linear()]
+    if not Helpers.benchmarks():
+        return
+    linear_time = Helpers.best_time(linear, number=1, repeat=3)
+    indexed_time = Helpers.best_time(indexed, number=5, repeat=3)
+    build_time = Helpers.best_time(lambda: AliasIndex.build(aliases), number=1, repeat=3)
+    print(
+        f"modalias 22 devices, 30k aliases: linear {linear_time * 1e3:.1f}ms "
+        f"indexed {indexed_time * 1e3:.3f}ms (index build {build_time * 1e3:.1f}ms)"
+    )
+    assert indexed_time < linear_time
+
+
+def synthetic_sysfs(host_root: Path, devices: int) -> Path:
+    """a sysfs tree and udev database with devices spread over pci, block and input"""
+    files: dict[str, str] = {}
+    for i in range(devices):
+        kind = i % 3
+        if kind == 0:
+            name = f"0000:{i // 256 % 256:02x}:{i % 32:02x}.{i % 8}"
+            files[f"sys/bus/pci/devices/{name}/uevent"] = (
+                f"DRIVER=drv{i % 40}\nPCI_CLASS=C0330\nPCI_ID=8086:{i % 0xFFFF:04X}\nPCI_SUBSYS_ID=1028:085C\n"
+                f"PCI_SLOT_NAME={name}\nMODALIAS=pci:v00008086d0000{i % 0xFFFF:04X}sv00001028sd0000085Cbc0Csc03i30\n"
+            )
+            files[f"run/udev/data/+pci:{name}"] = "E:ID_PCI_CLASS_FROM_DATABASE=Serial bus controller\n"
+        elif kind == 1:
+            files[f"sys/class/block/vd{i}/uevent"] = f"MAJOR=254\nMINOR={i}\nDEVNAME=vd{i}\nDEVTYPE=disk\nDISKSEQ={i}\n"
+            files[f"run/udev/data/b254:{i}"] = (
+                f"S:disk/by-uuid/{i:08x}\nI:{i}\nE:ID_FS_UUID={i:08x}\nE:ID_FS_TYPE=ext4\nE:ID_FS_USAGE=filesystem\n"
+            )
+        else:
+            # the inputN parents are on the bus, their eventN nodes only in the class
+            files[f"sys/bus/input/devices/input{i}/uevent"] = f'PRODUCT=3/46d/c52b/111\nNAME="keyboard {i}"\n'
+            files[f"run/udev/data/+input:input{i}"] = "E:ID_INPUT=1\nE:ID_INPUT_KEYBOARD=1\nE:ID_USB_DRIVER=usbhid\n"
+            files[f"sys/class/input/event{i}/uevent"] = f"MAJOR=13\nMINOR={i}\nDEVNAME=input/event{i}\n"
+            files[f"run/udev/data/c13:{i}"] = "E:ID_INPUT=1\nE:ID_INPUT_KEYBOARD=1\nE:ID_USB_DRIVER=usbhid\n"
+    return Helpers.make_host(host_root, files)
+
+
+def device_names(host_root: Path, wanted: dict[str, set[str]]) -> set[tuple[str, str]]:
+    """(subsystem, sys_name) of the devices SysfsSource reads"""
+    source = SysfsSource(host_root)
+    return {(subsystem, device_dir.name) for subsystem in wanted for device_dir in source.device_dirs(subsystem)}
+
+
+def test_bench_device_sources(tmp_path: Path) -> None:
+    wanted = {subsystem: udev_properties(subsystem) for subsystem in udev_rules}
+    wanted["block"] |= set(block_index_properties)
+
+    host_root = synthetic_sysfs(tmp_path, 3000)
+    names = device_names(host_root, wanted)
+    assert ("input", "input2") in names and ("input", "event2") in names
+    class_names = {(path.parts[-3], path.parts[-2]) for path in host_root.glob("sys/class/*/*/uevent")}
+    bus_names = {(path.parts[-4], path.parts[-2]) for path in host_root.glob("sys/bus/*/devices/*/uevent")}
+    assert names == class_names | bus_names
+
+    # libudev can't be pointed at another sysfs, so the backends are compared on the machine the tests run on
+    def pyudev_source() -> list[dict[str, str]]:
+        return [
+            {prop: str(value) for prop in wanted[device.subsystem] if (value := device.properties.get(prop))}
+            for device in PyudevSource().devices(wanted)
+        ]
+
+    def sysfs_source() -> list[dict[str, str]]:
+        return list(SysfsSource().devices(wanted))
+
+    def key(device: dict[str, str]) -> tuple[tuple[str, str], ...]:
+        return tuple(sorted(device.items()))
+
+    if have_libudev():
+        assert {(device.subsystem, device.sys_name) for device in PyudevSource().devices(wanted)} == device_names(
+            Path("/"), wanted
+        )
+        assert sorted(map(key, sysfs_source())) == sorted(map(key, pyudev_source()))
+    if not Helpers.benchmarks():
+        return
+
+    synthetic_time = Helpers.best_time(lambda: list(SysfsSource(host_root).devices(wanted)), number=1, repeat=3)
+    print(f"device sources synthetic 3000 devices: sysfs {synthetic_time * 1e3:.1f}ms")
+    if not have_libudev():
+        return
+    pyudev_time = Helpers.best_time(pyudev_source, number=5, repeat=3)
+    sysfs_time = Helpers.best_time(sysfs_source, number=5, repeat=3)
+    print(
+        f"device sources {len(sysfs_source())} local devices: pyudev {pyudev_time * 1e3:.2f}ms sysfs {sysfs_time * 1e3:.2f}ms"
+    )
+    assert sysfs_time < pyudev_time
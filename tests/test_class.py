@@ -1,3 +1,5 @@
+import pytest
+
 from nixos_gen_config.classes import NixConfigAttrs
 
 
@@ -18,3 +20,31 @@ def test_nixconfigattrs_get_str() -> None:
 def test_nixconfigattrs_get_str_empty() -> None:
     nix_hw_config = NixConfigAttrs()
     assert nix_hw_config.get_string("attrs") == ""
+
+
+def test_nixconfigattrs_merge() -> None:
+    nix_hw_config = NixConfigAttrs(kernel_modules=["kvm-amd"])
+    nix_hw_config.merge(NixConfigAttrs(kernel_modules=["wl"], imports=["./extra.nix"]))
+    assert nix_hw_config.kernel_modules == ["kvm-amd", "wl"]
+    assert nix_hw_config.imports == ["./extra.nix"]
+
+
+def test_nixconfigattrs_dedup_on_insert() -> None:
+    nix_hw_config = NixConfigAttrs()
+    nix_hw_config.kernel_modules.append("kvm-amd")
+    nix_hw_config.kernel_modules.extend(["wl", "kvm-amd", "wl"])
+    nix_hw_config.kernel_modules.append("kvm-amd")
+    assert nix_hw_config.kernel_modules == ["kvm-amd", "wl"]
+    assert len(nix_hw_config.kernel_modules) == 2
+
+
+def test_nixconfigattrs_merge_keeps_first_position() -> None:
+    nix_hw_config = NixConfigAttrs(initrd_available_kernel_modules=["nvme", "xhci_pci"])
+    nix_hw_config.merge(NixConfigAttrs(initrd_available_kernel_modules=["usbhid", "nvme"]))
+    assert nix_hw_config.initrd_available_kernel_modules == ["nvme", "xhci_pci", "usbhid"]
+
+
+def test_nixconfigattrs_slots() -> None:
+    nix_hw_config = NixConfigAttrs()
+    with pytest.raises(AttributeError):
+        nix_hw_config.kernel_module = ["typo"]  # type: ignore[attr-defined]
@@ -0,0 +1,120 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from nixos_gen_config import collector
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.devices import PyudevSource, SysfsSource, device_source, have_libudev
+from nixos_gen_config.hardware import udev_properties, udev_rules, udev_section
+from nixos_gen_config.partitions import BlockDeviceIndex, block_index_properties
+
+from .conftest import Helpers
+
+SYSFS = {
+    "sys/bus/pci/devices/0000:00:14.0/uevent": (
+        "DRIVER=xhci_hcd\nPCI_CLASS=C0330\nPCI_ID=8086:A36D\nPCI_SUBSYS_ID=1028:085C\n"
+        "PCI_SLOT_NAME=0000:00:14.0\nMODALIAS=pci:v00008086d0000A36Dsv00001028sd0000085Cbc0Csc03i30\n"
+    ),
+    "sys/bus/pci/devices/0000:00:14.0/modalias": "pci:v00008086d0000A36Dsv00001028sd0000085Cbc0Csc03i30\n",
+    "sys/bus/pci/devices/0000:01:00.0/uevent": (
+        "DRIVER=nvme\nPCI_CLASS=10802\nPCI_ID=144D:A808\nMODALIAS=pci:v0000144Dd0000A808sv0000144Dsd0000A801bc01sc08i02\n"
+    ),
+    "run/udev/data/+pci:0000:01:00.0": "E:ID_PCI_CLASS_FROM_DATABASE=Mass storage controller\n",
+    "sys/class/block/nvme0n1p1/uevent": "MAJOR=259\nMINOR=1\nDEVNAME=nvme0n1p1\nDEVTYPE=partition\nPARTN=1\n",
+    "run/udev/data/b259:1": (
+        "S:disk/by-uuid/6C1F-2A0B\nI:12345\nE:ID_FS_UUID=6C1F-2A0B\nE:ID_FS_TYPE=vfat\n"
+        "E:ID_PART_ENTRY_UUID=0a1b2c3d-01\nG:systemd\n"
+    ),
+    "sys/class/block/loop0/uevent": "MAJOR=7\nMINOR=0\nDEVNAME=loop0\nDEVTYPE=disk\n",
+    "sys/class/input/input3/uevent": 'PRODUCT=3/46d/c52b/111\nNAME="Logitech USB Receiver"\n',
+    "run/udev/data/+input:input3": "E:ID_INPUT=1\nE:ID_INPUT_KEYBOARD=1\nE:ID_USB_DRIVER=usbhid\n",
+    "sys/class/input/event3/uevent": "MAJOR=13\nMINOR=67\nDEVNAME=input/event3\n",
+    "run/udev/data/c13:67": "E:ID_INPUT_KEYBOARD=1\nE:ID_USB_DRIVER=usbhid\n",
+}
+
+
+def test_sysfs_source(tmp_path: Path) -> None:
+    source = SysfsSource(Helpers.make_host(tmp_path, SYSFS))
+    devices = list(source.devices({"pci": ["PCI_CLASS", "DRIVER"], "block": block_index_properties}))
+    assert devices == [
+        {"PCI_CLASS": "C0330", "DRIVER": "xhci_hcd", "SUBSYSTEM": "pci"},
+        {"PCI_CLASS": "10802", "DRIVER": "nvme", "SUBSYSTEM": "pci"},
+        {"MAJOR": "7", "MINOR": "0", "DEVNAME": "/dev/loop0", "SUBSYSTEM": "block"},
+        {
+            "MAJOR": "259",
+            "MINOR": "1",
+            "DEVNAME": "/dev/nvme0n1p1",
+            "ID_FS_UUID": "6C1F-2A0B",
+            "ID_PART_ENTRY_UUID": "0a1b2c3d-01",
+            "SUBSYSTEM": "block",
+        },
+    ]
+
+
+def test_sysfs_source_udev_section(tmp_path: Path) -> None:
+    host_root = Helpers.make_host(tmp_path, SYSFS)
+    nix_hw_config = NixConfigAttrs()
+    udev_section(nix_hw_config, host_root=host_root, source=SysfsSource(host_root))
+    assert nix_hw_config.initrd_available_kernel_modules == ["xhci_pci", "nvme", "usbhid"]
+
+    block_index = BlockDeviceIndex.from_source(SysfsSource(host_root))
+    assert block_index.by_devnum["259:1"].uuid == "6C1F-2A0B"
+
+
+# input3 is on the bus and in the class, event3 only in the class, both link to sys/devices like on a real host
+LINKED_INPUT = {
+    "sys/devices/usb1/input/input3/uevent": SYSFS["sys/class/input/input3/uevent"],
+    "sys/devices/usb1/input/input3/event3/uevent": SYSFS["sys/class/input/event3/uevent"],
+    "run/udev/data/+input:input3": SYSFS["run/udev/data/+input:input3"],
+    "run/udev/data/c13:67": SYSFS["run/udev/data/c13:67"],
+}
+
+
+def make_linked_input(tmp_path: Path) -> Path:
+    host_root = Helpers.make_host(tmp_path, LINKED_INPUT)
+    for link, target in (
+        ("sys/bus/input/devices/input3", "sys/devices/usb1/input/input3"),
+        ("sys/class/input/input3", "sys/devices/usb1/input/input3"),
+        ("sys/class/input/event3", "sys/devices/usb1/input/input3/event3"),
+    ):
+        path = host_root.joinpath(link)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.symlink_to(os.path.relpath(host_root.joinpath(target), path.parent))
+    return host_root
+
+
+def test_sysfs_source_bus_and_class(tmp_path: Path) -> None:
+    host_root = make_linked_input(tmp_path)
+    names = [device_dir.name for device_dir in SysfsSource(host_root).device_dirs("input")]
+    assert names == ["input3", "event3"]
+    assert [Path(device_dir).name for device_dir in collector.device_dirs(str(host_root), "input")] == names
+
+    nix_hw_config = NixConfigAttrs()
+    udev_section(nix_hw_config, host_root=host_root, source=SysfsSource(host_root))
+    assert nix_hw_config.initrd_available_kernel_modules == ["usbhid"]
+
+
+def test_device_source() -> None:
+    assert isinstance(device_source("sysfs"), SysfsSource)
+    assert isinstance(device_source("pyudev"), PyudevSource)
+
+
+@pytest.mark.skipif(not have_libudev(), reason="needs libudev")
+def test_sysfs_source_matches_pyudev() -> None:
+    # the kernel properties of the running machine, the udev database may be missing here
+    wanted = {
+        subsystem: ["SUBSYSTEM", "DRIVER", "PCI_CLASS", "PCI_ID", "MODALIAS", "MAJOR", "MINOR", "DEVNAME"]
+        for subsystem in udev_rules
+    }
+
+    def key(device: dict[str, str]) -> tuple[tuple[str, str], ...]:
+        return tuple(sorted(device.items()))
+
+    pyudev_devices = [
+        {prop: str(device.properties[prop]) for prop in wanted[device.subsystem] if device.properties.get(prop)}
+        for device in PyudevSource().devices(wanted)
+    ]
+    sysfs_devices = list(SysfsSource().devices(wanted))
+    assert sorted(map(key, sysfs_devices)) == sorted(map(key, pyudev_devices))
+    assert udev_properties("pci") >= {"MODALIAS", "DRIVER", "PCI_CLASS", "PCI_ID", "SUBSYSTEM"}
@@ -0,0 +1,110 @@
+from pathlib import Path
+
+import pytest
+
+from nixos_gen_config.classes import NixConfigAttrs, OrderedSet
+from nixos_gen_config.diff_config import check_hw_config, diff_hw_config, parse_hw_config
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.partitions import fsTemplate
+
+from .conftest import Helpers
+from .test_fingerprint import run_main
+
+
+def asset_config() -> NixConfigAttrs:
+    # what hardware-configuration.nix in the assets was rendered from
+    return NixConfigAttrs(
+        imports=['(modulesPath + "/installer/scan/not-detected.nix")'],
+        initrd_available_kernel_modules=["xhci_pci", "nvme", "usbhid", "sd_mod"],
+        kernel_modules=["kvm-amd", "wl"],
+        module_packages=["config.boot.kernelPackages.broadcom_sta"],
+        attrs=[
+            "hardware.cpu.amd.updateMicrocode = lib.mkDefault config.hardware.enableRedistributableFirmware;",
+            'powerManagement.cpuFreqGovernor = lib.mkDefault "powersave";',
+        ],
+        fsattrs=[
+            fsTemplate.substitute(mountpoint="/", device="/dev/disk/by-uuid/1234", filesystem="ext4", extra=""),
+            fsTemplate.substitute(mountpoint="/boot", device="/dev/disk/by-uuid/ABCD", filesystem="vfat", extra=""),
+        ],
+    )
+
+
+def test_parse_hw_config() -> None:
+    parsed = parse_hw_config(Helpers.read_asset("hardware-configuration.nix"))
+    expected = asset_config()
+    assert parsed.imports == expected.imports
+    assert parsed.initrd_available_kernel_modules == expected.initrd_available_kernel_modules
+    assert parsed.initrd_kernel_modules == []
+    assert parsed.module_packages == expected.module_packages
+    assert parsed.attrs == expected.attrs
+    assert len(parsed.fsattrs) == 2
+    assert diff_hw_config(parsed, expected) == []
+    # and every config parses back to itself
+    assert diff_hw_config(parse_hw_config(generate_hw_config(NixConfigAttrs())), NixConfigAttrs()) == []
+
+
+def test_diff_hw_config() -> None:
+    old = parse_hw_config(Helpers.read_asset("hardware-configuration.nix"))
+    new = asset_config()
+    new.initrd_available_kernel_modules.append("ahci")
+    new.kernel_modules = OrderedSet(["kvm-amd"])
+    new.attrs = OrderedSet(
+        [
+            "hardware.cpu.amd.updateMicrocode = lib.mkDefault config.hardware.enableRedistributableFirmware;",
+            'powerManagement.cpuFreqGovernor = lib.mkDefault "ondemand";',
+            "boot.isContainer = true;",
+        ]
+    )
+    new.fsattrs = OrderedSet(
+        [
+            fsTemplate.substitute(mountpoint="/", device="/dev/disk/by-uuid/5678", filesystem="ext4", extra=""),
+            fsTemplate.substitute(mountpoint="/home", device="/dev/disk/by-uuid/EF01", filesystem="xfs", extra=""),
+        ]
+    )
+    assert diff_hw_config(old, new) == [
+        "boot.initrd.availableKernelModules: + ahci",
+        "boot.kernelModules: - wl",
+        'powerManagement.cpuFreqGovernor: lib.mkDefault "powersave" -> lib.mkDefault "ondemand"',
+        "boot.isContainer: + true",
+        'fileSystems."/".device: "/dev/disk/by-uuid/1234" -> "/dev/disk/by-uuid/5678"',
+        'fileSystems."/home": + { device = "/dev/disk/by-uuid/EF01"; fsType = "xfs"; }',
+        'fileSystems."/boot": - { device = "/dev/disk/by-uuid/ABCD"; fsType = "vfat"; }',
+    ]
+
+    reordered = asset_config()
+    reordered.kernel_modules = OrderedSet(["wl", "kvm-amd"])
+    assert diff_hw_config(old, reordered) == ["boot.kernelModules: order changed"]
+
+
+def test_check_hw_config(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    config_file = tmp_path.joinpath("hardware-configuration.nix")
+    assert check_hw_config(asset_config(), tmp_path, show_diff=False) == 1
+    assert "doesn't exist" in capsys.readouterr().out
+
+    config_file.write_text(Helpers.read_asset("hardware-configuration.nix"), "utf-8")
+    assert check_hw_config(asset_config(), tmp_path, show_diff=True) == 0
+    assert "is up to date" in capsys.readouterr().out
+
+    changed = asset_config()
+    changed.kernel_modules.append("kvm-intel")
+    assert check_hw_config(changed, tmp_path, show_diff=True) == 1
+    assert capsys.readouterr().out == "boot.kernelModules: + kvm-intel\n"
+
+
+def test_main_check(tmp_path: Path) -> None:
+    args = ["--dir", str(tmp_path), "--no-filesystems"]
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(*args, "--check")
+    assert exit_info.value.code == 1
+    # nothing is written, not even the cache
+    assert list(tmp_path.iterdir()) == []
+
+    # write_nixos_config leaves an existing configuration.nix alone
+    tmp_path.joinpath("configuration.nix").write_text("{ }", "utf-8")
+    run_main(*args)
+    config_file = tmp_path.joinpath("hardware-configuration.nix")
+    mtime = config_file.stat().st_mtime_ns
+    with pytest.raises(SystemExit) as exit_info:
+        run_main(*args, "--diff")
+    assert exit_info.value.code == 0
+    assert config_file.stat().st_mtime_ns == mtime
@@ -0,0 +1,83 @@
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from nixos_gen_config import fingerprint, main
+
+from .conftest import FakeDevice, Helpers
+
+MOUNTINFO = "22 1 259:2 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p2 rw\n"
+
+
+def make_fingerprint_host(host_root: Path) -> Path:
+    return Helpers.make_host(
+        host_root,
+        {
+            "proc/cpuinfo": Helpers.read_asset("cpu_info_amd"),
+            "proc/self/mountinfo": MOUNTINFO,
+            "sys/bus/pci/devices/0000:00:14.0/modalias": "pci:v00008086d0000A36Dsv00001028sd0000085Cbc0Csc03i30\n",
+            "sys/bus/usb/devices/1-1/modalias": "usb:v046DpC52Bd2410dc00dsc00dp00ic03isc01ip01in00\n",
+            "sys/class/dmi/id/product_name": "XPS 13 9380\n",
+            "dev/disk/by-uuid/1234": "",
+        },
+    )
+
+
+def test_fingerprint_stable(tmp_path: Path) -> None:
+    host_root = make_fingerprint_host(tmp_path)
+    first = fingerprint.hardware_fingerprint(Path("/"), False, host_root)
+    assert fingerprint.hardware_fingerprint(Path("/"), False, host_root) == first
+    # the mount ids change every boot, they must not change the fingerprint
+    host_root.joinpath("proc/self/mountinfo").write_text(MOUNTINFO.replace("22 1", "97 53"), "utf-8")
+    assert fingerprint.hardware_fingerprint(Path("/"), False, host_root) == first
+
+
+def test_fingerprint_changes(tmp_path: Path) -> None:
+    host_root = make_fingerprint_host(tmp_path)
+    first = fingerprint.hardware_fingerprint(Path("/"), False, host_root)
+    Helpers.make_host(host_root, {"sys/bus/usb/devices/1-2/modalias": "usb:v1050p0407d0526dc00dsc00dp00ic03\n"})
+    second = fingerprint.hardware_fingerprint(Path("/"), False, host_root)
+    assert second != first
+    Helpers.make_host(host_root, {"dev/disk/by-uuid/5678": ""})
+    assert fingerprint.hardware_fingerprint(Path("/"), False, host_root) != second
+    # filesystems don't matter with --no-filesystems
+    assert fingerprint.hardware_fingerprint(Path("/"), True, host_root) != second
+
+
+def test_cached_config(tmp_path: Path) -> None:
+    cache_file = tmp_path.joinpath(fingerprint.cache_file_name)
+    assert fingerprint.load_cached_config(cache_file, "abc") is None
+    fingerprint.save_cached_config(cache_file, "abc", "{ }")
+    assert fingerprint.load_cached_config(cache_file, "abc") == "{ }"
+    assert fingerprint.load_cached_config(cache_file, "def") is None
+    cache_file.write_text("not json", "utf-8")
+    assert fingerprint.load_cached_config(cache_file, "abc") is None
+
+
+def run_main(*args: str) -> MagicMock:
+    """run main with args, returns the pyudev.Context mock"""
+    with patch.object(sys, "argv", ["nixos-gen-config", *args]), patch("pyudev.Context") as context_mock:
+        enumerator = MagicMock()
+        enumerator.match_subsystem.return_value = enumerator
+        enumerator.__iter__.return_value = iter([FakeDevice(SUBSYSTEM="block", ID_FS_TYPE="bcache")])
+        context_mock.return_value.list_devices.return_value = enumerator
+        with patch("nixos_gen_config.hardware.systemd_detect_virt", return_value="none"):
+            main.main()
+    return context_mock
+
+
+def test_main_hot_run(tmp_path: Path) -> None:
+    # write_nixos_config leaves an existing configuration.nix alone
+    tmp_path.joinpath("configuration.nix").write_text("{ }", "utf-8")
+    args = ["--dir", str(tmp_path), "--no-filesystems"]
+    config_file = tmp_path.joinpath("hardware-configuration.nix")
+
+    assert run_main(*args).called
+    config = config_file.read_text("utf-8")
+    assert '"bcache"' in config
+
+    # the fingerprint is unchanged, so the cached result is used without any libudev enumeration
+    assert not run_main(*args).called
+    assert config_file.read_text("utf-8") == config
+
+    assert run_main(*args, "--no-cache").called
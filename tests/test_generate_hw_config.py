@@ -0,0 +1,26 @@
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.partitions import fsTemplate
+
+from .conftest import Helpers
+
+
+def test_generate_hw_config_duplicates() -> None:
+    # every value is appended twice, the output must be the same as the one rendered from lists with uniq
+    nix_hw_config = NixConfigAttrs()
+    nix_hw_config.imports.append('(modulesPath + "/installer/scan/not-detected.nix")')
+    nix_hw_config.initrd_available_kernel_modules.extend(["xhci_pci", "nvme", "usbhid", "xhci_pci", "nvme", "sd_mod"])
+    nix_hw_config.kernel_modules.extend(["kvm-amd", "wl", "kvm-amd"])
+    nix_hw_config.module_packages.extend(["config.boot.kernelPackages.broadcom_sta"] * 2)
+    microcode = "hardware.cpu.amd.updateMicrocode = lib.mkDefault config.hardware.enableRedistributableFirmware;"
+    nix_hw_config.attrs.extend([microcode, 'powerManagement.cpuFreqGovernor = lib.mkDefault "powersave";', microcode])
+    for mountpoint, device, filesystem in [
+        ("/", "/dev/disk/by-uuid/1234", "ext4"),
+        ("/boot", "/dev/disk/by-uuid/ABCD", "vfat"),
+        ("/", "/dev/disk/by-uuid/1234", "ext4"),
+    ]:
+        nix_hw_config.fsattrs.append(
+            fsTemplate.substitute(mountpoint=mountpoint, device=device, filesystem=filesystem, extra="")
+        )
+
+    assert generate_hw_config(nix_hw_config) + "\n" == Helpers.read_asset("hardware-configuration.nix")
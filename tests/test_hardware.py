@@ -2,29 +2,43 @@
 # ^ pyudev names ID_VENDOR_ID etc
 import subprocess
 from pathlib import Path
-from unittest.mock import patch
+from typing import Iterable
+from unittest.mock import MagicMock, patch
+
+import pytest
 
 from nixos_gen_config import hardware
 from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.diff_config import diff_hw_config, parse_hw_config
+from nixos_gen_config.generate_hw_config import generate_hw_config
 
 from .conftest import FakeDevice, Helpers
 
+GOVERNORS_FILE = "sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors"
+POLICY = "sys/devices/system/cpu/cpufreq/policy{}"
+EPP_FILE = "/sys/devices/system/cpu/cpufreq/policy*/energy_performance_preference"
 
-def test_cpu_section_amd() -> None:
-    nix_hw_config = NixConfigAttrs()
-    cpuinfo = Helpers.read_asset("cpu_info_amd")
-    governors = Helpers.read_asset("available_governors")
 
-    def fake_read(path: str, encoding: str) -> str:
-        if str(path) == "/proc/cpuinfo":
-            return cpuinfo
-        if str(path) == "/sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors":
-            return governors
-        return "shouldn't be reached"
+def cpufreq_host(tmp_path: Path, driver: str, governors: list[str], epp: str = "", **status: str) -> Path:
+    files = {f"sys/devices/system/cpu/{name}/status": f"{mode}\n" for name, mode in status.items()}
+    for policy, policy_governors in enumerate(governors):
+        files[f"{POLICY.format(policy)}/scaling_driver"] = f"{driver}\n"
+        files[f"{POLICY.format(policy)}/scaling_available_governors"] = f"{policy_governors}\n"
+        if epp:
+            files[f"{POLICY.format(policy)}/energy_performance_available_preferences"] = f"{epp}\n"
+    return Helpers.make_host(tmp_path, files)
 
-    with patch.object(Path, "read_text", new=fake_read):
-        with patch.object(Path, "exists", return_value=True):
-            hardware.cpu_section(nix_hw_config)
+
+def test_cpu_section_amd(tmp_path: Path) -> None:
+    nix_hw_config = NixConfigAttrs()
+    host_root = Helpers.make_host(
+        tmp_path,
+        {
+            "proc/cpuinfo": Helpers.read_asset("cpu_info_amd"),
+            GOVERNORS_FILE: Helpers.read_asset("available_governors"),
+        },
+    )
+    hardware.cpu_section(nix_hw_config, host_root=host_root)
 
     assert (
         "hardware.cpu.amd.updateMicrocode = lib.mkDefault config.hardware.enableRedistributableFirmware;"
@@ -34,21 +48,16 @@ def test_cpu_section_amd() -> None:
     assert "kvm-amd" in nix_hw_config.kernel_modules
 
 
-def test_cpu_section_intel() -> None:
+def test_cpu_section_intel(tmp_path: Path) -> None:
     nix_hw_config = NixConfigAttrs()
-    cpuinfo = Helpers.read_asset("cpu_info_intel")
-    governors = Helpers.read_asset("available_governors")
-
-    def fake_read(path: str, encoding: str) -> str:
-        if str(path) == "/proc/cpuinfo":
-            return cpuinfo
-        if str(path) == "/sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors":
-            return governors
-        return "shouldn't be reached"
-
-    with patch.object(Path, "read_text", new=fake_read):
-        with patch.object(Path, "exists", return_value=True):
-            hardware.cpu_section(nix_hw_config)
+    host_root = Helpers.make_host(
+        tmp_path,
+        {
+            "proc/cpuinfo": Helpers.read_asset("cpu_info_intel"),
+            GOVERNORS_FILE: Helpers.read_asset("available_governors"),
+        },
+    )
+    hardware.cpu_section(nix_hw_config, host_root=host_root)
 
     assert (
         "hardware.cpu.intel.updateMicrocode = lib.mkDefault config.hardware.enableRedistributableFirmware;"
@@ -58,6 +67,154 @@ def test_cpu_section_intel() -> None:
     assert "kvm-intel" in nix_hw_config.kernel_modules
 
 
+def test_cpufreq_policies(tmp_path: Path) -> None:
+    # schedutil isn't offered by every policy, ondemand is
+    host_root = cpufreq_host(
+        tmp_path, "acpi-cpufreq", ["performance schedutil ondemand powersave", "performance ondemand powersave"]
+    )
+    cpufreq = hardware.CpuFreq.read(host_root)
+    assert cpufreq.driver == "acpi-cpufreq"
+    assert len(cpufreq.policies) == 2
+    assert cpufreq.common("governors") == ("performance", "ondemand", "powersave")
+    cpuinfo = hardware.CpuInfo.parse(["vendor_id\t: AuthenticAMD", "flags\t: fpu svm"])
+    assert hardware.cpufreq_settings(cpufreq, cpuinfo) == ([], "ondemand", "")
+    assert hardware.cpufreq_settings(cpufreq, cpuinfo, "throughput") == ([], "performance", "")
+
+
+def test_cpu_section_profiles_amd_pstate(tmp_path: Path) -> None:
+    governors = "conservative ondemand userspace powersave performance schedutil"
+    host_root = cpufreq_host(tmp_path, "amd-pstate", [governors, governors], amd_pstate="passive")
+    cpuinfo = hardware.CpuInfo.parse(["vendor_id\t: AuthenticAMD", "flags\t: fpu svm cppc"])
+    expected = {
+        "auto": ([], 'powerManagement.cpuFreqGovernor = lib.mkDefault "schedutil";'),
+        "throughput": (["amd_pstate=active"], 'powerManagement.cpuFreqGovernor = lib.mkDefault "performance";'),
+        "power": (["amd_pstate=active"], 'powerManagement.cpuFreqGovernor = lib.mkDefault "powersave";'),
+    }
+    for profile, (kernel_params, governor) in expected.items():
+        nix_hw_config = NixConfigAttrs()
+        hardware.cpu_section(nix_hw_config, cpuinfo, host_root, profile)
+        assert nix_hw_config.kernel_params == kernel_params
+        assert governor in nix_hw_config.attrs
+    assert f'systemd.tmpfiles.rules = [ "w {EPP_FILE} - - - - balance_power" ];' in nix_hw_config.attrs
+
+    hw_config = generate_hw_config(nix_hw_config)
+    assert '  hardware.firmware = [ ];\n  boot.kernelParams = [ "amd_pstate=active" ];\n' in hw_config
+    assert diff_hw_config(parse_hw_config(hw_config), nix_hw_config) == []
+
+
+def test_cpu_section_profiles_intel_pstate(tmp_path: Path) -> None:
+    # already active, only the governor and EPP change
+    epp = "default performance balance_performance balance_power power"
+    host_root = cpufreq_host(tmp_path, "intel_pstate", ["performance powersave"], epp, intel_pstate="active")
+    cpuinfo = hardware.CpuInfo.parse(["vendor_id\t: GenuineIntel", "flags\t: fpu vmx hwp"])
+    cpufreq = hardware.CpuFreq.read(host_root)
+    assert hardware.cpufreq_settings(cpufreq, cpuinfo) == ([], "powersave", "")
+    assert hardware.cpufreq_settings(cpufreq, cpuinfo, "throughput") == ([], "performance", "performance")
+    assert hardware.cpufreq_settings(cpufreq, cpuinfo, "power") == ([], "powersave", "balance_power")
+
+
+def test_cpufreq_settings_without_cpufreq() -> None:
+    cpuinfo = hardware.CpuInfo.parse(["vendor_id\t: AuthenticAMD", "flags\t: fpu svm cppc"])
+    assert hardware.cpufreq_settings(hardware.CpuFreq(), cpuinfo, "throughput") == ([], "", "")
+
+
+def numa_host(host_root: Path, cpulists: list[str], node_gib: int, hugepage_sizes: Iterable[int]) -> Path:
+    """a host with a node dir per cpulist, node_gib of memory on every node and 2M default huge pages"""
+    files = {
+        "proc/meminfo": (
+            f"MemTotal:       {node_gib * len(cpulists) << 20} kB\n"
+            "MemFree:            1024 kB\n"
+            "Hugepagesize:       2048 kB\n"
+        )
+    }
+    for node, cpulist in enumerate(cpulists):
+        files[f"sys/devices/system/node/node{node}/cpulist"] = f"{cpulist}\n"
+        files[f"sys/devices/system/node/node{node}/meminfo"] = f"Node {node} MemTotal:       {node_gib << 20} kB\n"
+    for size in hugepage_sizes:
+        files[f"sys/kernel/mm/hugepages/hugepages-{size}kB/nr_hugepages"] = "0\n"
+    return Helpers.make_host(host_root, files)
+
+
+NUMA_LAYOUTS = {
+    # a workstation, nothing to change
+    "1-node": (["0-7"], 16, [2048, 1048576], []),
+    # a two socket database host with smt siblings numbered after the cores
+    "2-node": (
+        ["0-15,32-47", "16-31,48-63"],
+        64,
+        [2048, 1048576],
+        [
+            "services.irqbalance.enable = lib.mkDefault true;",
+            'boot.kernel.sysctl."kernel.numa_balancing" = lib.mkDefault 1;',
+        ],
+    ),
+    # eight nodes without 1G pages
+    "8-node": (
+        [f"{node * 16}-{node * 16 + 15}" for node in range(8)],
+        64,
+        [2048],
+        [
+            "services.irqbalance.enable = lib.mkDefault true;",
+            'boot.kernel.sysctl."kernel.numa_balancing" = lib.mkDefault 1;',
+        ],
+    ),
+}
+
+
+@pytest.mark.parametrize("layout", NUMA_LAYOUTS)
+def test_memory_section(tmp_path: Path, layout: str) -> None:
+    cpulists, node_gib, hugepage_sizes, attrs = NUMA_LAYOUTS[layout]
+    host_root = numa_host(tmp_path, cpulists, node_gib, hugepage_sizes)
+    topology = hardware.MemoryTopology.read(host_root)
+    assert [node.cpulist for node in topology.nodes] == cpulists
+    assert topology.memory_kb == node_gib * len(cpulists) << 20
+    assert topology.default_hugepage_kb == 2048
+
+    nix_hw_config = NixConfigAttrs()
+    hardware.memory_section(nix_hw_config, host_root)
+    assert nix_hw_config.attrs == attrs
+    # 1G pages by default only where they exist and there is enough memory
+    assert nix_hw_config.kernel_params == (["default_hugepagesz=1G"] if layout == "2-node" else [])
+
+
+def test_memory_topology_summary(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    host_root = numa_host(tmp_path, ["0-15,32-47", "16-31,48-63"], 64, [2048, 1048576])
+    # the live run reports the topology the section read, without a host name
+    hardware.memory_section(NixConfigAttrs(), host_root, label="")
+    assert capsys.readouterr().err.startswith("Memory: 2 numa nodes (node0: cpus 0-15,32-47;")
+    hardware.memory_section(NixConfigAttrs(), host_root)
+    assert capsys.readouterr().err == ""
+    assert [node.cpu_count for node in hardware.MemoryTopology.read(host_root).nodes] == [32, 32]
+    assert hardware.MemoryTopology.read(host_root).summary() == (
+        "2 numa nodes (node0: cpus 0-15,32-47; node1: cpus 16-31,48-63), huge page sizes 2M 1G"
+    )
+    # without /sys/devices/system/node, e.g. a kernel without numa
+    assert hardware.MemoryTopology.read(tmp_path.joinpath("empty")).summary() == "0 numa nodes (), huge page sizes none"
+
+
+def test_cpuinfo_first_block_only() -> None:
+    cpuinfo = hardware.CpuInfo.read(Helpers.root().joinpath("assets", "cpu_info_epyc_256"))
+    assert cpuinfo.vendor_id == "AuthenticAMD"
+    assert cpuinfo.get("processor") == "0"
+    assert cpuinfo.get("model name") == "AMD EPYC 7742 64-Core Processor"
+    assert "svm" in cpuinfo.flags
+    assert "vmx" not in cpuinfo.flags
+    assert not cpuinfo.processors
+
+
+def test_cpuinfo_per_core() -> None:
+    cpuinfo = hardware.CpuInfo.read(Helpers.root().joinpath("assets", "cpu_info_epyc_256"), per_core=True)
+    assert len(cpuinfo.processors) == 256
+    assert cpuinfo.processors[-1]["processor"] == "255"
+    assert cpuinfo.get("processor") == "0"
+
+
+def test_cpuinfo_empty() -> None:
+    cpuinfo = hardware.CpuInfo.parse([])
+    assert cpuinfo.vendor_id == ""
+    assert not cpuinfo.flags
+
+
 def test_usb_keyboard() -> None:
     nix_hw_config = NixConfigAttrs()
     pyudev_device = FakeDevice()
@@ -83,17 +240,65 @@ def test_bcache_false() -> None:
     assert "bcache" not in nix_hw_config.initrd_available_kernel_modules
 
 
+def test_udev_section_dispatch() -> None:
+    nix_hw_config = NixConfigAttrs()
+    keyboard = FakeDevice(SUBSYSTEM="input", ID_INPUT_KEYBOARD="1", ID_USB_DRIVER="usbhid")
+    bcache_disk = FakeDevice(SUBSYSTEM="block", ID_FS_TYPE="bcache")
+    usb_controller = FakeDevice(SUBSYSTEM="pci", PCI_CLASS="C0330", DRIVER="xhci_hcd")
+    # a keyboard property on a pci device must not reach usb_keyboard
+    odd_pci = FakeDevice(SUBSYSTEM="pci", ID_INPUT_KEYBOARD="1", ID_USB_DRIVER="not_a_module")
+    hardware.udev_section(nix_hw_config, [keyboard, odd_pci, bcache_disk, usb_controller])
+    # grouped by subsystem in udev_rules order, not in enumeration order
+    assert nix_hw_config.initrd_available_kernel_modules == ["xhci_pci", "bcache", "usbhid"]
+
+
+def test_udev_section_single_enumeration() -> None:
+    nix_hw_config = NixConfigAttrs()
+    with patch("pyudev.Context") as context_mock:
+        enumerator = MagicMock()
+        enumerator.match_subsystem.return_value = enumerator
+        enumerator.__iter__.return_value = iter([FakeDevice(SUBSYSTEM="block", ID_FS_TYPE="bcache")])
+        context_mock.return_value.list_devices.return_value = enumerator
+        hardware.udev_section(nix_hw_config)
+
+    context_mock.return_value.list_devices.assert_called_once_with()
+    assert [c.args[0] for c in enumerator.match_subsystem.call_args_list] == list(hardware.udev_rules)
+    assert nix_hw_config.initrd_available_kernel_modules == ["bcache"]
+
+
 def test_virt_section() -> None:
     nix_hw_config = NixConfigAttrs()
-    with patch("subprocess.run") as subprocess_mock:
+    hardware.virt_section(nix_hw_config, "kvm")
+    assert '(modulesPath + "/profiles/qemu-quest.nix")' in nix_hw_config.imports
+    assert '(modulesPath + "/installer/scan/not-detected.nix")' not in nix_hw_config.imports
+
+
+def test_virt_section_none() -> None:
+    nix_hw_config = NixConfigAttrs()
+    hardware.virt_section(nix_hw_config, "none")
+    assert '(modulesPath + "/installer/scan/not-detected.nix")' in nix_hw_config.imports
+
+
+def test_virt_section_fallback() -> None:
+    nix_hw_config = NixConfigAttrs()
+    with patch("nixos_gen_config.hardware.detect_virt", return_value=None), patch("subprocess.run") as subprocess_mock:
         subprocess_mock.return_value.stdout = "kvm"
-        hardware.virt_section(nix_hw_config)
+        hardware.virt_section(nix_hw_config, cpuinfo=hardware.CpuInfo())
         assert '(modulesPath + "/profiles/qemu-quest.nix")' in nix_hw_config.imports
 
 
 def test_virt_section_process_error() -> None:
     nix_hw_config = NixConfigAttrs()
-    with patch("subprocess.run") as subprocess_mock:
+    with patch("nixos_gen_config.hardware.detect_virt", return_value=None), patch("subprocess.run") as subprocess_mock:
         subprocess_mock.side_effect = subprocess.CalledProcessError(1, "cmd", "output")
-        hardware.virt_section(nix_hw_config)
+        hardware.virt_section(nix_hw_config, cpuinfo=hardware.CpuInfo())
         assert '(modulesPath + "/installer/scan/not-detected.nix")' in nix_hw_config.imports
+
+
+def test_virt_section_native() -> None:
+    nix_hw_config = NixConfigAttrs()
+    with patch("nixos_gen_config.hardware.detect_virt", return_value="oracle"):
+        with patch("subprocess.run") as subprocess_mock:
+            hardware.virt_section(nix_hw_config, cpuinfo=hardware.CpuInfo())
+            subprocess_mock.assert_not_called()
+    assert "virtualisation.virtualbox.guest.enable = true;" in nix_hw_config.attrs
@@ -1,7 +1,8 @@
 # pylint: disable=invalid-name
 # ^ pyudev names ID_VENDOR_ID etc
 from nixos_gen_config.classes import NixConfigAttrs
-from nixos_gen_config.hardware import pci
+from nixos_gen_config.hardware import pci, wifi
+from nixos_gen_config.pci_ids import is_initrd_class, parse_pci_class
 
 from .conftest import FakeDevice
 
@@ -9,15 +10,51 @@ from .conftest import FakeDevice
 def test_pci_usb_controller() -> None:
     nix_hw_config = NixConfigAttrs()
     pyudev_device = FakeDevice()
-    pyudev_device.ID_PCI_SUBCLASS_FROM_DATABASE = "USB controller"
+    pyudev_device.PCI_CLASS = "C0330"
     pyudev_device.DRIVER = "xhci_hcd"
     pci(nix_hw_config, pyudev_device)
     assert "xhci_pci" in nix_hw_config.initrd_available_kernel_modules
 
 
+def test_pci_mass_storage() -> None:
+    nix_hw_config = NixConfigAttrs()
+    # NVM Express, matched by the class alone
+    pci(nix_hw_config, FakeDevice(PCI_CLASS="10802", DRIVER="nvme"))
+    assert nix_hw_config.initrd_available_kernel_modules == ["nvme"]
+
+
+def test_pci_other_class() -> None:
+    nix_hw_config = NixConfigAttrs()
+    # Ethernet controller
+    pci(nix_hw_config, FakeDevice(PCI_CLASS="20000", DRIVER="e1000e", PCI_ID="8086:15BB"))
+    assert not nix_hw_config.initrd_available_kernel_modules
+
+
 def test_pci_virtio_scsi() -> None:
     nix_hw_config = NixConfigAttrs()
     pyudev_device = FakeDevice()
-    pyudev_device.ID_MODEL_FROM_DATABASE = "Virtio SCSI"
+    pyudev_device.PCI_ID = "1AF4:1004"
     pci(nix_hw_config, pyudev_device)
     assert "virtio_scsi" in nix_hw_config.initrd_available_kernel_modules
+
+
+def test_wifi_broadcom_sta() -> None:
+    nix_hw_config = NixConfigAttrs()
+    wifi(nix_hw_config, FakeDevice(PCI_ID="14E4:43A0"))
+    assert "wl" in nix_hw_config.kernel_modules
+    assert "config.boot.kernelPackages.broadcom_sta" in nix_hw_config.module_packages
+
+
+def test_wifi_other() -> None:
+    nix_hw_config = NixConfigAttrs()
+    # BCM4350, driven by brcmfmac
+    wifi(nix_hw_config, FakeDevice(PCI_ID="14E4:43A3"))
+    assert not nix_hw_config.kernel_modules
+
+
+def test_parse_pci_class() -> None:
+    assert parse_pci_class("C0330") == 0x0C0330
+    assert parse_pci_class("") is None
+    assert parse_pci_class("not hex") is None
+    assert is_initrd_class(0x0C0010)
+    assert not is_initrd_class(0x0C0500)
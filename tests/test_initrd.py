@@ -0,0 +1,134 @@
+import os
+import sys
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from nixos_gen_config.arguments import process_args
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.hardware import udev_section
+from nixos_gen_config.initrd import ModuleDeps, initrd_section, module_name
+from nixos_gen_config.partitions import Partition
+
+from .conftest import FakeDevice, Helpers
+
+MODULES_DEP = """\
+kernel/drivers/nvme/host/nvme.ko.xz: kernel/drivers/nvme/host/nvme-core.ko.xz
+kernel/drivers/nvme/host/nvme-core.ko.xz:
+kernel/drivers/ata/ahci.ko.xz: kernel/drivers/ata/libahci.ko.xz
+kernel/drivers/usb/host/xhci-pci.ko.xz: kernel/drivers/usb/host/xhci-hcd.ko.xz kernel/drivers/usb/core/usbcore.ko.xz
+kernel/drivers/usb/host/xhci-hcd.ko.xz: kernel/drivers/usb/core/usbcore.ko.xz
+kernel/drivers/usb/core/usbcore.ko.xz:
+kernel/drivers/hid/usbhid/usbhid.ko.xz: kernel/drivers/hid/hid.ko.xz kernel/drivers/usb/core/usbcore.ko.xz
+kernel/drivers/hid/hid-generic.ko.xz: kernel/drivers/hid/hid.ko.xz
+kernel/drivers/md/dm-crypt.ko.xz: kernel/drivers/md/dm-mod.ko.xz
+"""
+PCI = "sys/devices/pci0000:00"
+NVME_DISK = f"{PCI}/0000:00:1d.0/0000:01:00.0/nvme/nvme0/nvme0n1"
+USB_INTERFACE = f"{PCI}/0000:00:14.0/usb1/1-1/1-1:1.0"
+KEYBOARD = f"{USB_INTERFACE}/0003:046D:C52B.0001/input/input3"
+# device dir -> driver, None for a driver built into the kernel
+DRIVERS: dict[str, tuple[str, str, Optional[str]]] = {
+    f"{PCI}/0000:00:1d.0": ("pci", "pcieport", None),
+    f"{PCI}/0000:00:1d.0/0000:01:00.0": ("pci", "nvme", "nvme"),
+    f"{PCI}/0000:00:17.0": ("pci", "ahci", "ahci"),
+    f"{PCI}/0000:00:14.0": ("pci", "xhci_hcd", "xhci_pci"),
+    f"{PCI}/0000:00:14.0/usb1/1-1": ("usb", "usb", "usbcore"),
+    USB_INTERFACE: ("usb", "usbhid", "usbhid"),
+    f"{USB_INTERFACE}/0003:046D:C52B.0001": ("hid", "hid-generic", "hid_generic"),
+}
+
+
+def symlink(host_root: Path, link: str, target: str) -> None:
+    path = host_root.joinpath(link)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # relative like the links of sysfs
+    path.symlink_to(os.path.relpath(host_root.joinpath(target), path.parent))
+
+
+def make_sysfs(host_root: Path) -> Path:
+    Helpers.make_host(
+        host_root,
+        {
+            "proc/sys/kernel/osrelease": "6.1.0\n",
+            "lib/modules/6.1.0/modules.dep": MODULES_DEP,
+            f"{NVME_DISK}/nvme0n1p2/dev": "259:2\n",
+            f"{NVME_DISK}/nvme0n1p3/dev": "259:3\n",
+            f"{PCI}/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block/sda/dev": "8:0\n",
+            f"{KEYBOARD}/capabilities/key": "1000000000007 ff9f207ac14057ff febeffdfffefffff fffffffffffffffe\n",
+            "sys/devices/virtual/block/dm-0/dm/name": "cryptroot\n",
+        },
+    )
+    for device_dir, (bus, driver, module) in DRIVERS.items():
+        symlink(host_root, f"{device_dir}/driver", f"sys/bus/{bus}/drivers/{driver}")
+        host_root.joinpath(f"sys/bus/{bus}/drivers/{driver}").mkdir(parents=True, exist_ok=True)
+        if module:
+            symlink(host_root, f"sys/bus/{bus}/drivers/{driver}/module", f"sys/module/{module}")
+            host_root.joinpath(f"sys/module/{module}").mkdir(parents=True, exist_ok=True)
+    symlink(host_root, "sys/dev/block/259:2", f"{NVME_DISK}/nvme0n1p2")
+    symlink(host_root, "sys/dev/block/259:3", f"{NVME_DISK}/nvme0n1p3")
+    symlink(host_root, "sys/dev/block/8:0", f"{PCI}/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block/sda")
+    symlink(host_root, "sys/dev/block/254:0", "sys/devices/virtual/block/dm-0")
+    symlink(host_root, "sys/class/block/dm-0", "sys/devices/virtual/block/dm-0")
+    symlink(host_root, "sys/devices/virtual/block/dm-0/slaves/nvme0n1p3", f"{NVME_DISK}/nvme0n1p3")
+    symlink(host_root, "sys/class/input/input3", KEYBOARD)
+    return host_root
+
+
+def test_module_deps() -> None:
+    assert module_name("kernel/drivers/usb/host/xhci-pci.ko.zst") == "xhci_pci"
+    deps = ModuleDeps.parse(MODULES_DEP.splitlines())
+    assert deps.closure("xhci_pci") == {"xhci_hcd", "usbcore"}
+    # xhci_hcd is loaded by xhci_pci, no special case needed
+    assert deps.minimal_cover(["xhci_hcd", "xhci_pci", "usbhid", "hid_generic", "nvme"]) == [
+        "xhci_pci",
+        "usbhid",
+        "hid_generic",
+        "nvme",
+    ]
+
+
+def test_initrd_section(tmp_path: Path) -> None:
+    host_root = make_sysfs(tmp_path)
+    partitions = [
+        Partition("/dev/nvme0n1p2", "/", "ext4", devnum="259:2"),
+        # on the sata disk, not needed to boot
+        Partition("/dev/sda", "/srv", "xfs", devnum="8:0"),
+    ]
+    nix_hw_config = NixConfigAttrs()
+    initrd_section(nix_hw_config, Path("/"), partitions, host_root)
+    assert nix_hw_config.initrd_available_kernel_modules == ["nvme", "xhci_pci", "usbhid", "hid_generic"]
+
+
+def test_initrd_section_device_mapper(tmp_path: Path) -> None:
+    # /nix on an encrypted partition, found through the members of the device mapper device
+    host_root = make_sysfs(tmp_path)
+    for nix_partition in [
+        Partition("/dev/mapper/cryptroot", "/mnt/nix", "ext4", devnum="254:0"),
+        Partition("/dev/mapper/cryptroot", "/mnt/nix", "btrfs", devnum="0:42"),
+    ]:
+        nix_hw_config = NixConfigAttrs()
+        initrd_section(nix_hw_config, Path("/mnt"), [nix_partition], host_root)
+        assert nix_hw_config.initrd_available_kernel_modules == ["nvme", "xhci_pci", "usbhid", "hid_generic"]
+
+
+def test_udev_section_without_initrd_modules() -> None:
+    devices = [
+        FakeDevice(SUBSYSTEM="pci", PCI_CLASS="10802", PCI_ID="144D:A808", DRIVER="nvme"),
+        FakeDevice(SUBSYSTEM="pci", PCI_ID="14E4:43A0"),
+    ]
+    nix_hw_config = NixConfigAttrs()
+    udev_section(nix_hw_config, devices=devices, initrd_modules=False)
+    assert nix_hw_config.initrd_available_kernel_modules == []
+    assert nix_hw_config.kernel_modules == ["wl"]
+
+
+@pytest.mark.parametrize("mode", [["--from-snapshot", "host.tar.xz"], ["--batch", "snapshots"], ["--remote", "db1"]])
+def test_minimal_initrd_only_live(mode: list[str], monkeypatch: pytest.MonkeyPatch) -> None:
+    # the module dependencies are read from this machine, the other hosts would get its modules
+    monkeypatch.setattr(sys, "argv", ["nixos-generate-config", "--minimal-initrd", *mode])
+    with pytest.raises(SystemExit):
+        process_args()
+    monkeypatch.setattr(sys, "argv", ["nixos-generate-config", *mode])
+    process_args()
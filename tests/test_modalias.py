@@ -0,0 +1,113 @@
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+import pytest
+
+from nixos_gen_config import modalias
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.hardware import udev_section
+from nixos_gen_config.snapshot import capture_modules_alias
+
+from .conftest import FakeDevice, Helpers
+
+RELEASE = "6.1.0-test"
+XHCI = "pci:v00008086d0000A36Dsv00001028sd0000085Cbc0Csc03i30"
+NVME = "pci:v0000144Dd0000A808sv0000144Dsd0000A801bc01sc08i02"
+VIRTIO_SCSI = "pci:v00001AF4d00001004sv00001AF4sd00000008bc01sc00i00"
+ALIAS_LINES = 30_000
+
+
+@pytest.fixture
+def host_root(tmp_path: Path) -> Path:
+    return Helpers.make_host(
+        tmp_path.joinpath("host"),
+        {
+            "proc/sys/kernel/osrelease": f"{RELEASE}\n",
+            f"run/booted-system/kernel-modules/lib/modules/{RELEASE}/modules.alias": Helpers.synthetic_modules_alias(
+                ALIAS_LINES
+            ),
+        },
+    )
+
+
+def test_fixed_prefix() -> None:
+    assert modalias.fixed_prefix("pci:v00001AF4d*sv*sd*bc*sc*i*") == "pci:v00001AF4d"
+    assert modalias.fixed_prefix("fs-ext4") == "fs-ext4"
+    assert modalias.alias_bus("pci:v*d*") == "pci"
+    assert modalias.alias_bus("acpi*:INT33D5:*") == ""
+
+
+def test_alias_index_matches_fnmatch() -> None:
+    # fnmatch has to compile every pattern, a tenth of the realistic size keeps this quick
+    aliases = list(modalias.parse_modules_alias(Helpers.synthetic_modules_alias(ALIAS_LINES // 10).splitlines()))
+    index = modalias.AliasIndex.build(aliases)
+    modaliases = [
+        XHCI,
+        NVME,
+        VIRTIO_SCSI,
+        "pci:v00001064d00000064sv00000000sd00000000bc02sc00i00",
+        "usb:v046DpC52Bd2410dc00dsc00dp00ic03isc01ip01in00",
+        "acpi:INT0007:",
+        "fs-ext4",
+    ]
+    for device in modaliases:
+        expected = {module for pattern, module in aliases if fnmatchcase(device, pattern)}
+        assert set(index.modules(device)) == expected
+        assert len(index.modules(device)) == len(expected)
+
+
+def test_alias_index_modules(host_root: Path) -> None:
+    index = modalias.load_alias_index(host_root)
+    assert index is not None
+    assert index.modules(XHCI) == ["xhci_pci"]
+    assert index.modules(NVME) == ["nvme"]
+    assert index.modules(VIRTIO_SCSI) == ["virtio_pci"]
+    assert index.modules("pci:v0000DEADd0000BEEFsv*") == []
+
+
+def test_alias_index_cache(host_root: Path, tmp_path: Path) -> None:
+    cache_dir = tmp_path.joinpath("cache")
+    first = modalias.load_alias_index(host_root, cache_dir)
+    cache_file = cache_dir.joinpath(f"modules.alias-{RELEASE}.json")
+    assert first is not None and cache_file.exists()
+
+    cached = modalias.load_alias_index(host_root, cache_dir)
+    assert cached is not None and cached.modules(NVME) == first.modules(NVME)
+
+    # a changed modules.alias is read again
+    alias_file = modalias.find_modules_alias(host_root, RELEASE)
+    assert alias_file is not None
+    alias_file.write_text("alias pci:v*d*sv*sd*bc01sc08i02* nvme_new\n", "utf-8")
+    changed = modalias.load_alias_index(host_root, cache_dir)
+    assert changed is not None and changed.modules(NVME) == ["nvme_new"]
+
+
+def test_no_modules_alias(tmp_path: Path) -> None:
+    assert modalias.load_alias_index(Helpers.make_host(tmp_path, {"proc/sys/kernel/osrelease": RELEASE})) is None
+
+
+def test_udev_section_unbound(host_root: Path) -> None:
+    nix_hw_config = NixConfigAttrs()
+    devices = [
+        FakeDevice(SUBSYSTEM="pci", PCI_CLASS="C0330", DRIVER="xhci_hcd", MODALIAS=XHCI),
+        # no driver loaded, found through modules.alias
+        FakeDevice(SUBSYSTEM="pci", PCI_CLASS="10802", MODALIAS=NVME),
+        # not a class the initrd needs
+        FakeDevice(SUBSYSTEM="pci", PCI_CLASS="20000", MODALIAS="pci:v00008086d000015BBsv*"),
+    ]
+    udev_section(nix_hw_config, devices, host_root=host_root)
+    assert nix_hw_config.initrd_available_kernel_modules == ["xhci_pci", "nvme"]
+
+
+def test_capture_modules_alias(host_root: Path) -> None:
+    devices = {
+        "pci": [
+            {"SUBSYSTEM": "pci", "PCI_CLASS": "C0330", "DRIVER": "xhci_hcd", "MODALIAS": XHCI},
+            {"SUBSYSTEM": "pci", "PCI_CLASS": "10802", "MODALIAS": NVME},
+        ]
+    }
+    # only the aliases of the device without a driver end up in the snapshot
+    assert capture_modules_alias(devices, host_root) == {
+        f"lib/modules/{RELEASE}/modules.alias": "alias pci:v*d*sv*sd*bc01sc08i02* nvme\n"
+    }
+    assert not capture_modules_alias({"pci": devices["pci"][:1]}, host_root)
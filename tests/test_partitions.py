@@ -0,0 +1,278 @@
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from nixos_gen_config import partitions as partitions_module
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.devices import PyudevSource
+from nixos_gen_config.diff_config import diff_hw_config, parse_hw_config
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.partitions import (
+    BlockDeviceIndex,
+    BlockLayer,
+    Partition,
+    get_fs,
+    get_stable_device_path,
+    iter_mountinfo,
+    wanted_mounts,
+)
+
+from .conftest import Helpers
+from .test_initrd import symlink
+
+BLOCK_DEVICES = [
+    {"DEVNAME": "/dev/nvme0n1", "MAJOR": "259", "MINOR": "0"},
+    {
+        "DEVNAME": "/dev/nvme0n1p1",
+        "MAJOR": "259",
+        "MINOR": "1",
+        "ID_FS_UUID": "6C1F-2A0B",
+        "ID_PART_ENTRY_UUID": "0b6a4d6c-01",
+        "ID_FS_LABEL": "ESP",
+    },
+    {"DEVNAME": "/dev/nvme0n1p2", "MAJOR": "259", "MINOR": "2", "ID_FS_UUID": "8f3e2b8e-4a6e-4d8e-9c1a-2b3c4d5e6f70"},
+    {"DEVNAME": "/dev/loop0", "MAJOR": "7", "MINOR": "0"},
+]
+
+MOUNTINFO = """\
+22 1 259:2 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p2 rw
+23 22 0:21 / /proc rw,nosuid,nodev,noexec,relatime shared:5 - proc proc rw
+24 22 259:1 / /boot rw,relatime shared:29 - vfat /dev/nvme0n1p1 rw,fmask=0022,dmask=0022
+25 22 0:35 /@home /home rw,relatime shared:30 - btrfs /dev/sda1 rw,ssd,space_cache=v2,subvolid=257,subvol=/@home
+26 25 0:36 / /home/user/My\\040Files rw - fuse.sshfs host:/data\\040dir rw,user_id=1000
+27 22 0:37 / /run/user/1000 rw,nosuid,nodev shared:31 - tmpfs tmpfs rw,size=1620964k
+28 22 0:38 / /mnt2 rw,relatime - ext4 /dev/sdb1 rw
+29 22 0:39 / /mnt/proc rw,relatime - proc proc rw
+"""
+
+
+def test_iter_mountinfo(tmp_path: Path) -> None:
+    mountinfo = tmp_path.joinpath("mountinfo")
+    mountinfo.write_text(MOUNTINFO, "utf-8")
+    mounts = list(iter_mountinfo(path=mountinfo))
+    assert len(mounts) == 8
+    assert mounts[0] == Partition("/dev/nvme0n1p2", "/", "ext4", "259:2")
+    # btrfs subvolumes have an anonymous device number
+    assert mounts[3] == Partition("/dev/sda1", "/home", "btrfs", "0:35")
+    sshfs = mounts[4]
+    assert (sshfs.mountpoint, sshfs.device, sshfs.fstype) == ("/home/user/My Files", "host:/data dir", "fuse.sshfs")
+
+    wanted = [mount.mountpoint for mount in iter_mountinfo(Path("/"), mountinfo)]
+    assert wanted == ["/", "/boot", "/home", "/home/user/My Files", "/mnt2", "/mnt/proc"]
+    wanted = [mount.mountpoint for mount in iter_mountinfo(Path("/mnt"), mountinfo)]
+    assert not wanted
+
+
+def test_wanted_mounts() -> None:
+    is_wanted = wanted_mounts(Path("/"))
+    assert is_wanted("/")
+    assert is_wanted("/home/devel")
+    assert not is_wanted("/dev/shm")
+    assert not is_wanted("/var/lib/nfs/rpc_pipefs")
+    is_wanted = wanted_mounts(Path("/mnt"))
+    assert is_wanted("/mnt")
+    assert is_wanted("/mnt/boot")
+    assert not is_wanted("/mnt2")
+    assert not is_wanted("/mnt/proc")
+    assert not is_wanted("/boot")
+
+
+def test_block_device_index() -> None:
+    block_index = BlockDeviceIndex(BLOCK_DEVICES)
+    esp = block_index.lookup("/dev/nvme0n1p1")
+    assert esp is not None
+    assert (esp.uuid, esp.partuuid, esp.label) == ("6C1F-2A0B", "0b6a4d6c-01", "ESP")
+    assert block_index.lookup_devnum("259:1") == esp
+    assert block_index.lookup("/dev/sda") is None
+
+
+def test_get_stable_device_path() -> None:
+    block_index = BlockDeviceIndex(BLOCK_DEVICES)
+    assert get_stable_device_path(block_index, "/dev/nvme0n1p1") == "/dev/disk/by-uuid/6C1F-2A0B"
+    # no filesystem uuid, the caller falls back to the device name
+    assert get_stable_device_path(block_index, "/dev/loop0") == ""
+    assert get_stable_device_path(block_index, "tmpfs") == ""
+    # known by its device number only
+    root_uuid = "/dev/disk/by-uuid/8f3e2b8e-4a6e-4d8e-9c1a-2b3c4d5e6f70"
+    assert get_stable_device_path(block_index, "/dev/root", "259:2") == root_uuid
+    assert get_stable_device_path(block_index, "/dev/root", "0:42") == ""
+
+
+def test_get_fs() -> None:
+    nix_hw_config = NixConfigAttrs()
+    partitions = [
+        Partition("/dev/nvme0n1p2", "/", "ext4"),
+        Partition("/dev/nvme0n1p1", "/boot", "vfat"),
+        Partition("proc", "/proc", "proc"),
+        Partition("tmpfs", "/run/user/1000", "tmpfs"),
+    ]
+    get_fs(nix_hw_config, Path("/"), BlockDeviceIndex(BLOCK_DEVICES), partitions)
+
+    assert nix_hw_config.fsattrs == [
+        """
+  fileSystems."/" =
+    { device = "/dev/disk/by-uuid/8f3e2b8e-4a6e-4d8e-9c1a-2b3c4d5e6f70";
+      fsType = "ext4";
+    };
+""",
+        """
+  fileSystems."/boot" =
+    { device = "/dev/disk/by-uuid/6C1F-2A0B";
+      fsType = "vfat";
+    };
+""",
+    ]
+
+
+def test_get_fs_builds_index_once() -> None:
+    nix_hw_config = NixConfigAttrs()
+    partitions = [Partition(f"/dev/loop{i}", f"/mnt/{i}", "squashfs") for i in range(10)]
+    with patch("pyudev.Context") as context_mock:
+        enumerator = MagicMock()
+        enumerator.match_subsystem.return_value = enumerator
+        enumerator.__iter__.return_value = iter(BLOCK_DEVICES)
+        context_mock.return_value.list_devices.return_value = enumerator
+        get_fs(nix_hw_config, Path("/"), partitions=partitions, source=PyudevSource())
+
+    context_mock.return_value.list_devices.assert_called_once_with()
+    enumerator.match_subsystem.assert_called_once_with("block")
+    assert len(nix_hw_config.fsattrs) == 10
+    assert 'device = "/dev/loop0";' in nix_hw_config.fsattrs[0]
+
+
+def test_get_fs_block_stacks(tmp_path: Path) -> None:
+    virtual = "sys/devices/virtual/block"
+    disks = "sys/devices/pci0000:00/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block"
+    layers = {
+        # / is LVM on LUKS on nvme0n1p2
+        f"{virtual}/dm-0": (
+            "254:0",
+            "CRYPT-LUKS2-0a1b2c3d4e5f60718293a4b5c6d7e8f9-cryptroot",
+            "cryptroot",
+            ["nvme0n1p2"],
+        ),
+        f"{virtual}/dm-1": ("254:1", "LVM-Xy3kQ0f2", "vg-root", ["dm-0"]),
+        f"{virtual}/md127": ("9:127", "", "", ["sda1", "sdb1"]),
+        f"{virtual}/bcache0": ("252:0", "", "", ["sdc"]),
+        "sys/devices/pci0000:00/0000:00:1d.0/nvme/nvme0/nvme0n1/nvme0n1p2": ("259:2", "", "", []),
+        **{
+            f"{disks}/{name}": (devnum, "", "", [])
+            for name, devnum in [("sda1", "8:1"), ("sdb1", "8:17"), ("sdc", "8:32"), ("sdd", "8:48")]
+        },
+    }
+    for device_dir, (devnum, dm_uuid, dm_name, slaves) in layers.items():
+        name = device_dir.rpartition("/")[2]
+        tmp_path.joinpath(device_dir).mkdir(parents=True)
+        tmp_path.joinpath(device_dir, "dev").write_text(f"{devnum}\n", "utf-8")
+        if dm_uuid:
+            tmp_path.joinpath(device_dir, "dm").mkdir()
+            tmp_path.joinpath(device_dir, "dm/uuid").write_text(f"{dm_uuid}\n", "utf-8")
+            tmp_path.joinpath(device_dir, "dm/name").write_text(f"{dm_name}\n", "utf-8")
+        if name.startswith("md"):
+            tmp_path.joinpath(device_dir, "md").mkdir()
+        for slave in slaves:
+            symlink(tmp_path, f"{device_dir}/slaves/{slave}", f"sys/class/block/{slave}")
+        symlink(tmp_path, f"sys/class/block/{name}", device_dir)
+        symlink(tmp_path, f"sys/dev/block/{devnum}", device_dir)
+
+    block_index = BlockDeviceIndex(
+        [
+            {"DEVNAME": "/dev/nvme0n1p2", "MAJOR": "259", "MINOR": "2", "ID_FS_UUID": "4f6c9b2e-luks"},
+            {"DEVNAME": "/dev/dm-1", "MAJOR": "254", "MINOR": "1", "ID_FS_UUID": "root-uuid"},
+        ]
+    )
+    partitions = [
+        Partition("/dev/mapper/vg-root", "/", "ext4", devnum="254:1"),
+        Partition("/dev/md127", "/boot", "vfat", devnum="9:127"),
+        Partition("rpool/nix", "/nix", "zfs", devnum="0:50"),
+        Partition("/dev/bcache0", "/var", "xfs", devnum="252:0"),
+        Partition("/dev/sdd", "/srv", "xfs", devnum="8:48"),
+    ]
+    nix_hw_config = NixConfigAttrs()
+    get_fs(nix_hw_config, Path("/"), block_index, partitions, host_root=tmp_path)
+
+    assert nix_hw_config.attrs == [
+        'boot.initrd.luks.devices."cryptroot".device = "/dev/disk/by-uuid/4f6c9b2e-luks";',
+        "boot.swraid.enable = true;",
+    ]
+    assert nix_hw_config.initrd_kernel_modules == ["dm-snapshot"]
+    assert nix_hw_config.initrd_available_kernel_modules == ["bcache"]
+    # NixOS mounts these in stage 1 and supports their filesystems there on its own
+    assert not any("neededForBoot" in fsattr or "supportedFilesystems" in fsattr for fsattr in nix_hw_config.fsattrs)
+    assert nix_hw_config.fsattrs[0] == (
+        # found by its device number, udev names it dm-1
+        '\n  fileSystems."/" =\n    { device = "/dev/disk/by-uuid/root-uuid";\n      fsType = "ext4";\n    };\n'
+    )
+
+
+PCI = "sys/devices/pci0000:00"
+# disk dir -> devnum, rotational, discard_max_bytes, partitions
+STORAGE_DISKS = {
+    f"{PCI}/0000:00:1d.0/nvme/nvme0/nvme0n1": ("259:0", "0", "2199023255040", {"nvme0n1p2": "259:2"}),
+    f"{PCI}/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block/sda": ("8:0", "1", "0", {"sda1": "8:1"}),
+    f"{PCI}/0000:00:05.0/virtio2/block/vda": ("252:0", "1", "0", {}),
+}
+STORAGE_PARTITIONS = [
+    # btrfs subvolumes, anonymous device numbers on the same partition
+    Partition("/dev/nvme0n1p2", "/", "btrfs", devnum="0:31"),
+    Partition("/dev/nvme0n1p2", "/home", "btrfs", devnum="0:32"),
+    Partition("/dev/nvme0n1p2", "/nix", "btrfs", devnum="0:33"),
+    Partition("/dev/sda1", "/srv", "xfs", devnum="8:1"),
+    Partition("/dev/vda", "/data", "ext4", devnum="252:0"),
+]
+
+
+def make_storage_host(host_root: Path) -> Path:
+    """an nvme, a sata hdd and a virtio disk in /sys"""
+    for disk_dir, (devnum, rotational, discard, disk_partitions) in STORAGE_DISKS.items():
+        files = {
+            f"{disk_dir}/dev": f"{devnum}\n",
+            f"{disk_dir}/queue/rotational": f"{rotational}\n",
+            f"{disk_dir}/queue/discard_max_bytes": f"{discard}\n",
+        }
+        for partition, partition_devnum in disk_partitions.items():
+            files[f"{disk_dir}/{partition}/dev"] = f"{partition_devnum}\n"
+            files[f"{disk_dir}/{partition}/partition"] = "1\n"
+        Helpers.make_host(host_root, files)
+        symlink(host_root, f"sys/class/block/{disk_dir.rpartition('/')[2]}", disk_dir)
+        symlink(host_root, f"sys/dev/block/{devnum}", disk_dir)
+        for partition, partition_devnum in disk_partitions.items():
+            symlink(host_root, f"sys/class/block/{partition}", f"{disk_dir}/{partition}")
+            symlink(host_root, f"sys/dev/block/{partition_devnum}", f"{disk_dir}/{partition}")
+    return host_root
+
+
+def test_get_fs_storage_classes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    make_storage_host(tmp_path)
+    reads: dict[Path, int] = {}
+    read_sys_file = partitions_module.read_sys_file
+
+    def counting_read(path: Path) -> str:
+        reads[path] = reads.get(path, 0) + 1
+        return read_sys_file(path)
+
+    monkeypatch.setattr(partitions_module, "read_sys_file", counting_read)
+    nix_hw_config = NixConfigAttrs()
+    get_fs(nix_hw_config, Path("/"), BlockDeviceIndex([]), STORAGE_PARTITIONS, host_root=tmp_path)
+
+    # every sysfs file is read once, however many mounts share the device
+    assert reads and set(reads.values()) == {1}
+    noatime = [fsattr.split('"')[1] for fsattr in nix_hw_config.fsattrs if '"noatime"' in fsattr]
+    assert noatime == ["/", "/home", "/nix"]
+    assert nix_hw_config.attrs == [
+        "services.fstrim.enable = lib.mkDefault true;",
+        "services.udev.extraRules = ''\n"
+        '    ACTION=="add|change", KERNEL=="nvme[0-9]*n[0-9]*", ENV{DEVTYPE}=="disk", ATTR{queue/scheduler}="none"\n'
+        '    ACTION=="add|change", KERNEL=="vd[a-z]*", ENV{DEVTYPE}=="disk", ATTR{queue/scheduler}="none"\n'
+        '    ACTION=="add|change", KERNEL=="sd[a-z]*", ENV{DEVTYPE}=="disk", ATTR{queue/rotational}=="1", '
+        'ATTR{queue/scheduler}="bfq"\n'
+        "  '';",
+    ]
+    # the rules survive --check reading the file back
+    assert diff_hw_config(parse_hw_config(generate_hw_config(nix_hw_config)), nix_hw_config) == []
+
+
+def test_luks_uuid() -> None:
+    layer = BlockLayer("crypt", "dm-0", "254:0", dm_uuid="CRYPT-LUKS2-0a1b2c3d4e5f60718293a4b5c6d7e8f9-cryptroot")
+    assert layer.luks_uuid() == "0a1b2c3d-4e5f-6071-8293-a4b5c6d7e8f9"
@@ -0,0 +1,197 @@
+import gzip
+import json
+from pathlib import Path
+
+import pytest
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.collector import collect as collect_local
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.partitions import BlockDeviceIndex, get_fs, iter_mountinfo
+from nixos_gen_config.remote import (
+    LocalTransport,
+    SshTransport,
+    Transport,
+    collect,
+    collector_request,
+    open_payload,
+    run_remote,
+)
+from nixos_gen_config.sections import run_sections
+from nixos_gen_config.snapshot import SNAPSHOT_VERSION
+
+from .conftest import Helpers
+from .test_devices import SYSFS
+from .test_hardware import numa_host
+from .test_partitions import make_storage_host
+from .test_snapshot import make_luks_on_lvm
+
+HOST_FILES = {
+    **SYSFS,
+    "proc/cpuinfo": "processor\t: 0\nvendor_id\t: GenuineIntel\nflags\t\t: fpu vmx\n\nprocessor\t: 1\n",
+    "proc/sys/kernel/osrelease": "6.1.0\n",
+    "proc/self/mountinfo": (
+        "22 1 259:2 / / rw,relatime - ext4 /dev/nvme0n1p2 rw\n"
+        "23 22 259:1 / /boot rw,relatime - vfat /dev/nvme0n1p1 rw\n"
+        "24 22 0:5 / /proc rw - proc proc rw\n"
+    ),
+    "sys/class/dmi/id/sys_vendor": "QEMU\n",
+    "sys/devices/system/clocksource/clocksource0/available_clocksource": "kvm-clock tsc\n",
+    "sys/devices/system/cpu/cpufreq/policy0/scaling_available_governors": "performance schedutil\n",
+}
+
+
+class CountingTransport(LocalTransport):
+    runs = 0
+
+    def run(self, program: str) -> bytes:
+        self.runs += 1
+        return super().run(program)
+
+
+def test_remote_collect(tmp_path: Path) -> None:
+    host_root = Helpers.make_host(tmp_path.joinpath("host"), HOST_FILES)
+    transport = CountingTransport()
+    payload = collect(transport, host_root)
+    # every input in one exec
+    assert transport.runs == 1
+    assert payload["files"]["proc/cpuinfo"] == "processor\t: 0\nvendor_id\t: GenuineIntel\nflags\t\t: fpu vmx\n"
+    # the cpufreq policies are found by glob on the host
+    assert "sys/devices/system/cpu/cpufreq/policy0/scaling_available_governors" in payload["files"]
+    assert {"DEVNAME": "/dev/nvme0n1p1", "ID_FS_UUID": "6C1F-2A0B"}.items() <= payload["devices"]["block"][1].items()
+
+    with open_payload(payload, Path("/")) as snapshot:
+        assert snapshot.virt == "kvm"
+        hw_config = generate_hw_config(run_sections(snapshot.sections(Path("/"), no_filesystems=False)))
+    assert 'boot.initrd.availableKernelModules = [ "xhci_pci" "nvme" "usbhid" ];' in hw_config
+    assert 'boot.kernelModules = [ "kvm-intel" ];' in hw_config
+    assert '(modulesPath + "/profiles/qemu-quest.nix")' in hw_config
+    assert 'fileSystems."/boot" =\n    { device = "/dev/disk/by-uuid/6C1F-2A0B";' in hw_config
+    assert 'fileSystems."/proc"' not in hw_config
+
+
+def test_remote_block_stacks(tmp_path: Path) -> None:
+    # the collector sends the block device tree along, the stack below / is replayed from it
+    host_root = make_luks_on_lvm(tmp_path.joinpath("host"))
+    host_root.joinpath("proc/self").mkdir(parents=True)
+    host_root.joinpath("proc/self/mountinfo").write_text(
+        "22 1 254:1 / / rw,relatime - ext4 /dev/mapper/cryptroot rw\n", "utf-8"
+    )
+    payload = collect(LocalTransport(), host_root)
+    with open_payload(payload, Path("/")) as snapshot:
+        nix_hw_config = run_sections(snapshot.sections(Path("/"), no_filesystems=False))
+    assert 'boot.initrd.luks.devices."cryptroot".device = "/dev/disk/by-uuid/4f6c9b2e-luks";' in nix_hw_config.attrs
+    assert nix_hw_config.initrd_kernel_modules == ["dm-snapshot"]
+
+
+def test_remote_storage_section(tmp_path: Path) -> None:
+    host_root = make_storage_host(tmp_path.joinpath("host"))
+    mountinfo = Helpers.make_host(
+        host_root,
+        {
+            "proc/cpuinfo": HOST_FILES["proc/cpuinfo"],
+            "proc/self/mountinfo": (
+                "22 1 0:31 /@ / rw - btrfs /dev/nvme0n1p2 rw\n"
+                "23 22 8:1 / /srv rw - xfs /dev/sda1 rw\n"
+                "24 22 252:0 / /data rw - ext4 /dev/vda rw\n"
+            ),
+        },
+    ).joinpath("proc/self/mountinfo")
+    live = NixConfigAttrs()
+    get_fs(live, Path("/"), BlockDeviceIndex([]), list(iter_mountinfo(Path("/"), mountinfo)), host_root=host_root)
+    assert "services.fstrim.enable = lib.mkDefault true;" in live.attrs
+
+    with open_payload(collect(LocalTransport(), host_root), Path("/")) as snapshot:
+        replayed = NixConfigAttrs()
+        get_fs(replayed, Path("/"), BlockDeviceIndex([]), snapshot.partitions, host_root=snapshot.host_root)
+    assert replayed.attrs == live.attrs
+    assert replayed.fsattrs == live.fsattrs
+
+
+def test_collector_modules_alias(tmp_path: Path) -> None:
+    # the nvme controller has no driver, only the alias lines matching it are sent back.
+    # the unbound virtio network card isn't of a class the initrd needs, its virtio_pci line isn't
+    files = dict(HOST_FILES)
+    files["sys/bus/pci/devices/0000:01:00.0/uevent"] = (
+        "PCI_CLASS=10802\nPCI_ID=144D:A808\nMODALIAS=pci:v0000144Dd0000A808sv0000144Dsd0000A801bc01sc08i02\n"
+    )
+    files["sys/bus/pci/devices/0000:02:00.0/uevent"] = (
+        "PCI_CLASS=20000\nPCI_ID=1AF4:1041\nMODALIAS=pci:v00001AF4d00001041sv00001AF4sd00001100bc02sc00i00\n"
+    )
+    files["lib/modules/6.1.0/modules.alias"] = Helpers.read_asset("modules.alias")
+    host_root = Helpers.make_host(tmp_path, files)
+    request = collector_request(host_root)
+    request["virt"] = False
+    payload = collect_local(request, str(host_root))
+    assert payload["files"]["lib/modules/6.1.0/modules.alias"] == "alias pci:v*d*sv*sd*bc01sc08i02* nvme\n"
+
+
+def test_ssh_transport() -> None:
+    assert SshTransport("root@db1", ssh=["ssh", "-p", "2222"]).command() == [
+        "ssh",
+        "-p",
+        "2222",
+        "-o",
+        "BatchMode=yes",
+        "-o",
+        "ConnectTimeout=10",
+        "-o",
+        "ServerAliveInterval=15",
+        "-o",
+        "ServerAliveCountMax=3",
+        "root@db1",
+        "python3",
+        "-",
+    ]
+
+
+def test_transport_timeout() -> None:
+    with pytest.raises(RuntimeError, match="timed out after 0.5s"):
+        LocalTransport(timeout=0.5).run("import time\ntime.sleep(10)\n")
+
+
+def test_collect_missing_keys() -> None:
+    class OtherCollector(Transport):
+        def command(self) -> list[str]:
+            return []
+
+        def run(self, program: str) -> bytes:
+            return gzip.compress(json.dumps({"version": SNAPSHOT_VERSION, "files": {}}).encode())
+
+    with pytest.raises(ValueError, match="has no exists, devices, virt"):
+        collect(OtherCollector())
+
+
+def fake_ssh(monkeypatch: pytest.MonkeyPatch, host_root: Path) -> None:
+    def fake_ssh_run(self: SshTransport, program: str) -> bytes:
+        if self.host == "broken":
+            raise RuntimeError("ssh exited with 255")
+        # the collector of the fake host, as the remote python would run it
+        return LocalTransport().run(program.replace('"host_root": "/"', f'"host_root": "{host_root}"'))
+
+    monkeypatch.setattr(SshTransport, "run", fake_ssh_run)
+
+
+def test_run_remote(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    fake_ssh(monkeypatch, Helpers.make_host(tmp_path.joinpath("host"), HOST_FILES))
+    out_dir = tmp_path.joinpath("out")
+    assert run_remote(["root@db1", "broken"], out_dir, Path("/"), True, jobs=2, cpu_profile="throughput") == 1
+    hw_config = out_dir.joinpath("db1/hardware-configuration.nix").read_text("utf-8")
+    assert '"nvme"' in hw_config
+    assert 'powerManagement.cpuFreqGovernor = lib.mkDefault "performance";' in hw_config
+
+
+def test_run_remote_memory_tuning(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    host_root = numa_host(
+        Helpers.make_host(tmp_path.joinpath("host"), HOST_FILES), ["0-15", "16-31"], 64, [2048, 1048576]
+    )
+    fake_ssh(monkeypatch, host_root)
+    out_dir = tmp_path.joinpath("out")
+    assert run_remote(["db1"], out_dir, Path("/"), True, jobs=1, memory_tuning=True) == 0
+    hw_config = out_dir.joinpath("db1/hardware-configuration.nix").read_text("utf-8")
+    assert "services.irqbalance.enable = lib.mkDefault true;" in hw_config
+    assert '"default_hugepagesz=1G"' in hw_config
+    # the topology of the host, not of this machine
+    assert "db1: Memory: 2 numa nodes (node0: cpus 0-15; node1: cpus 16-31)" in capsys.readouterr().err
@@ -0,0 +1,34 @@
+import threading
+import time
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.sections import Section, run_sections
+
+
+def slow_section(module: str, delay: float) -> Section:
+    def section(nix_config: NixConfigAttrs) -> None:
+        time.sleep(delay)
+        nix_config.kernel_modules.append(module)
+
+    return section
+
+
+def test_run_sections_order() -> None:
+    # the first section finishes last, the merge order must still follow the section order
+    sections = [slow_section("first", 0.05), slow_section("second", 0.0), slow_section("third", 0.01)]
+    serial = run_sections(sections, jobs=1)
+    parallel = run_sections(sections, jobs=3)
+    assert serial.kernel_modules == ["first", "second", "third"]
+    assert parallel == serial
+
+
+def test_run_sections_concurrent() -> None:
+    # both sections only get past the barrier if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def section(nix_config: NixConfigAttrs) -> None:
+        barrier.wait()
+        nix_config.attrs.append("ok")
+
+    # the fragments are merged like any other, so the same attr ends up only once
+    assert run_sections([section, section], jobs=2).attrs == ["ok"]
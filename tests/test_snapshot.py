@@ -0,0 +1,245 @@
+import io
+import json
+import tarfile
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.devices import SysfsSource
+from nixos_gen_config.generate_hw_config import generate_hw_config
+from nixos_gen_config.partitions import BlockDeviceIndex, Partition, get_fs
+from nixos_gen_config.sections import run_sections
+from nixos_gen_config.snapshot import SNAPSHOT_VERSION, capture_snapshot, open_snapshot
+
+from .conftest import Helpers
+from .test_initrd import symlink
+from .test_partitions import STORAGE_PARTITIONS, make_storage_host
+
+DEVICES = {
+    "pci": [
+        {"SUBSYSTEM": "pci", "DRIVER": "xhci_hcd", "PCI_CLASS": "C0330", "PCI_ID": "8086:A36D"},
+        {"SUBSYSTEM": "pci", "DRIVER": "nvme", "PCI_CLASS": "10802", "PCI_ID": "144D:A808"},
+    ],
+    "block": [
+        {"SUBSYSTEM": "block", "DEVNAME": "/dev/nvme0n1p1", "MAJOR": "259", "MINOR": "1", "ID_FS_UUID": "6C1F-2A0B"},
+        {"SUBSYSTEM": "block", "DEVNAME": "/dev/nvme0n1p2", "MAJOR": "259", "MINOR": "2", "ID_FS_UUID": "8f3e2b8e"},
+    ],
+    "input": [{"SUBSYSTEM": "input", "ID_INPUT_KEYBOARD": "1", "ID_USB_DRIVER": "usbhid"}],
+}
+PARTITIONS = [
+    Partition("/dev/nvme0n1p2", "/", "ext4"),
+    Partition("/dev/nvme0n1p1", "/boot", "vfat"),
+    Partition("proc", "/proc", "proc"),
+]
+
+EXPECTED = """\
+# Do not modify this file!  It was generated by ‘nixos-generate-config’
+# and may be overwritten by future invocations.  Please make changes
+# to /etc/nixos/configuration.nix instead.
+{ config, lib, pkgs, modulesPath, ... }:
+{
+  imports =
+    [ (modulesPath + "/installer/scan/not-detected.nix")
+    ];
+
+  boot.initrd.availableKernelModules = [ "xhci_pci" "nvme" "usbhid" ];
+  boot.initrd.kernelModules = [ ];
+  boot.kernelModules = [ "kvm-amd" ];
+  boot.extraModulePackages = [ ];
+  hardware.firmware = [ ];
+  hardware.cpu.amd.updateMicrocode = lib.mkDefault config.hardware.enableRedistributableFirmware;
+  powerManagement.cpuFreqGovernor = lib.mkDefault "powersave";
+
+  fileSystems."/" =
+    { device = "/dev/disk/by-uuid/8f3e2b8e";
+      fsType = "ext4";
+    };
+
+  fileSystems."/boot" =
+    { device = "/dev/disk/by-uuid/6C1F-2A0B";
+      fsType = "vfat";
+    };"""
+
+
+def add_file(tar: tarfile.TarFile, name: str, content: str) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(content.encode())
+    tar.addfile(info, io.BytesIO(content.encode()))
+
+
+def write_snapshot(archive: Path, extra: dict[str, str]) -> None:
+    metadata = {
+        "version": SNAPSHOT_VERSION,
+        "virt": "none",
+        "devices": DEVICES,
+        "partitions": [list(part) for part in PARTITIONS],
+    }
+    with tarfile.open(archive, "w:xz") as tar:
+        add_file(tar, "snapshot.json", json.dumps(metadata))
+        add_file(tar, "host/proc/cpuinfo", Helpers.read_asset("cpu_info_amd"))
+        add_file(
+            tar,
+            "host/sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors",
+            Helpers.read_asset("available_governors"),
+        )
+        for name, content in extra.items():
+            add_file(tar, name, content)
+
+
+def test_replay_snapshot(tmp_path: Path) -> None:
+    archive = tmp_path.joinpath("snapshot.tar.xz")
+    write_snapshot(archive, {})
+    with patch("pyudev.Context") as context_mock, patch("subprocess.run") as subprocess_mock:
+        with open_snapshot(archive) as snapshot:
+            nix_hw_config = run_sections(snapshot.sections(Path("/"), no_filesystems=False), jobs=4)
+    context_mock.assert_not_called()
+    subprocess_mock.assert_not_called()
+    assert generate_hw_config(nix_hw_config) == EXPECTED
+
+
+def test_replay_snapshot_ignores_paths_outside_host(tmp_path: Path) -> None:
+    archive = tmp_path.joinpath("snapshot.tar.xz")
+    write_snapshot(archive, {"host/../../escaped": "x", "outside": "x"})
+    with open_snapshot(archive) as snapshot:
+        assert sorted(p.name for p in snapshot.host_root.iterdir()) == ["proc", "sys"]
+    assert not tmp_path.joinpath("escaped").exists()
+
+
+def test_replay_snapshot_bad_version(tmp_path: Path) -> None:
+    archive = tmp_path.joinpath("snapshot.tar")
+    with tarfile.open(archive, "w") as tar:
+        add_file(tar, "snapshot.json", json.dumps({"version": SNAPSHOT_VERSION + 1}))
+    with pytest.raises(ValueError):
+        with open_snapshot(archive):
+            pass
+
+
+def test_replay_not_a_snapshot(tmp_path: Path) -> None:
+    archive = tmp_path.joinpath("backup.tar")
+    with tarfile.open(archive, "w") as tar:
+        add_file(tar, "etc/hostname", "db1\n")
+    with pytest.raises(ValueError, match="is not a hardware snapshot"):
+        with open_snapshot(archive):
+            pass
+
+
+@pytest.mark.parametrize("missing", ["virt", "devices", "partitions"])
+def test_replay_snapshot_missing_keys(tmp_path: Path, missing: str) -> None:
+    metadata = {"version": SNAPSHOT_VERSION, "virt": "none", "devices": {}, "partitions": []}
+    del metadata[missing]
+    archive = tmp_path.joinpath("snapshot.tar")
+    with tarfile.open(archive, "w") as tar:
+        add_file(tar, "snapshot.json", json.dumps(metadata))
+    with pytest.raises(ValueError, match=missing):
+        with open_snapshot(archive):
+            pass
+
+
+def test_capture_snapshot_roundtrip(tmp_path: Path) -> None:
+    host_root = tmp_path.joinpath("host")
+    host_root.joinpath("proc").mkdir(parents=True)
+    host_root.joinpath("proc", "cpuinfo").write_text(Helpers.read_asset("cpu_info_amd"), "utf-8")
+    devices = [device for subsystem_devices in DEVICES.values() for device in subsystem_devices]
+    archive = tmp_path.joinpath("snapshot.tar.xz")
+
+    enumerator = MagicMock()
+    enumerator.match_subsystem.return_value = enumerator
+    enumerator.__iter__.return_value = iter(devices)
+    with patch("pyudev.Context") as context_mock, patch("nixos_gen_config.snapshot.detect_virt", return_value="kvm"):
+        context_mock.return_value.list_devices.return_value = enumerator
+        with patch("nixos_gen_config.snapshot.list_partitions", return_value=PARTITIONS):
+            capture_snapshot(archive, host_root)
+
+    with open_snapshot(archive) as snapshot:
+        assert snapshot.virt == "kvm"
+        assert snapshot.devices == DEVICES
+        assert snapshot.partitions == PARTITIONS
+        # only the first processor is recorded
+        assert snapshot.host_root.joinpath("proc", "cpuinfo").read_text("utf-8").count("processor") == 1
+
+
+NVME_DISK = "sys/devices/pci0000:00/0000:00:1d.0/nvme/nvme0/nvme0n1"
+# LUKS on an LVM volume on a partition: device dir -> dev, dm uuid, dm name, slaves
+LUKS_ON_LVM: dict[str, tuple[str, str, str, list[str]]] = {
+    NVME_DISK: ("259:0", "", "", []),
+    f"{NVME_DISK}/nvme0n1p2": ("259:2", "", "", []),
+    "sys/devices/virtual/block/dm-0": ("254:0", "LVM-Xy3kQ0f2", "vg-root", ["nvme0n1p2"]),
+    "sys/devices/virtual/block/dm-1": (
+        "254:1",
+        "CRYPT-LUKS2-0a1b2c3d4e5f60718293a4b5c6d7e8f9-cryptroot",
+        "cryptroot",
+        ["dm-0"],
+    ),
+}
+LUKS_ON_LVM_PARTITIONS = [Partition("/dev/mapper/cryptroot", "/", "ext4", devnum="254:1")]
+
+
+def make_luks_on_lvm(host_root: Path) -> Path:
+    files = {
+        "proc/cpuinfo": Helpers.read_asset("cpu_info_amd"),
+        "run/udev/data/b254:0": "E:ID_FS_UUID=4f6c9b2e-luks\nE:ID_FS_TYPE=crypto_LUKS\n",
+        "run/udev/data/b254:1": "E:ID_FS_UUID=root-uuid\nE:ID_FS_TYPE=ext4\n",
+    }
+    for device_dir, (devnum, dm_uuid, dm_name, _) in LUKS_ON_LVM.items():
+        name = device_dir.rpartition("/")[2]
+        major, _, minor = devnum.partition(":")
+        files[f"{device_dir}/uevent"] = f"MAJOR={major}\nMINOR={minor}\nDEVNAME={name}\n"
+        files[f"{device_dir}/dev"] = f"{devnum}\n"
+        if dm_uuid:
+            files[f"{device_dir}/dm/uuid"] = f"{dm_uuid}\n"
+            files[f"{device_dir}/dm/name"] = f"{dm_name}\n"
+    files[f"{NVME_DISK}/nvme0n1p2/partition"] = "2\n"
+    Helpers.make_host(host_root, files)
+    for device_dir, (devnum, _, _, slaves) in LUKS_ON_LVM.items():
+        for slave in slaves:
+            symlink(host_root, f"{device_dir}/slaves/{slave}", f"sys/class/block/{slave}")
+        symlink(host_root, f"sys/class/block/{device_dir.rpartition('/')[2]}", device_dir)
+        symlink(host_root, f"sys/dev/block/{devnum}", device_dir)
+    return host_root
+
+
+def test_replay_block_stacks(tmp_path: Path) -> None:
+    # the stack below / is walked in /sys, which the snapshot has to bring along
+    host_root = make_luks_on_lvm(tmp_path.joinpath("host"))
+    live = NixConfigAttrs()
+    block_index = BlockDeviceIndex.from_source(SysfsSource(host_root))
+    get_fs(live, Path("/"), block_index, LUKS_ON_LVM_PARTITIONS, host_root=host_root)
+    assert live.attrs == ['boot.initrd.luks.devices."cryptroot".device = "/dev/disk/by-uuid/4f6c9b2e-luks";']
+    assert live.initrd_kernel_modules == ["dm-snapshot"]
+
+    archive = tmp_path.joinpath("snapshot.tar.xz")
+    with (
+        patch("nixos_gen_config.snapshot.list_partitions", return_value=LUKS_ON_LVM_PARTITIONS),
+        patch("nixos_gen_config.snapshot.detect_virt", return_value="none"),
+    ):
+        capture_snapshot(archive, host_root, source=SysfsSource(host_root))
+    with open_snapshot(archive) as snapshot:
+        replayed = run_sections(snapshot.sections(Path("/"), no_filesystems=False))
+    # the other sections add their own attrs
+    assert set(live.attrs) <= set(replayed.attrs)
+    assert replayed.initrd_kernel_modules == live.initrd_kernel_modules
+    assert replayed.fsattrs == live.fsattrs
+
+
+def test_replay_storage_section(tmp_path: Path) -> None:
+    # the storage classes come from the queue files of the disks
+    host_root = make_storage_host(tmp_path.joinpath("host"))
+    host_root.joinpath("proc").mkdir()
+    host_root.joinpath("proc/cpuinfo").write_text(Helpers.read_asset("cpu_info_amd"), "utf-8")
+    live = NixConfigAttrs()
+    get_fs(live, Path("/"), BlockDeviceIndex([]), STORAGE_PARTITIONS, host_root=host_root)
+    assert "services.fstrim.enable = lib.mkDefault true;" in live.attrs
+
+    archive = tmp_path.joinpath("snapshot.tar.xz")
+    with (
+        patch("nixos_gen_config.snapshot.list_partitions", return_value=STORAGE_PARTITIONS),
+        patch("nixos_gen_config.snapshot.detect_virt", return_value="none"),
+    ):
+        capture_snapshot(archive, host_root, source=SysfsSource(host_root))
+    with open_snapshot(archive) as snapshot:
+        replayed = NixConfigAttrs()
+        get_fs(replayed, Path("/"), BlockDeviceIndex([]), snapshot.partitions, host_root=snapshot.host_root)
+    assert replayed.attrs == live.attrs
+    assert replayed.fsattrs == live.fsattrs
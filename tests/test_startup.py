@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import nixos_gen_config
+
+from .test_snapshot import write_snapshot
+
+# total self time of every import of a cold start, in microseconds. generous so slow CI machines pass,
+# pulling pyudev, psutil or icecream back into startup is caught by the checks below
+IMPORT_BUDGET_US = 400_000
+HEAVY_MODULES = {"pyudev", "psutil", "icecream", "ctypes"}
+
+
+def import_times(*args: str) -> dict[str, int]:
+    """self import time in microseconds of every module imported by running nixos-gen-config with args"""
+    env = dict(os.environ)
+    src = str(Path(nixos_gen_config.__file__).parent.parent)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "nixos_gen_config.main", *args],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    times: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, _, module = line[len("import time:") :].split("|")
+        times[module.strip()] = int(self_us)
+    return times
+
+
+def test_startup_help() -> None:
+    times = import_times("--help")
+    assert not HEAVY_MODULES & times.keys()
+
+
+def test_startup_show_hardware_config(tmp_path: Path) -> None:
+    archive = tmp_path.joinpath("snapshot.tar.xz")
+    write_snapshot(archive, {})
+    times = import_times("--show-hardware-config", "--from-snapshot", str(archive))
+    assert "nixos_gen_config.snapshot" in times
+    assert not HEAVY_MODULES & times.keys()
+    total = sum(times.values())
+    print(f"import time of --show-hardware-config --from-snapshot: {total / 1000:.1f}ms")
+    assert total < IMPORT_BUDGET_US
@@ -0,0 +1,87 @@
+import json
+from functools import partial
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from nixos_gen_config.hardware import udev_section
+from nixos_gen_config.partitions import BlockDeviceIndex, get_fs, iter_mountinfo
+from nixos_gen_config.sections import run_sections
+from nixos_gen_config.timings import Timings, timings
+
+from .conftest import FakeDevice
+from .test_fingerprint import run_main
+from .test_partitions import MOUNTINFO
+
+
+@pytest.fixture
+def enabled_timings() -> Iterator[Timings]:
+    timings.enabled = True
+    yield timings
+    timings.enabled = False
+    timings.times.clear()
+    timings.counters.clear()
+
+
+def test_timings_disabled() -> None:
+    recorder = Timings()
+    with recorder.timer("section"):
+        recorder.count("devices", 3)
+    assert not recorder.times and not recorder.counters
+
+
+def test_timings_report() -> None:
+    recorder = Timings()
+    recorder.enabled = True
+    with recorder.timer("render"):
+        pass
+    recorder.count("mounts kept", 2)
+    recorder.count("mounts kept")
+    report = json.loads(recorder.report("json"))
+    assert list(report["times_ms"]) == ["render"]
+    assert report["counters"] == {"mounts kept": 3}
+    assert recorder.report().splitlines()[1].split() == ["mounts", "kept", "3"]
+
+
+def test_timings_sections(enabled_timings: Timings, tmp_path: Path) -> None:
+    mountinfo = tmp_path.joinpath("mountinfo")
+    mountinfo.write_text(MOUNTINFO, "utf-8")
+    devices = [FakeDevice(SUBSYSTEM="block", ID_FS_TYPE="bcache"), FakeDevice(SUBSYSTEM="pci")]
+    sections = [
+        partial(udev_section, devices=devices),
+        partial(
+            get_fs,
+            root_dir=Path("/"),
+            block_index=BlockDeviceIndex([]),
+            partitions=iter_mountinfo(Path("/"), mountinfo),
+        ),
+    ]
+    nix_hw_config = run_sections(sections, jobs=2)
+
+    assert {"section udev_section", "section get_fs"} <= enabled_timings.times.keys()
+    assert enabled_timings.counters["udev devices block"] == 1
+    assert enabled_timings.counters["udev devices pci"] == 1
+    assert enabled_timings.counters["mounts scanned"] == len(MOUNTINFO.splitlines())
+    assert enabled_timings.counters["mounts kept"] == len(nix_hw_config.fsattrs)
+
+
+def test_main_timings_file(enabled_timings: Timings, tmp_path: Path) -> None:
+    tmp_path.joinpath("configuration.nix").write_text("{ }", "utf-8")
+    timings_file = tmp_path.joinpath("timings.json")
+    run_main("--dir", str(tmp_path), "--no-filesystems", "--timings=json", "--timings-file", str(timings_file))
+    report = json.loads(timings_file.read_text("utf-8"))
+    assert {"fingerprint", "section udev_section", "section virt_section", "render", "write"} <= report[
+        "times_ms"
+    ].keys()
+    assert report["counters"]["udev devices block"] == 1
+
+
+def test_main_timings_on_exit(enabled_timings: Timings, tmp_path: Path) -> None:
+    # --check exits with its status, the report is still written
+    timings_file = tmp_path.joinpath("timings.json")
+    with pytest.raises(SystemExit):
+        run_main(
+            "--dir", str(tmp_path), "--no-filesystems", "--check", "--timings=json", "--timings-file", str(timings_file)
+        )
+    assert "section udev_section" in json.loads(timings_file.read_text("utf-8"))["times_ms"]
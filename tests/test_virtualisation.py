@@ -0,0 +1,32 @@
+from pathlib import Path
+
+import pytest
+
+from nixos_gen_config.hardware import CpuInfo
+from nixos_gen_config.virtualisation import detect_virt
+
+from .conftest import Helpers
+
+# every directory holds the files a machine's detection reads and what systemd-detect-virt printed on it
+VIRT_CASES = sorted(Helpers.root().joinpath("assets", "virt").iterdir())
+
+
+@pytest.mark.parametrize("host_root", VIRT_CASES, ids=[case.name for case in VIRT_CASES])
+def test_detect_virt_matches_systemd(host_root: Path) -> None:
+    expected = host_root.joinpath("systemd-detect-virt").read_text("utf-8").strip()
+    cpuinfo = CpuInfo.read(host_root.joinpath("proc", "cpuinfo"))
+    assert detect_virt(cpuinfo, host_root) == expected
+
+
+def test_detect_virt_unknown_hypervisor(tmp_path: Path) -> None:
+    # only the CPUID vendor could tell which hypervisor this is
+    cpuinfo = CpuInfo(flags=frozenset(["fpu", "hypervisor"]))
+    tmp_path.joinpath("sys", "class", "dmi", "id").mkdir(parents=True)
+    tmp_path.joinpath("sys", "class", "dmi", "id", "sys_vendor").write_text("Some Cloud\n", "utf-8")
+    assert detect_virt(cpuinfo, tmp_path) is None
+
+
+def test_detect_virt_container_other(tmp_path: Path) -> None:
+    tmp_path.joinpath("run", "systemd").mkdir(parents=True)
+    tmp_path.joinpath("run", "systemd", "container").write_text("oci\n", "utf-8")
+    assert detect_virt(CpuInfo(), tmp_path) == "container-other"
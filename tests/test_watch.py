@@ -0,0 +1,109 @@
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Iterable, Optional
+
+import pytest
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.devices import SysfsSource
+from nixos_gen_config.hardware import udev_section
+from nixos_gen_config.sections import Section
+from nixos_gen_config.watch import IncrementalConfig, collect_events, watch, watched_subsystems
+
+from .conftest import Helpers
+from .test_devices import SYSFS
+
+
+class FakeMonitor:
+    """hands out the queued events, each None ends a burst and an empty queue ends the watch"""
+
+    def __init__(self, *events: Optional[str]) -> None:
+        self.events = list(events)
+
+    def poll(self, timeout: Optional[float] = None) -> Any:
+        if not self.events:
+            return None
+        subsystem = self.events.pop(0)
+        return SimpleNamespace(subsystem=subsystem) if subsystem else None
+
+
+def counting_sections(
+    runs: dict[str, int], modules: dict[str, list[str]], walked: Optional[list[str]] = None
+) -> list[Section]:
+    # named like the real sections, watch picks the sections to rerun by name
+    def udev_section(nix_config: NixConfigAttrs, subsystems: Iterable[str] = ("pci", "block", "input")) -> None:
+        runs["udev_section"] += 1
+        if walked is not None:
+            walked.extend(subsystems)
+        if "pci" in subsystems:
+            nix_config.initrd_available_kernel_modules.extend(modules["udev"])
+
+    def get_fs(nix_config: NixConfigAttrs) -> None:
+        runs["get_fs"] += 1
+
+    def cpu_section(nix_config: NixConfigAttrs) -> None:
+        runs["cpu_section"] += 1
+        nix_config.kernel_modules.append("kvm-intel")
+
+    return [udev_section, get_fs, cpu_section]
+
+
+def test_collect_events_debounces() -> None:
+    monitor = FakeMonitor("pci", "block", "pci", None, "input")
+    assert collect_events(monitor, debounce=0.01, max_delay=5) == {"pci", "block"}
+    assert collect_events(monitor, debounce=0.01, max_delay=5) == {"input"}
+    assert collect_events(monitor, debounce=0.01, max_delay=5) == set()
+
+
+def test_incremental_config_reruns_affected_sections() -> None:
+    runs = {"udev_section": 0, "get_fs": 0, "cpu_section": 0}
+    walked: list[str] = []
+    sections = counting_sections(runs, {"udev": ["nvme"]}, walked)
+    incremental = IncrementalConfig(sections)
+    # udev_section runs once per subsystem
+    assert runs == {"udev_section": 3, "get_fs": 1, "cpu_section": 1}
+    assert watched_subsystems(incremental.sections) == {"pci", "block", "input"}
+
+    walked.clear()
+    assert incremental.refresh({"input"}) == ["udev_section"]
+    assert incremental.refresh({"block"}) == ["udev_section", "get_fs"]
+    assert incremental.refresh({"usb"}) == []
+    # only the devices of the subsystems of the events are walked again
+    assert walked == ["input", "block"]
+    assert runs == {"udev_section": 5, "get_fs": 2, "cpu_section": 1}
+    assert incremental.config().kernel_modules == ["kvm-intel"]
+    assert incremental.config().initrd_available_kernel_modules == ["nvme"]
+
+
+def test_udev_section_per_subsystem(tmp_path: Path) -> None:
+    host_root = Helpers.make_host(tmp_path, SYSFS)
+    section = partial(udev_section, host_root=host_root, source=SysfsSource(host_root))
+    whole = NixConfigAttrs()
+    section(whole)
+    # split by subsystem the fragments merge to the same config
+    assert IncrementalConfig([section]).config() == whole
+
+    keyboards = NixConfigAttrs()
+    section(keyboards, subsystems=["input"])
+    assert keyboards.initrd_available_kernel_modules == ["usbhid"]
+
+
+def test_watch_rewrites_only_changes(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    runs = {"udev_section": 0, "get_fs": 0, "cpu_section": 0}
+    modules = {"udev": ["xhci_pci"]}
+    sections = counting_sections(runs, modules)
+
+    class HotplugMonitor(FakeMonitor):
+        def poll(self, timeout: Optional[float] = None) -> Any:
+            # the second burst adds a disk controller
+            if len(self.events) == 2:
+                modules["udev"] = ["xhci_pci", "nvme"]
+            return super().poll(timeout)
+
+    watch(sections, tmp_path, HotplugMonitor("pci", "pci", None, "pci", None), debounce=0.01)
+    hw_config = tmp_path.joinpath("hardware-configuration.nix").read_text("utf-8")
+    assert '"xhci_pci" "nvme"' in hw_config
+    # the initial write and the one after the disk controller, the first burst changed nothing
+    assert capsys.readouterr().out.count("Writing") == 2
+    assert runs == {"udev_section": 5, "get_fs": 1, "cpu_section": 1}
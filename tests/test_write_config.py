@@ -0,0 +1,59 @@
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from nixos_gen_config.classes import NixConfigAttrs
+from nixos_gen_config.generate_hw_config import generate_hw_config, render_hw_config
+from nixos_gen_config.write_config import write_config_file, write_hw_config
+
+
+def test_render_hw_config_no_trailing_whitespace() -> None:
+    nix_hw_config = NixConfigAttrs(attrs=["boot.isContainer = true;"])
+    sink = io.StringIO()
+    render_hw_config(nix_hw_config, sink)
+    assert sink.getvalue() == generate_hw_config(nix_hw_config)
+    assert sink.getvalue().endswith("  boot.isContainer = true;")
+
+    sink = io.StringIO()
+    render_hw_config(NixConfigAttrs(), sink)
+    assert sink.getvalue().endswith("hardware.firmware = [ ];")
+
+
+def test_write_config_file(tmp_path: Path) -> None:
+    config_file = tmp_path.joinpath("hardware-configuration.nix")
+    assert write_config_file(config_file, "{ }")
+    assert config_file.read_text("utf-8") == "{ }"
+    # only the config file is left behind
+    assert list(tmp_path.iterdir()) == [config_file]
+
+
+def test_write_config_file_unchanged(tmp_path: Path) -> None:
+    config_file = tmp_path.joinpath("hardware-configuration.nix")
+    config_file.write_text("{ }", "utf-8")
+    os.utime(config_file, (1_000_000, 1_000_000))
+    inode = config_file.stat().st_ino
+
+    assert not write_config_file(config_file, "{ }")
+    assert config_file.stat().st_mtime == 1_000_000
+    assert config_file.stat().st_ino == inode
+
+
+def test_write_config_file_replaces(tmp_path: Path) -> None:
+    config_file = tmp_path.joinpath("hardware-configuration.nix")
+    config_file.write_text("{ old }", "utf-8")
+    config_file.chmod(0o600)
+
+    assert write_config_file(config_file, "{ new }")
+    assert config_file.read_text("utf-8") == "{ new }"
+    assert config_file.stat().st_mode & 0o777 == 0o600
+
+
+def test_write_hw_config_twice(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    hw_config = generate_hw_config(NixConfigAttrs(kernel_modules=["kvm-amd"]))
+    write_hw_config(hw_config, tmp_path)
+    write_hw_config(hw_config, tmp_path)
+    config_file = tmp_path.joinpath("hardware-configuration.nix")
+    assert config_file.read_text("utf-8") == hw_config
+    assert capsys.readouterr().out.splitlines() == [f"Writing {config_file}", f"{config_file} is up to date"]